@@ -0,0 +1,160 @@
+"""Общий анализатор текста для main.py и talk2json_bot.
+
+Текст приводится к нижнему регистру, знаки препинания заменяются пробелами
+(как в TextPreprocessor), термы получают номера в общем словаре.
+russian_words() и scan() разбирают текст одним скомпилированным выражением
+за один проход: первая отдает только русские слова без цифр (для ключевых
+слов запроса), вторая - все токены с позициями и видом (русское слово,
+токен с цифрами, прочее). Массивы
+номеров термов кэшируются по хэшу текста и сохраняются на диск вместе со
+словарем, поэтому каждый чанк токенизируется один раз, а оба приложения
+индексируют одинаковые термы.
+
+Формат папки кэша (ANALYZER_DIR):
+    vocab.txt   - термы построчно, номер терма = номер строки
+    tokens.bin  - номера термов всех текстов подряд (int32)
+    offsets.npy - границы текстов в tokens.bin
+    keys.txt    - хэши текстов построчно (пишется последним)
+"""
+
+import hashlib
+import os
+import re
+import threading
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+
+ANALYZER_DIR = os.path.join("data", "analyzer")
+
+# Виды токенов scan()
+WORD = "word"
+NUMBER = "number"
+OTHER = "other"
+
+PUNCT_PATTERN = re.compile(r"[^\w\s]")
+# Каждое совпадение начинается в начале последовательности \w и забирает ее целиком:
+# только русские буквы - WORD, есть цифра - NUMBER, иначе (латиница, "_") - OTHER
+SCAN_PATTERN = re.compile(r"(?P<word>[а-яё]+\b)|(?P<number>\w*\d\w*)|(?P<other>\w+)")
+SCAN_PATTERN_IGNORECASE = re.compile(SCAN_PATTERN.pattern, re.IGNORECASE)
+# Группа заполнена только для последовательностей из одних русских букв
+RUSSIAN_WORD_PATTERN = re.compile(r"([а-яё]+)\b|\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Нижний регистр, знаки препинания -> пробелы, разбиение по пробелам.
+    Замена с split() на практике быстрее, чем findall(r"\w+") с тем же результатом"""
+    return PUNCT_PATTERN.sub(" ", text.lower()).split()
+
+
+def russian_words(text: str) -> List[str]:
+    """Слова только из русских букв (то же, что \b[а-яё]+\b) в нижнем регистре"""
+    return [word for word in RUSSIAN_WORD_PATTERN.findall(text.lower()) if word]
+
+
+def scan(text: str) -> Iterator[Tuple[str, int, str]]:
+    """Токены в нижнем регистре с позицией начала в исходном тексте и видом (WORD/NUMBER/OTHER)"""
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        for match in SCAN_PATTERN.finditer(lowered):
+            yield match.group(), match.start(), match.lastgroup
+    else:
+        # Редкие символы меняют длину при lower(): позиции берутся по исходному тексту
+        for match in SCAN_PATTERN_IGNORECASE.finditer(text):
+            yield match.group().lower(), match.start(), match.lastgroup
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8", errors="replace")).hexdigest()
+
+
+class TokenCache:
+    def __init__(self, path: str = ANALYZER_DIR):
+        self.path = path
+        self.lock = threading.Lock()
+        self.terms: List[str] = []
+        self.term_ids: Dict[str, int] = {}
+        self.entries: Dict[str, np.ndarray] = {}
+        self.loaded = False
+        self.dirty = False
+
+    def _ensure_loaded(self) -> None:
+        if self.loaded:
+            return
+        self.loaded = True
+        try:
+            with open(os.path.join(self.path, "keys.txt"), "r", encoding="utf-8") as f:
+                keys = f.read().split()
+            with open(os.path.join(self.path, "vocab.txt"), "r", encoding="utf-8") as f:
+                content = f.read()
+            tokens = np.fromfile(os.path.join(self.path, "tokens.bin"), dtype=np.int32)
+            offsets = np.load(os.path.join(self.path, "offsets.npy"))
+        except (OSError, ValueError):
+            return
+        if len(offsets) != len(keys) + 1 or offsets[-1] != len(tokens):
+            return
+
+        self.terms = content.split("\n") if content else []
+        self.term_ids = {term: term_id for term_id, term in enumerate(self.terms)}
+        self.entries = {key: tokens[offsets[i]:offsets[i + 1]] for i, key in enumerate(keys)}
+
+    def _encode(self, text: str) -> np.ndarray:
+        key = text_key(text)
+        ids = self.entries.get(key)
+        if ids is None:
+            term_ids = self.term_ids
+            tokens = tokenize(text)
+            for term in tokens:
+                if term not in term_ids:
+                    term_ids[term] = len(self.terms)
+                    self.terms.append(term)
+            ids = np.array([term_ids[term] for term in tokens], dtype=np.int32)
+            self.entries[key] = ids
+            self.dirty = True
+        return ids
+
+    def encode(self, text: str) -> np.ndarray:
+        """Номера термов текста (из кэша или с пополнением словаря)"""
+        with self.lock:
+            self._ensure_loaded()
+            return self._encode(text)
+
+    def encode_many(self, texts: List[str]) -> List[np.ndarray]:
+        with self.lock:
+            self._ensure_loaded()
+            return [self._encode(text) for text in texts]
+
+    def tokens(self, texts: List[str]) -> List[List[str]]:
+        """Термы текстов строками, токенизация через кэш"""
+        with self.lock:
+            self._ensure_loaded()
+            terms = self.terms
+            return [[terms[i] for i in self._encode(text).tolist()] for text in texts]
+
+    def save(self) -> None:
+        """Запись кэша на диск, если он пополнялся"""
+        with self.lock:
+            if not self.dirty:
+                return
+            keys = list(self.entries)
+            arrays = [self.entries[key] for key in keys]
+            offsets = np.concatenate([[0], np.cumsum([len(a) for a in arrays])]).astype(np.int64)
+
+            os.makedirs(self.path, exist_ok=True)
+            # keys.txt удаляется первым и пишется последним: без него кэш считается пустым
+            keys_path = os.path.join(self.path, "keys.txt")
+            if os.path.exists(keys_path):
+                os.remove(keys_path)
+            # Термы не содержат пробельных символов, поэтому словарь хранится построчно
+            with open(os.path.join(self.path, "vocab.txt"), "w", encoding="utf-8") as f:
+                f.write("\n".join(self.terms))
+            (np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int32)).astype(np.int32).tofile(
+                os.path.join(self.path, "tokens.bin")
+            )
+            np.save(os.path.join(self.path, "offsets.npy"), offsets)
+            with open(keys_path, "w", encoding="utf-8") as f:
+                f.write("\n".join(keys))
+            self.dirty = False
+
+
+TOKEN_CACHE = TokenCache()
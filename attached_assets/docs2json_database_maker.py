@@ -11,6 +11,9 @@ import os
 import json
 import uuid
 import re
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from IPython.display import display, clear_output
 import ipywidgets as widgets
 from PyPDF2 import PdfReader
@@ -36,10 +39,84 @@ API_KEY = userdata.get('API_KEY')
 KNOWLEDGE_BASE_PATH = "/content/drive/My Drive/txt2json_data/knowledge_base.json"
 CHUNK_SIZE = 12000  # ~3000 токенов (4 символа = 1 токен)
 SUMMARY_CONTEXT_SIZE = 3
+# Саммари документа сводится деревом: группы по SUMMARY_GROUP_SIZE саммари
+# сливаются параллельно (SUMMARY_WORKERS запросов), уровень за уровнем
+SUMMARY_GROUP_SIZE = 8
+SUMMARY_WORKERS = 4
+SUMMARY_CACHE_PATH = "/content/drive/My Drive/txt2json_data/summary_cache.json"
+# Разметка чанков: "json" - ответ в JSON с проверкой по схеме и повторным запросом только
+# неверных полей, "lines" - прежний разбор строк "поле: значение"
+ANNOTATION_MODE = "json"
+JSON_REPAIR_ATTEMPTS = 2
+DOC_TYPES = ("закон", "указ", "постановление", "судебный акт", "статья", "иное")
+DATE_FORMAT = re.compile(r'^(\d{4}-\d{2}-\d{2}|Не указана)$')
+# Описание полей для промпта; проверка - в validate_field
+ANNOTATION_FIELDS = {
+    "doc_name": "полное название документа (строка)",
+    "doc_date": 'дата в формате ГГГГ-ММ-ДД или "Не указана"',
+    "doc_type": "тип: " + ", ".join(DOC_TYPES),
+    "chunk_summary": "три тезиса о содержании (строка)",
+    "qa_pairs": 'список из 3 объектов {"question": "...", "answer": "..."}',
+    "chunk_keywords": "список из 3 ключевых слов и 3 ключевых фраз (строки)",
+}
+DOC_FIELDS = ("doc_name", "doc_date", "doc_type")
+CHUNK_FIELDS = ("chunk_summary", "qa_pairs", "chunk_keywords")
+
+def parse_json_object(response):
+    """JSON-объект из ответа модели: допускаются обрамление ```json и текст вокруг объекта"""
+    start, end = response.find('{'), response.rfind('}')
+    if start < 0 or end < start:
+        raise ValueError("объект не найден")
+    try:
+        data = json.loads(response[start:end + 1])
+    except json.JSONDecodeError as e:
+        raise ValueError(str(e))
+    if not isinstance(data, dict):
+        raise ValueError("ожидался объект")
+    return data
+
+def validate_field(field, value):
+    """Проверка поля разметки по схеме: (нормализованное значение, None) или (None, ошибка)"""
+    if field in ("doc_name", "chunk_summary"):
+        if isinstance(value, list):
+            value = ' '.join(map(str, value))
+        if not isinstance(value, str) or not value.strip():
+            return None, "нужна непустая строка"
+        return ' '.join(value.split()), None
+    if field == "doc_date":
+        if not isinstance(value, str) or not DATE_FORMAT.match(value.strip()):
+            return None, f"неверная дата {value!r}"
+        return value.strip(), None
+    if field == "doc_type":
+        if not isinstance(value, str) or value.strip().lower() not in DOC_TYPES:
+            return None, f"неизвестный тип {value!r}"
+        return value.strip().lower(), None
+    if field == "qa_pairs":
+        if not isinstance(value, list):
+            return None, "нужен список объектов"
+        pairs = [
+            {'question': str(qa['question']).strip(), 'answer': str(qa['answer']).strip()}
+            for qa in value
+            if isinstance(qa, dict) and str(qa.get('question', '')).strip() and str(qa.get('answer', '')).strip()
+        ]
+        if not pairs:
+            return None, "нет пар с непустыми question и answer"
+        return pairs[:3], None
+    if field == "chunk_keywords":
+        if not isinstance(value, list):
+            return None, "нужен список строк"
+        keywords = [str(keyword).strip() for keyword in value if str(keyword).strip()]
+        if not keywords:
+            return None, "список пуст"
+        return keywords[:6], None
+    return None, "неизвестное поле"
 
 class DocumentProcessor:
     def __init__(self):
         self.knowledge_base = self.load_knowledge_base()
+        self.summary_cache = self.load_summary_cache()
+        self.summary_lock = threading.Lock()
+        self.annotation_stats = {'requests': 0, 'repairs': 0, 'failed_fields': 0}
         self.chunk_counter = 1
         self.setup_ui()
         self.file_paths = []
@@ -186,6 +263,7 @@ class DocumentProcessor:
             "doc_qa": []
         }
         prev_summaries = []
+        self.annotation_stats = {'requests': 0, 'repairs': 0, 'failed_fields': 0}
 
         self.progress.max = len(chunks)
         self.progress.value = 0
@@ -194,13 +272,15 @@ class DocumentProcessor:
             try:
                 self.progress.value = i + 1
 
-                if i == 0:
-                    response = self.process_first_chunk(chunk_text)  # Передаём полный текст чанка
+                context = prev_summaries[-SUMMARY_CONTEXT_SIZE:]
+                if ANNOTATION_MODE == "json":
+                    chunk_data = self.annotate_chunk(chunk_text, context, i, i == len(chunks)-1)
                 else:
-                    context = prev_summaries[-SUMMARY_CONTEXT_SIZE:]
-                    response = self.process_chunk(chunk_text, context, i == len(chunks)-1)
-
-                chunk_data = self.parse_llm_response(response, i)
+                    if i == 0:
+                        response = self.process_first_chunk(chunk_text)  # Передаём полный текст чанка
+                    else:
+                        response = self.process_chunk(chunk_text, context, i == len(chunks)-1)
+                    chunk_data = self.parse_llm_response(response, i)
                 chunk_data['chunk_text'] = chunk_text  # Сохраняем исходный текст чанка
                 prev_summaries.append(chunk_data['chunk_summary'])
 
@@ -241,6 +321,10 @@ class DocumentProcessor:
             print(f"Тип: {doc_data['doc_type']}")
             print(f"Дата: {doc_data['doc_date']}")
             print(f"Всего QA пар: {len(doc_data['doc_qa'])}")
+            if ANNOTATION_MODE == "json":
+                stats = self.annotation_stats
+                print(f"Запросов разметки: {stats['requests']}, исправлений: {stats['repairs']}, "
+                      f"неполученных полей: {stats['failed_fields']}")
 
     def load_knowledge_base(self):
         """Загрузка базы знаний из файла"""
@@ -256,6 +340,24 @@ class DocumentProcessor:
         """Сохранение базы знаний в файл"""
         with open(KNOWLEDGE_BASE_PATH, 'w', encoding='utf-8') as f:
             json.dump(self.knowledge_base, f, ensure_ascii=False, indent=2)
+        self.save_summary_cache()
+
+    def load_summary_cache(self):
+        """Загрузка кэша промежуточных саммари"""
+        if os.path.exists(SUMMARY_CACHE_PATH):
+            try:
+                with open(SUMMARY_CACHE_PATH, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except:
+                return {}
+        return {}
+
+    def save_summary_cache(self):
+        """Сохранение кэша промежуточных саммари"""
+        with self.summary_lock:
+            cache = dict(self.summary_cache)
+        with open(SUMMARY_CACHE_PATH, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, ensure_ascii=False)
 
     def process_first_chunk(self, text):
         """Обработка первого чанка"""
@@ -281,13 +383,109 @@ qa_pairs: [3 пары в формате "вопрос:: ответ" (разде
 Текст: {text[:5000]}..."""
         return self.send_llm_request(prompt)
 
+    def annotate_chunk(self, text, context, chunk_index, is_last=False):
+        """Разметка чанка в JSON: ответ проверяется по схеме, неверные или пропущенные
+        поля запрашиваются повторно (до JSON_REPAIR_ATTEMPTS раз), верные не переспрашиваются"""
+        fields = (DOC_FIELDS if chunk_index == 0 else ()) + CHUNK_FIELDS
+        schema = "\n".join(f'  "{field}": {ANNOTATION_FIELDS[field]}' for field in fields)
+        prompt = f"""Проанализируй {"первый" if chunk_index == 0 else "следующий"} фрагмент юридического/публицистического документа.
+{f"Контекст предыдущих фрагментов: {'; '.join(context)}" if context else ""}
+{"Это последний фрагмент документа. " if is_last else ""}Ответь только JSON-объектом без пояснений с полями:
+{schema}
+
+Текст: {text[:5000]}..."""
+        data, errors = self.validate_annotation(self.send_llm_request(prompt), fields)
+
+        for attempt in range(JSON_REPAIR_ATTEMPTS):
+            if not errors:
+                break
+            self.annotation_stats['repairs'] += 1
+            problems = "\n".join(f'  "{field}": {error}; нужно: {ANNOTATION_FIELDS[field]}' for field, error in errors.items())
+            repair_prompt = f"""В разметке фрагмента документа неверны поля:
+{problems}
+Ответь только JSON-объектом с исправленными значениями этих полей, без остальных полей.
+
+Текст: {text[:5000]}..."""
+            repaired, errors = self.validate_annotation(self.send_llm_request(repair_prompt), list(errors))
+            data.update(repaired)
+
+        if errors:
+            self.annotation_stats['failed_fields'] += len(errors)
+            with self.output:
+                print(f"Чанк {chunk_index+1}: не удалось получить поля {', '.join(errors)}")
+        parsed = {
+            'chunk_summary': data.get('chunk_summary', 'Не удалось извлечь'),
+            'chunk_text': '',
+            'qa_pairs': data.get('qa_pairs', []),
+            'chunk_keywords': data.get('chunk_keywords', [])
+        }
+        if chunk_index == 0:
+            parsed.update({
+                'doc_name': data.get('doc_name', 'Неизвестно'),
+                'doc_date': data.get('doc_date', 'Не указана'),
+                'doc_type': data.get('doc_type', 'Неизвестен')
+            })
+        return parsed
+
+    def validate_annotation(self, response, fields):
+        """Верные поля ответа и ошибки остальных: ({поле: значение}, {поле: описание ошибки})"""
+        self.annotation_stats['requests'] += 1
+        try:
+            data = parse_json_object(response)
+        except ValueError as e:
+            return {}, {field: f"ответ не JSON ({str(e)})" for field in fields}
+
+        valid, errors = {}, {}
+        for field in fields:
+            if field not in data:
+                errors[field] = "поле отсутствует"
+                continue
+            value, error = validate_field(field, data[field])
+            if error:
+                errors[field] = error
+            else:
+                valid[field] = value
+        return valid, errors
+
     def generate_doc_summary(self, summaries):
-        """Генерация общего саммари документа"""
+        """Генерация общего саммари документа сведением саммари частей деревом
+
+        Пока саммари больше SUMMARY_GROUP_SIZE, они сливаются группами, группы
+        одного уровня - параллельно. Число последовательных запросов растет как
+        логарифм числа чанков, размер каждого промпта ограничен группой.
+        """
+        level = list(summaries)
+        with ThreadPoolExecutor(max_workers=SUMMARY_WORKERS) as executor:
+            while len(level) > SUMMARY_GROUP_SIZE:
+                groups = [level[i:i + SUMMARY_GROUP_SIZE] for i in range(0, len(level), SUMMARY_GROUP_SIZE)]
+                level = list(executor.map(self.merge_summaries, groups))
+
         prompt = f"""Напиши краткое саммари всего документа на основе анализа его частей:
-{' '.join(summaries)}
+{' '.join(level)}
 
 Саммари должно содержать 5-7 основных положений документа, быть связным текстом."""
-        return self.send_llm_request(prompt).strip()
+        return self.cached_llm_request(prompt).strip()
+
+    def merge_summaries(self, summaries):
+        """Промежуточное слияние группы саммари соседних частей документа"""
+        if len(summaries) == 1:
+            return summaries[0]
+        prompt = f"""Объедини саммари последовательных частей документа в одно саммари этого раздела:
+{' '.join(summaries)}
+
+Сохрани основные положения, номера статей и пунктов, не более 7 тезисов."""
+        return self.cached_llm_request(prompt).strip()
+
+    def cached_llm_request(self, prompt):
+        """Запрос к LLM с кэшем по тексту промпта: повторная обработка не повторяет слияния"""
+        key = hashlib.sha1(f"{LLM}\n{prompt}".encode('utf-8')).hexdigest()
+        with self.summary_lock:
+            if key in self.summary_cache:
+                return self.summary_cache[key]
+        response = self.send_llm_request(prompt)
+        with self.summary_lock:
+            self.summary_cache[key] = response
+        return response
 
     def send_llm_request(self, prompt):
         """Отправка запроса к LLM API"""
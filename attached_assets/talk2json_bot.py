@@ -7,32 +7,110 @@ Original file is located at
     https://colab.research.google.com/drive/1WbbIC3PFKScAw9Qn2oXppwt6_Ok2Cj4Q
 """
 
+import hashlib
 import json
 import os
 import re
-from typing import List, Dict, Any, Tuple
-from rank_bm25 import BM25Okapi
-import ipywidgets as widgets
-from IPython.display import display
+from typing import List, Dict, Any, FrozenSet, Optional, Tuple
 import requests
-from google.colab import drive, userdata
 import numpy as np
 from collections import defaultdict
+import math
 import pickle
 import time
 
+# Виджеты и Google Drive доступны только в Colab; без них модуль
+# можно импортировать из скриптов (бенчмарки, тесты)
+try:
+    import ipywidgets as widgets
+    from IPython.display import display
+    HAS_WIDGETS = True
+except ImportError:
+    HAS_WIDGETS = False
+
+# Общий анализатор с кэшем токенов из корня репозитория (в Colab его может не быть)
+try:
+    from analyzer import TOKEN_CACHE, tokenize
+    HAS_ANALYZER = True
+except ImportError:
+    HAS_ANALYZER = False
+
+# Нормализация вопросов кэша ответов (леммы pymorphy, если он установлен)
+try:
+    from query_cache import normalize_question
+    HAS_QUESTION_NORMALIZER = True
+except ImportError:
+    HAS_QUESTION_NORMALIZER = False
+
+# Хранилище SQLite FTS5 из корня репозитория: поиск без загрузки базы знаний в память
+try:
+    from fts_index import FTSIndex
+    HAS_FTS = True
+except ImportError:
+    HAS_FTS = False
+
+# Ограниченная память диалога из корня репозитория; без нее - прежний список реплик
+try:
+    from conversation_memory import ConversationMemory, Turn
+    HAS_MEMORY = True
+except ImportError:
+    HAS_MEMORY = False
+
+try:
+    from google.colab import drive, userdata
+    IN_COLAB = True
+except ImportError:
+    IN_COLAB = False
+
 # Настройки
 GOOGLE_DRIVE_PATH = "/content/drive/MyDrive/txt2json_data/knowledge_base.json"
 API_URL = "https://api.vsegpt.ru/v1/chat/completions"
-API_KEY = userdata.get('API_KEY')
+API_KEY = userdata.get('API_KEY') if IN_COLAB else os.environ.get('API_KEY', '')
 CONTEXT_SUM = 4000
 MAX_ANSWER_LENGTH = 4000
 MAX_HISTORY_LENGTH = 100
+SUMMARY_PROMPT = (
+    "Сожми историю консультации в несколько коротких пунктов: вопросы пользователя, "
+    "выводы и упомянутые статьи. Не добавляй ничего, чего нет в тексте."
+)
+SUMMARY_MAX_TOKENS = 300
 TEMPERATURE = 0.4
+SYSTEM_PROMPT = "Ты - AI ассистент, анализирующий документы. Ссылайся на номер статей и пунктов."
 BM25_CACHE_PATH = "/content/drive/MyDrive/txt2json_data/bm25_cache.pkl"
+# "memory" - BM25F в памяти (кэш BM25_CACHE_PATH), "fts" - база SQLite FTS5 в FTS_DB_PATH
+SEARCH_BACKEND = os.environ.get('TALK2JSON_BACKEND', 'memory')
+FTS_DB_PATH = "/content/drive/MyDrive/txt2json_data/knowledge_base.sqlite"
+
+# BM25F: вес поля и сила нормировки по его длине (b); поля индексируются раздельно
+BM25F_K1 = 1.5
+BM25F_EPSILON = 0.25
+BM25F_FIELDS = {
+    'chunk_summary': {'boost': 2.0, 'b': 0.5},
+    'chunk_keywords': {'boost': 3.0, 'b': 0.3},
+    'chunk_text': {'boost': 1.0, 'b': 0.75},
+}
+
+# Хранилище чанков: поля документа (значения по умолчанию) хранятся один раз на документ,
+# текстовые поля чанков - колонками; ключевые слова чанка склеиваются через разделитель
+DOC_FIELDS = {'doc_id': None, 'doc_name': 'Без названия', 'doc_type': 'Неизвестен', 'doc_date': 'Не указана'}
+CHUNK_FIELDS = ('chunk_summary', 'chunk_text', 'chunk_keywords')
+KEYWORD_SEPARATOR = '\x1f'
+
+# Быстрые ответы из qa_pairs базы знаний: порог взвешенного по IDF сходства вопросов
+QA_MATCH_THRESHOLD = 0.8
+QA_STEM_LENGTH = 6
+# Отрицания меняют смысл вопроса: остаются термами и должны совпадать у обоих вопросов
+QA_NEGATION_WORDS = frozenset({'не', 'ни', 'без'})
+
+# Фильтры по метаданным: поля с битовыми картами значений и дата документа (ГГГГ-ММ-ДД)
+METADATA_FIELDS = ('doc_id', 'doc_name', 'doc_type')
+DATE_PATTERN = re.compile(r'(\d{4})(?:-(\d{1,2}))?(?:-(\d{1,2}))?')
+# Фильтры в тексте запроса: "тип:закон с:2020 по:2023-06-30 документ:<doc_id>"
+FILTER_PATTERN = re.compile(r'(?<!\w)(тип|документ|с|по):(\S+)', re.IGNORECASE)
 
 # Подключение Google Drive
-drive.mount('/content/drive')
+if IN_COLAB:
+    drive.mount('/content/drive')
 
 # Собственные стоп-слова для русского языка
 RUSSIAN_STOPWORDS = {
@@ -54,53 +132,418 @@ RUSSIAN_STOPWORDS = {
 }
 
 class TextPreprocessor:
-    def __init__(self):
+    def __init__(self, token_cache=None):
+        """token_cache - кэш токенов анализатора (по умолчанию общий TOKEN_CACHE)"""
         self.regex = re.compile(r'[^\w\s]')
+        self.token_cache = token_cache if token_cache is not None else (TOKEN_CACHE if HAS_ANALYZER else None)
 
     def preprocess(self, text: str) -> List[str]:
+        if HAS_ANALYZER:
+            return tokenize(text)
         text = self.regex.sub(' ', text.lower())
         return text.split()  # Простая токенизация без стоп-слов и стемминга
 
+    def preprocess_corpus(self, texts: List[str]) -> List[List[str]]:
+        """Токенизация корпуса; с анализатором - через общий кэш токенов"""
+        if self.token_cache is None:
+            return [self.preprocess(text) for text in texts]
+        tokenized = self.token_cache.tokens(texts)
+        self.token_cache.save()
+        return tokenized
+
+
+def field_text(chunk: Dict, field: str) -> str:
+    """Текст поля чанка; список ключевых слов склеивается через пробел"""
+    value = chunk.get(field, '')
+    if isinstance(value, list):
+        return ' '.join(map(str, value))
+    return str(value)
+
+
+class BM25FIndex:
+    """BM25F по нескольким полям чанка.
+
+    Для каждого поля хранятся свои списки словопозиций и длины. Частоты
+    терма в полях нормируются по длине своего поля, умножаются на вес поля
+    и суммируются, после чего к сумме применяется насыщение k1 и IDF терма
+    по числу чанков, где он встречается хотя бы в одном поле. С одним полем
+    оценки совпадают с BM25Okapi.
+    """
+
+    def __init__(self, fields: Dict[str, List[List[str]]], boosts: Dict[str, float],
+                 field_b: Dict[str, float], k1: float = BM25F_K1):
+        self.k1 = k1
+        self.boosts = boosts
+        self.field_b = field_b
+        self.vocab: Dict[str, int] = {}
+        self.corpus_size = len(next(iter(fields.values()), []))
+        self.postings = {}
+        self.doc_norm = {}
+
+        docs_with_term = defaultdict(set)
+        for field, corpus in fields.items():
+            term_ids, doc_ids, tfs = [], [], []
+            doc_len = np.zeros(self.corpus_size)
+            for doc_id, tokens in enumerate(corpus):
+                doc_len[doc_id] = len(tokens)
+                counts = defaultdict(int)
+                for token in tokens:
+                    counts[token] += 1
+                for term, tf in counts.items():
+                    term_id = self.vocab.setdefault(term, len(self.vocab))
+                    term_ids.append(term_id)
+                    doc_ids.append(doc_id)
+                    tfs.append(tf)
+                    docs_with_term[term_id].add(doc_id)
+
+            # Списки словопозиций поля: номера чанков и частоты, сгруппированные по термам
+            term_ids = np.array(term_ids, dtype=np.int64)
+            order = np.argsort(term_ids, kind='stable')
+            starts = np.searchsorted(term_ids[order], np.arange(len(self.vocab) + 1))
+            self.postings[field] = (
+                np.array(doc_ids, dtype=np.int32)[order],
+                np.array(tfs, dtype=np.float64)[order],
+                starts
+            )
+            avg_len = doc_len.mean() if self.corpus_size and doc_len.mean() > 0 else 1.0
+            b = field_b.get(field, 0.75)
+            self.doc_norm[field] = 1 - b + b * doc_len / avg_len
+
+        df = np.zeros(len(self.vocab))
+        for term_id, docs in docs_with_term.items():
+            df[term_id] = len(docs)
+        # IDF как в BM25Okapi: отрицательные значения заменяются на epsilon * средний IDF
+        self.idf = np.log(self.corpus_size - df + 0.5) - np.log(df + 0.5)
+        if len(self.idf):
+            self.idf[self.idf < 0] = BM25F_EPSILON * self.idf.mean()
+
+    def _field_postings(self, field: str, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        docs, tfs, starts = self.postings[field]
+        # Термы, добавленные после построения поля, в нем не встречаются
+        if term_id + 1 >= len(starts):
+            return docs[:0], tfs[:0]
+        return docs[starts[term_id]:starts[term_id + 1]], tfs[starts[term_id]:starts[term_id + 1]]
+
+    def get_scores(self, query: List[str], candidates: Optional[np.ndarray] = None) -> np.ndarray:
+        """Оценки чанков; с булевой маской candidates словопозиции остальных чанков не учитываются"""
+        scores = np.zeros(self.corpus_size)
+        counts = defaultdict(int)
+        for token in query:
+            counts[token] += 1
+
+        for term, weight in counts.items():
+            term_id = self.vocab.get(term)
+            if term_id is None:
+                continue
+            tf_weighted = np.zeros(self.corpus_size)
+            for field in self.postings:
+                docs, tfs = self._field_postings(field, term_id)
+                if candidates is not None:
+                    keep = candidates[docs]
+                    docs, tfs = docs[keep], tfs[keep]
+                tf_weighted[docs] += self.boosts.get(field, 1.0) * tfs / self.doc_norm[field][docs]
+            scores += weight * self.idf[term_id] * tf_weighted * (self.k1 + 1) / (self.k1 + tf_weighted)
+        return scores
+
+
+def normalize_value(value: Any) -> str:
+    return ' '.join(str(value).lower().split())
+
+
+def date_key(value: str, upper: bool = False) -> Optional[int]:
+    """Дата как число ГГГГММДД; без месяца или дня берется начало (или конец при upper) периода"""
+    match = DATE_PATTERN.search(str(value))
+    if not match:
+        return None
+    year, month, day = match.groups()
+    month = int(month) if month else (12 if upper else 1)
+    day = int(day) if day else (31 if upper else 1)
+    return int(year) * 10000 + month * 100 + day
+
+
+def parse_filters(query: str) -> Tuple[str, Dict[str, Any]]:
+    """Выделение фильтров из текста запроса: (запрос без фильтров, фильтры для search)"""
+    filters: Dict[str, Any] = {}
+    date_from = date_to = None
+    for name, value in FILTER_PATTERN.findall(query):
+        name = name.lower()
+        if name == 'тип':
+            filters.setdefault('doc_type', []).append(value)
+        elif name == 'документ':
+            filters.setdefault('doc_id', []).append(value)
+        elif name == 'с':
+            date_from = value
+        else:
+            date_to = value
+    if date_from or date_to:
+        filters['doc_date'] = (date_from, date_to)
+    return ' '.join(FILTER_PATTERN.sub(' ', query).split()), filters
+
+
+class MetadataIndex:
+    """Битовые индексы метаданных чанков для отбора кандидатов до BM25.
+
+    Для каждого значения полей METADATA_FIELDS хранится битовая карта чанков
+    (np.packbits). Даты документов хранятся ключами ГГГГММДД, отсортированными
+    вместе с номерами чанков, поэтому диапазон дат превращается в карту двумя
+    бинарными поисками. Значения одного поля объединяются через OR, разные
+    поля - через AND. Чанки без даты в фильтр по дате не попадают.
+    """
+
+    def __init__(self, store: 'ChunkStore'):
+        self.size = len(store)
+        self.bitmaps: Dict[str, Dict[str, np.ndarray]] = {}
+        # Значения полей берутся из таблицы документов; чанки документа - диапазон в by_doc
+        by_doc = np.argsort(store.chunk_doc, kind='stable')
+        starts = np.searchsorted(store.chunk_doc[by_doc], np.arange(len(store.docs['doc_id']) + 1))
+        for field in METADATA_FIELDS:
+            rows = defaultdict(list)
+            for doc, value in enumerate(store.docs[field]):
+                rows[normalize_value(value)].append(by_doc[starts[doc]:starts[doc + 1]])
+            self.bitmaps[field] = {value: self._bitmap(np.concatenate(ids)) for value, ids in rows.items()}
+
+        doc_keys = np.array([date_key(value) or 0 for value in store.docs['doc_date']], dtype=np.int64)
+        keys = doc_keys[store.chunk_doc] if len(doc_keys) else np.zeros(self.size, dtype=np.int64)
+        known = np.flatnonzero(keys)
+        self.date_order = known[np.argsort(keys[known], kind='stable')]
+        self.date_keys = keys[self.date_order]
+
+    def _bitmap(self, ids) -> np.ndarray:
+        mask = np.zeros(self.size, dtype=bool)
+        mask[ids] = True
+        return np.packbits(mask)
+
+    def values(self, field: str) -> List[str]:
+        """Известные значения поля (например, типы документов для подсказки)"""
+        return sorted(self.bitmaps.get(field, {}))
+
+    def _date_bitmap(self, date_from: Optional[str], date_to: Optional[str]) -> np.ndarray:
+        start, end = 0, len(self.date_keys)
+        for value, upper in ((date_from, False), (date_to, True)):
+            if not value:
+                continue
+            key = date_key(value, upper)
+            if key is None:
+                raise ValueError(f"Неверная дата в фильтре: {value}")
+            if upper:
+                end = np.searchsorted(self.date_keys, key, side='right')
+            else:
+                start = np.searchsorted(self.date_keys, key, side='left')
+        return self._bitmap(self.date_order[start:end])
+
+    def select(self, filters: Dict[str, Any]) -> Optional[np.ndarray]:
+        """Булева маска чанков, подходящих под все фильтры; None, если фильтров нет.
+
+        filters: {'doc_type': 'закон' или список значений, 'doc_id': ..., 'doc_name': ...,
+                  'doc_date': (с, по) - границы 'ГГГГ' или 'ГГГГ-ММ-ДД', любая может быть None}
+        """
+        bitmap = None
+        for field, value in filters.items():
+            if not value:
+                continue
+            if field == 'doc_date':
+                current = self._date_bitmap(*value)
+            elif field in self.bitmaps:
+                current = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+                for item in ([value] if isinstance(value, str) else value):
+                    current |= self.bitmaps[field].get(normalize_value(item), 0)
+            else:
+                raise ValueError(f"Неизвестное поле фильтра: {field}")
+            bitmap = current if bitmap is None else bitmap & current
+
+        if bitmap is None:
+            return None
+        return np.unpackbits(bitmap, count=self.size).astype(bool)
+
+
+def question_terms(question: str) -> FrozenSet[str]:
+    """Нормализованные термы вопроса: как в кэше ответов (query_cache), без него -
+    слова без стоп-слов (кроме отрицаний), усеченные до QA_STEM_LENGTH символов"""
+    if HAS_QUESTION_NORMALIZER:
+        return normalize_question(question)
+    words = re.findall(r'\w+', question.lower().replace('ё', 'е'))
+    return frozenset(
+        word[:QA_STEM_LENGTH] for word in words
+        if word not in RUSSIAN_STOPWORDS or word in QA_NEGATION_WORDS
+    )
+
+
+class QAIndex:
+    """Индекс сохраненных пар вопрос-ответ (qa_pairs чанков и doc_qa документов).
+
+    Вопросы хранятся множествами нормализованных термов со списками вопросов
+    по терму. Сходство - доля веса общих термов в весе объединения (Жаккар
+    с весами IDF), поэтому совпадение редких слов важнее служебных. Термы
+    запроса, которых нет ни в одном вопросе, получают максимальный вес.
+    Вопросы с разными отрицаниями ("можно ли" и "можно ли не") не совпадают
+    при любом сходстве остальных термов.
+    """
+
+    def __init__(self, knowledge_base: List[Dict]):
+        self.entries: List[Dict] = []
+        self.terms: List[FrozenSet[str]] = []
+        self.postings: Dict[str, List[int]] = defaultdict(list)
+        seen = set()
+        for doc_idx, doc in enumerate(knowledge_base):
+            doc_name = doc.get('doc_name', 'Без названия')
+            for chunk in doc.get('chunks', []):
+                for qa in chunk.get('qa_pairs', []):
+                    self._add(qa, doc_name, chunk.get('chunk_id'), seen)
+            # doc_qa повторяет qa_pairs чанков; новые пары остаются без ссылки на чанк
+            for qa in doc.get('doc_qa', []):
+                self._add(qa, doc_name, None, seen)
+
+        total = len(self.entries)
+        self.idf = {term: math.log(1 + total / len(ids)) for term, ids in self.postings.items()}
+        self.unknown_idf = math.log(1 + total) if total else 1.0
+
+    def _add(self, qa: Dict, doc_name: str, chunk_id: Optional[str], seen: set) -> None:
+        question, answer = str(qa.get('question', '')).strip(), str(qa.get('answer', '')).strip()
+        terms = question_terms(question)
+        if not terms or not answer or (question, answer) in seen:
+            return
+        seen.add((question, answer))
+        for term in terms:
+            self.postings[term].append(len(self.entries))
+        self.entries.append({'question': question, 'answer': answer, 'doc_name': doc_name, 'chunk_id': chunk_id})
+        self.terms.append(terms)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _weight(self, terms: FrozenSet[str]) -> float:
+        return sum(self.idf.get(term, self.unknown_idf) for term in terms)
+
+    def match(self, question: str, threshold: float = QA_MATCH_THRESHOLD) -> Optional[Dict]:
+        """Сохраненная пара с самым похожим вопросом, если сходство не ниже threshold"""
+        terms = question_terms(question)
+        negations = terms & QA_NEGATION_WORDS
+        candidates = {i for term in terms for i in self.postings.get(term, ())}
+        best, best_score = None, threshold
+        for i in candidates:
+            if self.terms[i] & QA_NEGATION_WORDS != negations:
+                continue
+            score = self._weight(terms & self.terms[i]) / self._weight(terms | self.terms[i])
+            if score >= best_score:
+                best, best_score = i, score
+        if best is None:
+            return None
+        return {**self.entries[best], 'score': round(best_score, 3)}
+
+
+class SearchResult:
+    """Найденный фрагмент. Читается и как словарь (result['chunk_text'],
+    result.get(...), {**result}), но без словаря на каждый экземпляр"""
+
+    __slots__ = tuple(DOC_FIELDS) + CHUNK_FIELDS + ('score',)
+
+    def __init__(self, doc_id: str, doc_name: str, doc_type: str, doc_date: str,
+                 chunk_summary: str, chunk_text: str, chunk_keywords: List[str], score: float):
+        self.doc_id = doc_id
+        self.doc_name = doc_name
+        self.doc_type = doc_type
+        self.doc_date = doc_date
+        self.chunk_summary = chunk_summary
+        self.chunk_text = chunk_text
+        self.chunk_keywords = chunk_keywords
+        self.score = score
+
+    def keys(self) -> Tuple[str, ...]:
+        return self.__slots__
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+    def __repr__(self) -> str:
+        return f"SearchResult(doc_name={self.doc_name!r}, score={self.score:.3f})"
+
+
+class ChunkStore:
+    """Колоночное хранилище метаданных чанков.
+
+    Поля документа (doc_id, doc_name, doc_type, doc_date) хранятся один раз на
+    документ в таблице docs, чанк ссылается на документ номером в массиве
+    chunk_doc. Текстовые поля чанков - колонки-списки со ссылками на строки
+    базы знаний (без копирования текста), ключевые слова чанка склеены в одну
+    строку. Словари и списки ключевых слов собираются только для результатов.
+    """
+
+    def __init__(self, knowledge_base: List[Dict]):
+        self.docs: Dict[str, List[str]] = {field: [] for field in DOC_FIELDS}
+        self.columns: Dict[str, List[str]] = {field: [] for field in CHUNK_FIELDS}
+        chunk_doc = []
+        for doc_idx, doc in enumerate(knowledge_base):
+            for field, default in DOC_FIELDS.items():
+                self.docs[field].append(str(doc.get(field, default or f"doc_{doc_idx}")))
+            for chunk in doc.get('chunks', []):
+                chunk_doc.append(doc_idx)
+                self.columns['chunk_summary'].append(str(chunk.get('chunk_summary', '')))
+                self.columns['chunk_text'].append(str(chunk.get('chunk_text', '')))
+                self.columns['chunk_keywords'].append(
+                    KEYWORD_SEPARATOR.join(map(str, chunk.get('chunk_keywords', [])))
+                )
+        self.chunk_doc = np.array(chunk_doc, dtype=np.int32)
+        self.doc_rows = list(zip(*self.docs.values()))
+
+    def __len__(self) -> int:
+        return len(self.chunk_doc)
+
+    def field(self, field: str, idx: int) -> str:
+        """Текст поля чанка (ключевые слова - через пробел, как в field_text)"""
+        if field in self.docs:
+            return self.docs[field][self.chunk_doc[idx]]
+        value = self.columns[field][idx]
+        return value.replace(KEYWORD_SEPARATOR, ' ') if field == 'chunk_keywords' else value
+
+    def result(self, idx: int, score: float) -> SearchResult:
+        """Поля чанка idx для выдачи"""
+        keywords = self.columns['chunk_keywords'][idx]
+        return SearchResult(
+            *self.doc_rows[self.chunk_doc[idx]],
+            self.columns['chunk_summary'][idx],
+            self.columns['chunk_text'][idx],
+            keywords.split(KEYWORD_SEPARATOR) if keywords else [],
+            score
+        )
+
 
 class BM25SearchEngine:
     def __init__(self, preprocessor: TextPreprocessor):
         self.preprocessor = preprocessor
         self.bm25 = None
-        self.chunks_info = []
+        self.store = None
         self.doc_index = defaultdict(list)
+        self.metadata = None
+        self.qa = QAIndex([])
         self.is_index_loaded = False
 
+    def __len__(self) -> int:
+        return len(self.store) if self.store is not None else 0
+
     def build_index(self, knowledge_base: List[Dict]) -> None:
         """Построение поискового индекса"""
         print("Начало построения индекса...")
-        corpus = []
-        self.chunks_info = []
-
-        for doc_idx, doc in enumerate(knowledge_base):
-            for chunk in doc.get('chunks', []):
-                # Подготовка текста для индексации
-                text_parts = [
-                    str(chunk.get('chunk_summary', '')),
-                    ' '.join(map(str, chunk.get('chunk_keywords', []))),
-                    str(chunk.get('chunk_text', ''))
-                ]
-                text_for_index = ' '.join(text_parts)
-
-                # Сохраняем метаданные
-                self.chunks_info.append({
-                    'doc_id': doc.get('doc_id', f"doc_{doc_idx}"),
-                    'doc_name': doc.get('doc_name', 'Без названия'),
-                    'chunk_summary': chunk.get('chunk_summary', ''),
-                    'chunk_text': chunk.get('chunk_text', ''),
-                    'chunk_keywords': chunk.get('chunk_keywords', [])
-                })
-
-                corpus.append(text_for_index)
-
-        # Токенизация и создание индекса
-        print(f"Обработка {len(corpus)} документов...")
-        tokenized_corpus = [self.preprocessor.preprocess(doc) for doc in corpus]
-        self.bm25 = BM25Okapi(tokenized_corpus)
+        self.store = ChunkStore(knowledge_base)
+        chunks = [chunk for doc in knowledge_base for chunk in doc.get('chunks', [])]
+
+        # Токенизация полей и создание индекса
+        print(f"Обработка {len(self.store)} документов...")
+        fields = {
+            field: self.preprocessor.preprocess_corpus([field_text(chunk, field) for chunk in chunks])
+            for field in BM25F_FIELDS
+        }
+        self.bm25 = BM25FIndex(
+            fields,
+            {field: params['boost'] for field, params in BM25F_FIELDS.items()},
+            {field: params['b'] for field, params in BM25F_FIELDS.items()}
+        )
+        self.metadata = MetadataIndex(self.store)
+        self.qa = QAIndex(knowledge_base)
         self.is_index_loaded = True
         print("Построение индекса завершено")
 
@@ -113,11 +556,11 @@ class BM25SearchEngine:
 
             with open(cache_path, 'rb') as f:
                 data = pickle.load(f)
-                if len(data) != 3:
+                if len(data) != 5 or not isinstance(data[1], ChunkStore):
                     print("Неверный формат кэша")
                     return False
 
-                self.bm25, self.chunks_info, self.doc_index = data
+                self.bm25, self.store, self.doc_index, self.metadata, self.qa = data
                 self.is_index_loaded = True
                 print("Индекс успешно загружен из кэша")
                 return True
@@ -131,13 +574,15 @@ class BM25SearchEngine:
         try:
             os.makedirs(os.path.dirname(cache_path), exist_ok=True)
             with open(cache_path, 'wb') as f:
-                pickle.dump((self.bm25, self.chunks_info, self.doc_index), f)
+                pickle.dump((self.bm25, self.store, self.doc_index, self.metadata, self.qa), f)
             print(f"Индекс сохранен в кэш: {cache_path}")
         except Exception as e:
             print(f"Ошибка сохранения кэша: {str(e)}")
 
-    def search(self, query: str, top_n: int = 5, score_threshold: float = 0.1) -> List[Dict]:
-        """Поиск релевантных фрагментов"""
+    def search(self, query: str, top_n: int = 5, score_threshold: float = 0.1,
+               filters: Optional[Dict[str, Any]] = None) -> List[SearchResult]:
+        """Поиск релевантных фрагментов; filters (см. MetadataIndex.select) отбирают
+        чанки по метаданным до расчета BM25"""
         if not self.is_index_loaded:
             raise ValueError("Индекс не загружен")
 
@@ -145,20 +590,120 @@ class BM25SearchEngine:
         if not tokens:
             return []
 
-        scores = self.bm25.get_scores(tokens)
+        candidates = self.metadata.select(filters) if filters else None
+        if candidates is not None and not candidates.any():
+            return []
+
+        scores = self.bm25.get_scores(tokens, candidates)
         if len(scores) == 0:
             return []
 
-        # Получаем топ-N результатов
-        best_indices = np.argsort(scores)[-top_n:][::-1]
+        # Получаем топ-N результатов (только среди кандидатов фильтра)
+        pool = np.flatnonzero(candidates) if candidates is not None else np.arange(len(scores))
+        best_indices = pool[np.argsort(scores[pool])[-top_n:][::-1]]
 
-        # Фильтрация и форматирование результатов
-        results = []
-        for idx in best_indices:
-            if scores[idx] > score_threshold:
-                result = {**self.chunks_info[idx], 'score': float(scores[idx])}
-                results.append(result)
+        # Поля собираются только для прошедших порог результатов
+        return [
+            self.store.result(idx, float(scores[idx])) for idx in best_indices if scores[idx] > score_threshold
+        ]
+
+class FTSSearchEngine:
+    """Поиск по базе знаний в SQLite FTS5 (fts_index.py) с тем же интерфейсом, что у
+    BM25SearchEngine. Поля чанка индексируются как колонки FTS5 с весами BM25F_FIELDS,
+    фильтры по метаданным выполняются условием SQL. База знаний не держится в памяти,
+    build_index переиндексирует только новые и изменившиеся документы."""
+
+    def __init__(self, preprocessor: TextPreprocessor, path: str = FTS_DB_PATH):
+        self.preprocessor = preprocessor
+        self.index = FTSIndex(
+            path, tuple(BM25F_FIELDS), {field: params['boost'] for field, params in BM25F_FIELDS.items()}
+        )
+        # Пары вопрос-ответ собираются из базы знаний при build_index
+        self.qa = QAIndex([])
+        self.is_index_loaded = len(self.index) > 0
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def build_index(self, knowledge_base: List[Dict]) -> None:
+        """Синхронизация базы FTS с базой знаний по отпечаткам документов"""
+        print("Синхронизация индекса FTS...")
+        stored = self.index.source_fingerprints()
+        current = set()
+        updated = 0
+        for doc_idx, doc in enumerate(knowledge_base):
+            doc_id = str(doc.get('doc_id', f"doc_{doc_idx}"))
+            current.add(doc_id)
+            fingerprint = hashlib.sha1(json.dumps(doc, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+            if stored.get(doc_id) == fingerprint:
+                continue
+
+            meta = {field: str(doc.get(field, default or doc_id)) for field, default in DOC_FIELDS.items()}
+            meta.update({f"{field}_key": normalize_value(meta[field]) for field in METADATA_FIELDS})
+            meta['doc_date_key'] = date_key(meta['doc_date'])
+            rows = []
+            for chunk in doc.get('chunks', []):
+                row = dict(meta)
+                row.update({field: field_text(chunk, field) for field in BM25F_FIELDS})
+                row['chunk_keywords'] = KEYWORD_SEPARATOR.join(map(str, chunk.get('chunk_keywords', [])))
+                rows.append(row)
+            self.index.replace_source(doc_id, fingerprint, rows)
+            updated += 1
+
+        for doc_id in stored.keys() - current:
+            self.index.remove_source(doc_id)
+        self.qa = QAIndex(knowledge_base)
+        self.is_index_loaded = len(self.index) > 0
+        print(f"Обновлено документов: {updated}, удалено: {len(stored.keys() - current)}")
+
+    def load_from_cache(self, cache_path: str) -> bool:
+        """База FTS уже на диске: загружать нечего, cache_path не используется"""
+        return self.is_index_loaded
+
+    def save_to_cache(self, cache_path: str) -> None:
+        """Изменения сохраняются в базе при build_index"""
+
+    def _filter_clause(self, filters: Dict[str, Any]) -> Optional[Tuple[str, List]]:
+        """Фильтры search (см. MetadataIndex.select) как условие на таблицу chunks"""
+        keys: Dict[str, Any] = {}
+        for field, value in filters.items():
+            if not value:
+                continue
+            if field == 'doc_date':
+                bounds = []
+                for bound, upper in zip(value, (False, True)):
+                    key = date_key(bound, upper) if bound else None
+                    if bound and key is None:
+                        raise ValueError(f"Неверная дата в фильтре: {bound}")
+                    bounds.append(key)
+                keys['doc_date_key'] = tuple(bounds)
+            elif field in METADATA_FIELDS:
+                keys[f"{field}_key"] = [normalize_value(item) for item in ([value] if isinstance(value, str) else value)]
+            else:
+                raise ValueError(f"Неизвестное поле фильтра: {field}")
+        return self.index.filter_clause(keys)
+
+    def search(self, query: str, top_n: int = 5, score_threshold: float = 0.1,
+               filters: Optional[Dict[str, Any]] = None) -> List[SearchResult]:
+        if not self.is_index_loaded:
+            raise ValueError("Индекс не загружен")
 
+        tokens = self.preprocessor.preprocess(query)
+        if not tokens:
+            return []
+
+        clause = self._filter_clause(filters) if filters else None
+        hits = [(rowid, score) for rowid, score in self.index.search(tokens, top_n, filters=clause)
+                if score > score_threshold]
+        results = []
+        for row, (_, score) in zip(self.index.rows(rowid for rowid, _ in hits), hits):
+            keywords = row['chunk_keywords']
+            results.append(SearchResult(
+                row['doc_id'], row['doc_name'], row['doc_type'], row['doc_date'],
+                row['chunk_summary'], row['chunk_text'],
+                keywords.split(KEYWORD_SEPARATOR) if keywords else [],
+                score
+            ))
         return results
 
 def load_knowledge_base(file_path: str) -> List[Dict]:
@@ -171,18 +716,25 @@ def build_llm_context(query: str, chunks: List[Dict], history: str = "") -> str:
         f"Запрос пользователя: {query}",
         "Релевантные фрагменты из документов:"
     ]
+    history_part = f"\n\nИстория диалога:\n{history}" if history else ""
 
+    # История уже ограничена памятью диалога: место под нее резервируется,
+    # а в бюджет CONTEXT_SUM укладываются фрагменты
+    budget = CONTEXT_SUM - len(history_part) - len('\n'.join(context_parts))
     for chunk in sorted(chunks, key=lambda x: x.get('score', 0), reverse=True)[:5]:
-        context_parts.extend([
+        fragment = '\n'.join([
             f"\nДокумент: {chunk.get('doc_name', 'Без названия')}",
             f"Ключевые слова: {', '.join(chunk.get('chunk_keywords', []))}",
             f"Содержание: {chunk.get('chunk_text', '')[:1000]}"
         ])
+        if len(fragment) + 1 > budget:
+            if budget > 1:
+                context_parts.append(fragment[:budget - 1])
+            break
+        context_parts.append(fragment)
+        budget -= len(fragment) + 1
 
-    if history:
-        context_parts.append(f"\nИстория диалога:\n{history}")
-
-    return '\n'.join(context_parts)[:CONTEXT_SUM]
+    return ('\n'.join(context_parts) + history_part)[:CONTEXT_SUM]
 
 class LLMClient:
     def __init__(self, api_url: str, api_key: str):
@@ -218,14 +770,22 @@ class LLMClient:
 class ChatInterface:
     def __init__(self):
         self.preprocessor = TextPreprocessor()
-        self.search_engine = BM25SearchEngine(self.preprocessor)
+        if SEARCH_BACKEND == 'fts' and HAS_FTS:
+            self.search_engine = FTSSearchEngine(self.preprocessor)
+        else:
+            self.search_engine = BM25SearchEngine(self.preprocessor)
         self.llm_client = LLMClient(API_URL, API_KEY)
         self.history = []
+        self.memory = ConversationMemory(summarize=self.summarize_history) if HAS_MEMORY else None
 
     def initialize(self):
         print("⏳ Инициализация системы...")
         start_time = time.time()
 
+        # База FTS обновляется инкрементально: изменившиеся документы переиндексируются
+        if isinstance(self.search_engine, FTSSearchEngine) and os.path.exists(GOOGLE_DRIVE_PATH):
+            self.search_engine.build_index(load_knowledge_base(GOOGLE_DRIVE_PATH))
+
         # Пытаемся загрузить из кэша
         if not self.search_engine.load_from_cache(BM25_CACHE_PATH):
             print("Создание нового индекса...")
@@ -240,11 +800,27 @@ class ChatInterface:
                 raise RuntimeError(f"Ошибка построения индекса: {str(e)}")
 
         print(f"✅ Инициализация завершена за {time.time()-start_time:.2f} сек")
-        print(f"Загружено фрагментов: {len(self.search_engine.chunks_info)}")
+        print(f"Загружено фрагментов: {len(self.search_engine)}")
 
     def process_query(self, query: str) -> str:
+        query, filters = parse_filters(query)
+        if not query:
+            return "❌ Введите текст запроса помимо фильтров"
+
+        # Частые вопросы: сохраненный ответ из qa_pairs без запроса к LLM
+        # (с фильтрами - обычный путь, пары не проверяются на соответствие фильтрам)
+        stored = self.search_engine.qa.match(query) if not filters else None
+        if stored is not None:
+            print(f"⚡ Ответ из базы вопросов (сходство {stored['score']})")
+            answer = f"{stored['answer']}\n\n📄 {stored['doc_name']}: «{stored['question']}»"
+            self.add_to_history(query, answer)
+            return answer
+
         print("🔍 Поиск релевантной информации...")
-        chunks = self.search_engine.search(query)
+        try:
+            chunks = self.search_engine.search(query, filters=filters)
+        except ValueError as e:
+            return f"❌ {str(e)}"
 
         if not chunks:
             return "❌ По запросу ничего не найдено"
@@ -253,7 +829,7 @@ class ChatInterface:
         print("🤖 Генерация ответа...")
 
         messages = [
-            {"role": "system", "content": "Ты - AI ассистент, анализирующий документы. Ссылайся на номер статей и пунктов."},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": context}
         ]
 
@@ -261,12 +837,27 @@ class ChatInterface:
         self.add_to_history(query, answer)
         return answer
 
+    def summarize_history(self, summary: str, turns: List["Turn"]) -> str:
+        """Инкрементальное сжатие: прежнее резюме и вытесненные реплики -> новое резюме"""
+        dialog = "\n".join(f"В: {q}\nО: {a}" for q, a in turns)
+        content = f"Текущее резюме:\n{summary}\n\nНовые реплики:\n{dialog}" if summary else dialog
+        messages = [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": content}
+        ]
+        return self.llm_client.query(messages, TEMPERATURE, SUMMARY_MAX_TOKENS)
+
     def add_to_history(self, query: str, answer: str) -> None:
+        if self.memory is not None:
+            self.memory.add(query, answer)
+            return
         self.history.append((query, answer))
         if len(self.history) > MAX_HISTORY_LENGTH:
             self.history.pop(0)
 
     def get_history(self) -> str:
+        if self.memory is not None:
+            return self.memory.render()
         return "\n".join(f"В: {q}\nО: {a}" for q, a in self.history)
 
 def main_interface():
@@ -276,7 +867,7 @@ def main_interface():
 
         query_input = widgets.Textarea(
             value='',
-            placeholder='Введите запрос...',
+            placeholder='Введите запрос... Фильтры: тип:закон с:2020 по:2023-06-30 документ:<doc_id>',
             description='Запрос:',
             layout={'width': '80%', 'height': '100px'}
         )
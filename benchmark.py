@@ -0,0 +1,417 @@
+"""Бенчмарк поискового конвейера на корпусе из папки documents.
+
+Замеряет время построения индекса, пиковую память, размер индекса на диске
+и задержки запросов (p50/p95/p99) для функций main.py и для
+talk2json_bot.BM25SearchEngine. Результаты выводятся в JSON, который можно
+сравнить с сохраненным эталоном (--baseline) для поиска регрессий.
+Отдельно замеряется пропускная способность токенизаторов analyzer.py (MB/s)
+и поиск по шардированному индексу (sharded_index.py) в сравнении с единым.
+
+Пример:
+    python benchmark.py --scales 1,10 --output data/bench.json
+    python benchmark.py --baseline data/bench.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "attached_assets"))
+
+import main as app
+from analyzer import TokenCache, russian_words, scan, tokenize
+from inverted_index import InvertedIndex
+from postings_codec import index_size
+from sharded_index import ShardedIndex, build_shards
+from talk2json_bot import BM25SearchEngine, TextPreprocessor
+
+# Конфигурация бенчмарка
+DEFAULT_SCALES = "1,10"
+QUERY_REPEAT = 5
+REGRESSION_TOLERANCE = 0.2
+TOKENIZER_FILE = os.path.join(app.DOCUMENTS_DIR, "ГК часть 1.txt")
+TOKENIZER_REPEAT = 5
+DEFAULT_SHARDS = max(2, os.cpu_count() or 1)
+BENCHMARK_QUERIES = [
+    "Какова плата за подключение к системе теплоснабжения?",
+    "Кто является единой теплоснабжающей организацией?",
+    "Порядок заключения концессионного соглашения",
+    "Ответственность исполнителя за предоставление коммунальных услуг ненадлежащего качества",
+    "Как рассчитывается норматив потребления коммунальной услуги?",
+    "Требования к схеме теплоснабжения поселения",
+    "Коммерческий учет тепловой энергии и теплоносителя",
+    "Охранная зона тепловых сетей",
+    "Признаки ограничения конкуренции органами власти",
+    "Срок исковой давности",
+    "Технологическое присоединение к тепловым сетям",
+    "Перерасчет платы за отопление при временном отсутствии потребителя",
+    "Государственное регулирование цен в сфере теплоснабжения",
+    "Техническая эксплуатация тепловых энергоустановок",
+    "Предельный уровень цены на тепловую энергию в ценовых зонах",
+    "Договор теплоснабжения и его существенные условия",
+]
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """Перцентили задержек в миллисекундах"""
+    values = np.array(samples) * 1000
+    return {
+        "p50": round(float(np.percentile(values, 50)), 3),
+        "p95": round(float(np.percentile(values, 95)), 3),
+        "p99": round(float(np.percentile(values, 99)), 3),
+        "mean": round(float(values.mean()), 3),
+        "count": len(samples),
+    }
+
+
+def timed(fn: Callable, *args) -> Tuple[object, float]:
+    """Вызов функции с замером времени"""
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def peak_memory_mb(fn: Callable, *args) -> float:
+    """Пиковое потребление памяти Python-аллокаций при вызове функции"""
+    tracemalloc.start()
+    try:
+        fn(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return round(peak / 1024 / 1024, 2)
+
+
+def make_scaled_corpus(docs_dir: str, scale: int, tmp_dir: str) -> str:
+    """Синтетическое увеличение корпуса: каждый .txt файл повторяется scale раз"""
+    if scale == 1:
+        return docs_dir
+
+    scaled_dir = os.path.join(tmp_dir, f"corpus_x{scale}")
+    os.makedirs(scaled_dir, exist_ok=True)
+    for filename in os.listdir(docs_dir):
+        if not filename.endswith(".txt"):
+            continue
+        source = os.path.abspath(os.path.join(docs_dir, filename))
+        for copy_idx in range(scale):
+            os.symlink(source, os.path.join(scaled_dir, f"{copy_idx:03d}_{filename}"))
+    return scaled_dir
+
+
+def load_knowledge_base(docs_dir: str) -> List[Dict]:
+    """База знаний в формате docs2json (без LLM-аннотаций) из текстовых файлов"""
+    knowledge_base = []
+    for doc_idx, filename in enumerate(sorted(os.listdir(docs_dir))):
+        if not filename.endswith(".txt"):
+            continue
+        file_path = os.path.join(docs_dir, filename)
+        encoding = app.detect_file_encoding(file_path)
+        with open(file_path, "r", encoding=encoding, errors="replace") as f:
+            text = f.read()
+        knowledge_base.append({
+            "doc_id": f"doc_{doc_idx}",
+            "doc_name": os.path.splitext(filename)[0],
+            "chunks": [
+                {"chunk_summary": "", "chunk_keywords": [], "chunk_text": chunk}
+                for chunk in app.process_text(text)
+            ],
+        })
+    return knowledge_base
+
+
+def empty_token_cache(tmp_dir: str) -> TokenCache:
+    """Пустой кэш токенов в отдельной временной папке: время сборки включает токенизацию,
+    а не попадания в кэш прошлых повторов, и кэш приложения (data/analyzer) не меняется"""
+    return TokenCache(tempfile.mkdtemp(dir=tmp_dir))
+
+
+def bench_main_pipeline(docs_dir: str, queries: List[str], repeat: int,
+                        track_memory: bool, tmp_dir: str) -> Dict:
+    """Бенчмарк функций main.py: create_bm25_index, extract_keywords, search_relevant_chunks.
+    Запросы выполняются по индексу, загруженному из сжатого формата, как после рестарта.
+    Схлопывание дубликатов отключено: иначе копии увеличенного корпуса схлопнутся до x1"""
+    (bm25, chunks), build_time = timed(app.create_bm25_index, docs_dir, None, None, empty_token_cache(tmp_dir))
+    if bm25 is None:
+        raise RuntimeError(f"Не удалось построить индекс по папке {docs_dir}")
+
+    index_dir = os.path.join(tmp_dir, "main_index")
+    bm25.save(index_dir)
+    bm25, load_time = timed(InvertedIndex.load, index_dir)
+
+    result = {
+        "pipeline": "main",
+        "chunks": len(chunks),
+        "build_s": round(build_time, 3),
+        "load_s": round(load_time, 4),
+        "index_bytes": index_size(index_dir),
+    }
+    if track_memory:
+        result["peak_mem_mb"] = peak_memory_mb(
+            app.create_bm25_index, docs_dir, None, None, empty_token_cache(tmp_dir)
+        )
+
+    samples = {"extract_keywords": [], "search_relevant_chunks": [], "query_total": []}
+    for query in queries:
+        # Прогрев, чтобы не учитывать первичные аллокации
+        app.search_relevant_chunks(bm25, chunks, app.extract_keywords(query, bm25), None, query)
+        for _ in range(repeat):
+            keywords, kw_time = timed(app.extract_keywords, query, bm25)
+            _, search_time = timed(app.search_relevant_chunks, bm25, chunks, keywords, None, query)
+            samples["extract_keywords"].append(kw_time)
+            samples["search_relevant_chunks"].append(search_time)
+            samples["query_total"].append(kw_time + search_time)
+
+    result["latency_ms"] = {stage: percentiles(values) for stage, values in samples.items()}
+    shutil.rmtree(index_dir)
+    return result
+
+
+def bench_kb_engine(docs_dir: str, queries: List[str], repeat: int,
+                    track_memory: bool, tmp_dir: str) -> Dict:
+    """Бенчмарк talk2json_bot.BM25SearchEngine: build_index и search"""
+    knowledge_base = load_knowledge_base(docs_dir)
+    engine = BM25SearchEngine(TextPreprocessor(empty_token_cache(tmp_dir)))
+
+    # build_index печатает прогресс, в отчете бенчмарка он не нужен
+    with contextlib.redirect_stdout(io.StringIO()):
+        _, build_time = timed(engine.build_index, knowledge_base)
+        cache_path = os.path.join(tmp_dir, "bm25_cache.pkl")
+        engine.save_to_cache(cache_path)
+        index_bytes = os.path.getsize(cache_path)
+        os.remove(cache_path)
+
+        result = {
+            "pipeline": "kb_engine",
+            "chunks": len(engine.store),
+            "build_s": round(build_time, 3),
+            "index_bytes": index_bytes,
+        }
+        if track_memory:
+            result["peak_mem_mb"] = peak_memory_mb(
+                BM25SearchEngine(TextPreprocessor(empty_token_cache(tmp_dir))).build_index, knowledge_base
+            )
+
+    samples = []
+    for query in queries:
+        engine.search(query)
+        for _ in range(repeat):
+            _, search_time = timed(engine.search, query)
+            samples.append(search_time)
+
+    result["latency_ms"] = {"search": percentiles(samples)}
+    return result
+
+
+def same_top_k(expected: List[Tuple[int, float]], actual: List[Tuple[int, float]]) -> bool:
+    """Одинаковые номера чанков в том же порядке и оценки с точностью до округления"""
+    return (
+        [doc for doc, _ in expected] == [doc for doc, _ in actual]
+        and np.allclose([score for _, score in expected], [score for _, score in actual])
+    )
+
+
+def bench_sharded(docs_dir: str, queries: List[str], repeat: int, track_memory: bool,
+                  tmp_dir: str, shards: int = DEFAULT_SHARDS) -> Dict:
+    """Бенчмарк sharded_index.ShardedIndex: top_k шардов в рабочих процессах против top_k
+    единого индекса на тех же запросах. Пропускная способность - запросов в секунду.
+    mismatched_queries - запросы, где выдача шардов отличается от выдачи единого индекса"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        token_cache = empty_token_cache(tmp_dir)
+        bm25, chunks = app.create_bm25_index(docs_dir, None, None, token_cache)
+    token_ids = token_cache.encode_many(chunks)
+    shards_dir = os.path.join(tmp_dir, "shards")
+    _, build_time = timed(build_shards, token_ids, token_cache.terms, shards, shards_dir, 1.8, 0.75)
+    result = {
+        "pipeline": "sharded",
+        "shards": shards,
+        "chunks": len(chunks),
+        "build_s": round(build_time, 3),
+        "index_bytes": sum(
+            index_size(os.path.join(shards_dir, name))
+            for name in os.listdir(shards_dir) if name.startswith("shard_")
+        ),
+    }
+
+    # Взвешенные запросы как в main.search_relevant_chunks
+    weighted = [[term for term in app.extract_keywords(query, bm25) for _ in range(2)] for query in queries]
+    samples = {"single_top_k": [], "sharded_top_k": []}
+    sharded, start_time = timed(ShardedIndex, shards_dir)
+    result["load_s"] = round(start_time, 3)
+    with sharded:
+        result["mismatched_queries"] = [
+            " ".join(query) for query in weighted
+            if not same_top_k(bm25.top_k(query, app.TOP_K), sharded.top_k(query, app.TOP_K))
+        ]
+        for name, index in (("single_top_k", bm25), ("sharded_top_k", sharded)):
+            for query in weighted:
+                index.top_k(query, app.TOP_K)
+                for _ in range(repeat):
+                    _, search_time = timed(index.top_k, query, app.TOP_K)
+                    samples[name].append(search_time)
+
+    result["latency_ms"] = {name: percentiles(values) for name, values in samples.items()}
+    result["throughput_qps"] = {
+        name.replace("_top_k", ""): round(len(values) / sum(values), 1) for name, values in samples.items()
+    }
+    shutil.rmtree(shards_dir)
+    return result
+
+
+def bench_tokenizers(path: str, repeat: int = TOKENIZER_REPEAT) -> Dict[str, float]:
+    """Пропускная способность токенизаторов, MB/s (по размеру текста в UTF-8, лучший из repeat)"""
+    encoding = app.detect_file_encoding(path)
+    with open(path, "r", encoding=encoding, errors="replace") as f:
+        text = f.read()
+    megabytes = len(text.encode("utf-8")) / 1024 / 1024
+
+    def legacy_keywords(t: str) -> List[str]:
+        # Прежний extract_keywords: findall, затем отдельный поиск цифр в каждом слове
+        return [w for w in re.findall(r'\b[а-яё]+\b', t.lower()) if not re.search(r'\d', w)]
+
+    tokenizers = {
+        "legacy_keywords": legacy_keywords,
+        "russian_words": russian_words,
+        "tokenize": tokenize,
+        "scan": lambda t: list(scan(t)),
+    }
+    result = {}
+    for name, fn in tokenizers.items():
+        best = min(timed(fn, text)[1] for _ in range(repeat))
+        result[name] = round(megabytes / best, 1)
+    return result
+
+
+def find_regressions(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Сравнение с эталоном: метрики, выросшие больше чем на tolerance"""
+    previous = {(r["pipeline"], r["scale"]): r for r in baseline.get("results", [])}
+    regressions = []
+
+    for current in results["results"]:
+        old = previous.get((current["pipeline"], current["scale"]))
+        if not old:
+            continue
+
+        pairs = [(key, old.get(key), current.get(key)) for key in ("build_s", "load_s", "index_bytes", "peak_mem_mb")]
+        for stage, stats in current["latency_ms"].items():
+            old_stats = old.get("latency_ms", {}).get(stage, {})
+            pairs.append((f"{stage}.p95", old_stats.get("p95"), stats["p95"]))
+
+        for metric, old_value, new_value in pairs:
+            if old_value and new_value is not None and new_value > old_value * (1 + tolerance):
+                regressions.append(
+                    f"{current['pipeline']} x{current['scale']} {metric}: {old_value} -> {new_value}"
+                )
+    for current in results["results"]:
+        for query in current.get("mismatched_queries", []):
+            regressions.append(f"{current['pipeline']} x{current['scale']}: выдача шардов отличается ({query})")
+    old_tokenizers = baseline.get("tokenizers_mb_s", {})
+    for name, value in results.get("tokenizers_mb_s", {}).items():
+        old_value = old_tokenizers.get(name)
+        if old_value and value < old_value * (1 - tolerance):
+            regressions.append(f"tokenizer {name} MB/s: {old_value} -> {value}")
+    return regressions
+
+
+def print_report(results: Dict) -> None:
+    """Краткий табличный отчет в stderr (stdout занят JSON)"""
+    for r in results["results"]:
+        memory = f"{r['peak_mem_mb']} MB" if "peak_mem_mb" in r else "-"
+        load = f", загрузка: {r['load_s']} с" if "load_s" in r else ""
+        print(
+            f"[{r['pipeline']} x{r['scale']}] чанков: {r['chunks']}, построение: {r['build_s']} с{load}, "
+            f"память: {memory}, индекс: {r['index_bytes'] / 1024 / 1024:.1f} MB",
+            file=sys.stderr
+        )
+        for stage, stats in r["latency_ms"].items():
+            print(
+                f"    {stage}: p50={stats['p50']} мс p95={stats['p95']} мс p99={stats['p99']} мс",
+                file=sys.stderr
+            )
+        if "throughput_qps" in r:
+            throughput = ", ".join(f"{name}: {qps} q/s" for name, qps in r["throughput_qps"].items())
+            print(f"    шардов: {r['shards']}, пропускная способность: {throughput}, "
+                  f"расхождений с единым индексом: {len(r['mismatched_queries'])}", file=sys.stderr)
+    for name, value in results.get("tokenizers_mb_s", {}).items():
+        print(f"[tokenizer] {name}: {value} MB/s", file=sys.stderr)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Бенчмарк поиска по корпусу документов")
+    parser.add_argument("--docs-dir", default=app.DOCUMENTS_DIR, help="папка с .txt документами")
+    parser.add_argument("--scales", default=DEFAULT_SCALES,
+                        help="коэффициенты увеличения корпуса через запятую, например 1,10,100")
+    parser.add_argument("--pipelines", default="main,kb_engine,tokenizer",
+                        help="main, kb_engine, tokenizer, sharded через запятую")
+    parser.add_argument("--tokenizer-file", default=TOKENIZER_FILE, help="текст для замера токенизаторов")
+    parser.add_argument("--shards", type=int, default=DEFAULT_SHARDS, help="число шардов для sharded")
+    parser.add_argument("--repeat", type=int, default=QUERY_REPEAT, help="повторов каждого запроса")
+    parser.add_argument("--no-memory", action="store_true", help="не замерять пиковую память")
+    parser.add_argument("--output", help="файл для JSON-результатов (по умолчанию stdout)")
+    parser.add_argument("--baseline", help="JSON предыдущего запуска для поиска регрессий")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE,
+                        help="допустимый относительный рост метрик")
+    args = parser.parse_args(argv)
+
+    benches = {
+        "main": bench_main_pipeline,
+        "kb_engine": bench_kb_engine,
+        "sharded": lambda *bench_args: bench_sharded(*bench_args, shards=args.shards),
+    }
+    pipelines = [name.strip() for name in args.pipelines.split(",") if name.strip()]
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "docs_dir": args.docs_dir,
+            "queries": len(BENCHMARK_QUERIES),
+            "repeat": args.repeat,
+        },
+        "results": [],
+    }
+
+    if "tokenizer" in pipelines:
+        print("⏳ tokenizer...", file=sys.stderr)
+        results["tokenizers_mb_s"] = bench_tokenizers(args.tokenizer_file)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for scale in [int(s) for s in args.scales.split(",")]:
+            docs_dir = make_scaled_corpus(args.docs_dir, scale, tmp_dir)
+            for name in [p for p in pipelines if p in benches]:
+                print(f"⏳ {name} x{scale}...", file=sys.stderr)
+                result = benches[name](docs_dir, BENCHMARK_QUERIES, args.repeat, not args.no_memory, tmp_dir)
+                result["scale"] = scale
+                results["results"].append(result)
+
+    print_report(results)
+    payload = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(payload)
+    else:
+        print(payload)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"❌ Регрессия: {line}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
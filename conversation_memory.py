@@ -0,0 +1,118 @@
+"""Ограниченная память диалога со скользящим резюме.
+
+Последние реплики (вопрос и ответ) хранятся дословно, более старые
+сворачиваются в краткое резюме. Резюме обновляется инкрементально: при
+вытеснении реплик summarize(текущее резюме, вытесненные реплики) дает новое,
+поэтому каждая реплика обрабатывается один раз. Резюме и последние реплики
+вместе укладываются в бюджет токенов, и размер промпта не растет с длиной
+консультации.
+
+По умолчанию резюме извлекающее (вопрос и первое предложение ответа), без
+обращения к LLM; talk2json_bot передает функцию сжатия через LLM. Токены
+оцениваются по длине текста: CHARS_PER_TOKEN символов русского текста на токен.
+"""
+
+import re
+from typing import Callable, List, Optional, Tuple
+
+MEMORY_TOKEN_BUDGET = 400
+MEMORY_RECENT_TURNS = 3
+# Доля бюджета под резюме, остальное - под дословные последние реплики
+SUMMARY_SHARE = 0.4
+CHARS_PER_TOKEN = 3
+SUMMARY_ANSWER_CHARS = 160
+SUMMARY_HEADER = "Краткое содержание предыдущего диалога:"
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+Turn = Tuple[str, str]
+
+
+def estimate_tokens(text: str) -> int:
+    """Оценка числа токенов по длине текста"""
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def clip_to_tokens(text: str, tokens: int) -> str:
+    """Обрезка текста до бюджета токенов с многоточием"""
+    limit = max(0, tokens) * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    return text[:max(0, limit - 1)].rstrip() + "…"
+
+
+def extractive_summary(summary: str, turns: List[Turn]) -> str:
+    """Резюме без LLM: к прежнему резюме добавляется строка на реплику
+    (вопрос и первое предложение ответа)"""
+    lines = [summary] if summary else []
+    for question, answer in turns:
+        first_sentence = SENTENCE_END.split(" ".join(answer.split()), 1)[0]
+        lines.append(
+            f"- {' '.join(question.split())} → "
+            f"{clip_to_tokens(first_sentence, SUMMARY_ANSWER_CHARS // CHARS_PER_TOKEN)}"
+        )
+    return "\n".join(lines)
+
+
+class ConversationMemory:
+    def __init__(self, token_budget: int = MEMORY_TOKEN_BUDGET, recent_turns: int = MEMORY_RECENT_TURNS,
+                 summarize: Optional[Callable[[str, List[Turn]], str]] = None):
+        self.token_budget = token_budget
+        self.summary_budget = int(token_budget * SUMMARY_SHARE)
+        self.recent_turns = recent_turns
+        self.summarize = summarize or extractive_summary
+        self.turns: List[Turn] = []
+        self.summary = ""
+        self.total_turns = 0
+
+    def _turns_tokens(self) -> int:
+        return sum(estimate_tokens(q) + estimate_tokens(a) for q, a in self.turns)
+
+    def add(self, question: str, answer: str) -> None:
+        """Новая реплика; старые сверх лимита числа или бюджета сворачиваются в резюме"""
+        self.turns.append((question, answer))
+        self.total_turns += 1
+
+        evicted = []
+        turns_budget = self.token_budget - self.summary_budget
+        while len(self.turns) > self.recent_turns or (len(self.turns) > 1 and self._turns_tokens() > turns_budget):
+            evicted.append(self.turns.pop(0))
+        if not evicted:
+            return
+
+        try:
+            summary = self.summarize(self.summary, evicted)
+        except Exception:
+            # Сбой внешнего сжатия (например, LLM) не должен терять историю
+            summary = extractive_summary(self.summary, evicted)
+        self.summary = self._fit_summary(summary)
+
+    def _fit_summary(self, summary: str) -> str:
+        """Резюме в пределах своей доли бюджета: первыми отбрасываются самые старые строки"""
+        lines = summary.strip().splitlines()
+        while len(lines) > 1 and estimate_tokens("\n".join(lines)) > self.summary_budget:
+            lines.pop(0)
+        return clip_to_tokens("\n".join(lines), self.summary_budget)
+
+    def render(self) -> str:
+        """Резюме и последние реплики для промпта; не больше token_budget токенов"""
+        parts = [f"{SUMMARY_HEADER}\n{self.summary}"] if self.summary else []
+        remaining = self.token_budget - sum(estimate_tokens(part) + 1 for part in parts)
+
+        # Бюджет раздается с самой свежей реплики; длинный ответ обрезается
+        recent = []
+        for question, answer in reversed(self.turns):
+            turn = f"В: {question}\nО: {answer}"
+            if estimate_tokens(turn) + 1 > remaining:
+                turn = clip_to_tokens(turn, remaining - 1)
+            if turn:
+                recent.append(turn)
+            remaining -= estimate_tokens(turn) + 1
+            if remaining <= 0:
+                break
+        return "\n".join(parts + recent[::-1])
+
+    def clear(self) -> None:
+        self.turns = []
+        self.summary = ""
+        self.total_turns = 0
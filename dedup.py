@@ -0,0 +1,90 @@
+"""Поиск почти-дубликатов чанков при индексации.
+
+Чанк представляется множеством шинглов - хэшей SHINGLE_SIZE подряд идущих
+символов, из которых берется каждый SHINGLE_SAMPLE-й по значению хэша.
+Точные копии находятся по хэшу текста, почти-дубликаты - через MinHash/LSH
+(minhash.py) с проверкой точного коэффициента Жаккара шинглов.
+Дубликаты схлопываются в одну запись индекса (остается первый чанк),
+а источники всех копий сохраняются в списке ссылок этой записи.
+"""
+
+import hashlib
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from minhash import LSHIndex, signature_from_hashes
+
+DEDUP_THRESHOLD = 0.85
+SHINGLE_SIZE = 32  # степень двойки
+SHINGLE_MULTIPLIER = 0x9E3779B97F4A7C15
+SHINGLE_SAMPLE = 8
+
+
+def shingle_hashes(text: str) -> np.ndarray:
+    """Отсортированные уникальные 32-битные хэши шинглов текста (SHINGLE_SIZE символов
+    после приведения к нижнему регистру и схлопывания пробелов)"""
+    normalized = " ".join(text.lower().split())
+    codes = np.frombuffer(normalized.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    if len(codes) < SHINGLE_SIZE:
+        return np.unique(codes)
+
+    # Полиномиальный хэш окон удвоением ширины: log2(SHINGLE_SIZE) векторных шагов
+    combined, width = codes, 1
+    with np.errstate(over="ignore"):
+        while width < SHINGLE_SIZE:
+            power = np.uint64(pow(SHINGLE_MULTIPLIER, width, 2 ** 64))
+            combined = combined[:-width] * power + combined[width:]
+            width *= 2
+    hashes = combined >> np.uint64(32)
+    # Одинаковая для всех чанков выборка 1/SHINGLE_SAMPLE шинглов сохраняет оценку Жаккара.
+    # У коротких чанков выборка бывает пустой: тогда берутся все шинглы
+    sampled = hashes[hashes % np.uint64(SHINGLE_SAMPLE) == 0]
+    return np.unique(sampled if len(sampled) else hashes)
+
+
+def shingle_jaccard(a: np.ndarray, b: np.ndarray) -> float:
+    """Точный коэффициент Жаккара двух отсортированных массивов уникальных хэшей.
+    Пустые множества ничего не говорят о сходстве текстов: 0, копии находит хэш текста"""
+    if not len(a) or not len(b):
+        return 0.0
+    common = len(np.intersect1d(a, b, assume_unique=True))
+    return common / (len(a) + len(b) - common)
+
+
+def deduplicate_chunks(chunks: List[str], sources: List[List], threshold: float = DEDUP_THRESHOLD
+                       ) -> Tuple[List[str], List[List[List]]]:
+    """Схлопывание точных и почти-дубликатов.
+
+    sources[i] - ссылка на источник i-го чанка (например, [имя файла, номер чанка]).
+    Возвращает уникальные чанки и для каждого список ссылок на все его копии.
+    """
+    unique_chunks: List[str] = []
+    unique_sources: List[List[List]] = []
+    by_text_hash: Dict[bytes, int] = {}
+    shingles: List[np.ndarray] = []
+    lsh = LSHIndex()
+
+    for chunk, source in zip(chunks, sources):
+        text_hash = hashlib.sha1(chunk.encode("utf-8", errors="replace")).digest()
+        duplicate_of = by_text_hash.get(text_hash)
+
+        if duplicate_of is None:
+            chunk_shingles = shingle_hashes(chunk)
+            signature = signature_from_hashes(chunk_shingles)
+            for candidate in sorted(lsh.query(signature)):
+                if shingle_jaccard(chunk_shingles, shingles[candidate]) >= threshold:
+                    duplicate_of = candidate
+                    break
+
+        if duplicate_of is not None:
+            unique_sources[duplicate_of].append(source)
+            continue
+
+        by_text_hash[text_hash] = len(unique_chunks)
+        lsh.insert(len(unique_chunks), signature)
+        shingles.append(chunk_shingles)
+        unique_chunks.append(chunk)
+        unique_sources.append([source])
+
+    return unique_chunks, unique_sources
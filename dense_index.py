@@ -0,0 +1,138 @@
+"""Плотные векторы чанков (LSA) с приближенным поиском ближайших соседей.
+
+Чанки проецируются в пространство LSA: TF-IDF по усеченным основам слов
+и TruncatedSVD из scikit-learn, все считается локально на CPU. Векторы
+нормируются и хранятся в int8 с масштабом на строку. Поиск идет по
+IVF-индексу: векторы разбиты на кластеры KMeans, запрос сравнивается
+только с векторами из n_probe ближайших кластеров.
+
+reciprocal_rank_fusion() объединяет выдачи BM25 и векторного поиска
+(гибридный поиск), что помогает на перефразированных вопросах.
+
+scikit-learn импортируется только при построении индекса: его импорт
+занимает больше секунды и не нужен, пока гибридный поиск выключен.
+"""
+
+import hashlib
+import importlib.util
+import os
+import pickle
+import re
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+HAS_SKLEARN = importlib.util.find_spec("sklearn") is not None
+
+DENSE_DIM = 256
+STEM_LENGTH = 6
+MIN_WORD_LENGTH = 3
+DEFAULT_N_PROBE = 4
+RRF_K = 60
+
+WORD_PATTERN = re.compile(r"[а-яёa-z0-9]+")
+
+
+def stem_tokens(text: str) -> List[str]:
+    """Грубая нормализация словоформ: нижний регистр и первые STEM_LENGTH букв"""
+    return [w[:STEM_LENGTH] for w in WORD_PATTERN.findall(text.lower()) if len(w) >= MIN_WORD_LENGTH]
+
+
+def chunks_fingerprint(chunks: List[str]) -> str:
+    """Хэш текстов чанков для проверки актуальности сохраненного индекса"""
+    digest = hashlib.sha1()
+    for chunk in chunks:
+        digest.update(chunk.encode("utf-8", errors="replace"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class DenseIndex:
+    def __init__(self, chunks: List[str], dim: int = DENSE_DIM, n_lists: Optional[int] = None, seed: int = 0):
+        if not HAS_SKLEARN:
+            raise ImportError("Для векторного поиска нужна библиотека scikit-learn")
+        from sklearn.cluster import MiniBatchKMeans
+        from sklearn.decomposition import TruncatedSVD
+        from sklearn.feature_extraction.text import TfidfVectorizer
+
+        self.fingerprint = chunks_fingerprint(chunks)
+        self.vectorizer = TfidfVectorizer(analyzer=stem_tokens, sublinear_tf=True, min_df=2, max_df=0.8)
+        tfidf = self.vectorizer.fit_transform(chunks)
+        # Отброшенные по min_df/max_df термы нужны только для отладки, а весят больше словаря
+        self.vectorizer.stop_words_ = None
+
+        dim = max(1, min(dim, tfidf.shape[1] - 1, len(chunks) - 1))
+        self.svd = TruncatedSVD(n_components=dim, random_state=seed)
+        vectors = self._normalize(self.svd.fit_transform(tfidf))
+        self.svd.components_ = self.svd.components_.astype(np.float32)
+        self.vectors, self.scales = self._quantize(vectors)
+
+        n_lists = n_lists or max(1, int(np.sqrt(len(chunks))))
+        kmeans = MiniBatchKMeans(n_clusters=n_lists, random_state=seed, n_init=3)
+        labels = kmeans.fit_predict(vectors)
+        self.centroids = self._normalize(kmeans.cluster_centers_).astype(np.float32)
+        # Инвертированные списки IVF: номера чанков, сгруппированные по кластерам
+        self.list_ids = np.argsort(labels, kind="stable").astype(np.int32)
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=n_lists))])
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    @staticmethod
+    def _quantize(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """int8 с масштабом на строку: в 4 раза меньше float32"""
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1.0
+        quantized = np.round(vectors / scales[:, None]).astype(np.int8)
+        return quantized, scales.astype(np.float32)
+
+    def embed_query(self, query: str) -> np.ndarray:
+        vector = self.svd.transform(self.vectorizer.transform([query]))
+        return self._normalize(vector)[0].astype(np.float32)
+
+    def search(self, query: str, k: int, n_probe: int = DEFAULT_N_PROBE) -> List[Tuple[int, float]]:
+        """Приближенный поиск k ближайших чанков по косинусной близости"""
+        q = self.embed_query(query)
+        if not q.any():
+            return []
+
+        n_probe = min(n_probe, len(self.centroids))
+        lists = np.argpartition(-(self.centroids @ q), n_probe - 1)[:n_probe]
+        ids = np.concatenate([self.list_ids[self.list_offsets[c]:self.list_offsets[c + 1]] for c in lists])
+        if not len(ids):
+            return []
+
+        scores = (self.vectors[ids].astype(np.float32) @ q) * self.scales[ids]
+        k = min(k, len(ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(ids[i]), float(scores[i])) for i in top]
+
+    def save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "dense.pkl"), "wb") as f:
+            pickle.dump(self, f)
+
+    @classmethod
+    def load(cls, path: str, chunks: Optional[List[str]] = None) -> Optional["DenseIndex"]:
+        """Загрузка индекса; None, если файла нет или он построен по другим чанкам"""
+        file_path = os.path.join(path, "dense.pkl")
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, "rb") as f:
+            index = pickle.load(f)
+        if chunks is not None and index.fingerprint != chunks_fingerprint(chunks):
+            return None
+        return index
+
+
+def reciprocal_rank_fusion(rankings: List[List[int]], k: int = RRF_K) -> List[Tuple[int, float]]:
+    """Объединение нескольких ранжирований: сумма 1 / (k + позиция)"""
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda x: (-x[1], x[0]))
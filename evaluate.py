@@ -0,0 +1,298 @@
+"""Оценка качества поиска и ответа с фейковым LLM.
+
+Прогоняет пары вопрос -> ожидаемый фрагмент (например, заголовок статьи)
+через поиск main.py и talk2json_bot.BM25SearchEngine, считает recall@k и MRR,
+время каждого этапа и долю ответов, в которые попал ожидаемый фрагмент.
+Этап ответа выполняется против локального сервера из fake_llm.py (режим
+эха), поэтому проверяется, что нужный фрагмент дошел до модели.
+
+Пример:
+    python evaluate.py --questions data/eval_questions.json --output data/eval.json
+    python evaluate.py --from-kb knowledge_base.json --pipelines kb_engine
+    python evaluate.py --baseline data/eval.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "attached_assets"))
+
+import main as app
+import talk2json_bot as kb_bot
+from benchmark import load_knowledge_base as load_documents_as_kb
+from benchmark import percentiles, timed
+from fake_llm import start_server
+
+DEFAULT_QUESTIONS_PATH = os.path.join("data", "eval_questions.json")
+RECALL_AT = (1, 3, 5)
+MARKER_LENGTH = 120
+QUALITY_METRICS = ["mrr", "answer_support"] + [f"recall@{k}" for k in RECALL_AT]
+
+
+def normalize(text: str) -> str:
+    """Нормализация пробелов и регистра для сравнения фрагментов"""
+    return " ".join(text.split()).lower()
+
+
+def chunk_marker(text: str, length: int = MARKER_LENGTH) -> str:
+    """Характерный отрывок из середины чанка, по которому ищется совпадение"""
+    normalized = " ".join(text.split())
+    start = max(0, len(normalized) // 2 - length // 2)
+    return normalized[start:start + length]
+
+
+def contains_expected(text: str, expected: List[str]) -> bool:
+    """Содержит ли текст хотя бы один из ожидаемых фрагментов"""
+    normalized = normalize(text)
+    return any(normalize(marker) in normalized for marker in expected)
+
+
+def first_relevant_rank(texts: List[str], expected: List[str]) -> Optional[int]:
+    """Позиция (с единицы) первого релевантного фрагмента в выдаче"""
+    for rank, text in enumerate(texts, start=1):
+        if contains_expected(text, expected):
+            return rank
+    return None
+
+
+def load_questions(path: str) -> List[Dict]:
+    """Загрузка набора вопросов: [{"question": ..., "expected": [...]}]"""
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def questions_from_knowledge_base(kb_path: str) -> List[Dict]:
+    """Набор вопросов из qa_pairs базы знаний docs2json"""
+    with open(kb_path, "r", encoding="utf-8") as f:
+        documents = json.load(f).get("documents", [])
+
+    questions = []
+    for doc in documents:
+        for chunk in doc.get("chunks", []):
+            marker = chunk_marker(str(chunk.get("chunk_text", "")))
+            if not marker:
+                continue
+            for qa in chunk.get("qa_pairs", []):
+                questions.append({
+                    "question": qa.get("question", ""),
+                    "expected": [marker],
+                    "reference_answer": qa.get("answer", ""),
+                    "chunk_id": chunk.get("chunk_id"),
+                })
+    return [q for q in questions if q["question"]]
+
+
+def run_main_pipeline(questions: List[Dict], docs_dir: str, llm_url: str, hybrid: bool = False,
+                      fts_path: Optional[str] = None, passages: bool = False) -> List[Dict]:
+    """Поиск и ответ через функции main.py (hybrid - BM25 вместе с векторным поиском,
+    fts_path - бэкенд SQLite FTS5 с базой в этом файле, passages - в промпт идут
+    отрывки чанков из passages.py, а не чанки целиком)"""
+    if fts_path:
+        bm25, chunks = app.create_fts_index(docs_dir, fts_path)
+    else:
+        # Без сохранения: индекс приложения в INDEX_DIR не перезаписывается
+        bm25, chunks = app.create_bm25_index(docs_dir, None)
+    if bm25 is None:
+        raise RuntimeError(f"Не удалось построить индекс по папке {docs_dir}")
+    dense = app.create_dense_index(chunks, None) if hybrid else None
+
+    rows = []
+    for item in questions:
+        question = item["question"]
+        timings = {}
+        keywords, timings["extract_keywords"] = timed(app.extract_keywords, question, bm25)
+        found, timings["search"] = timed(app.search_relevant_chunks, bm25, chunks, keywords, dense, question)
+        fragments = found
+        if passages:
+            selected, timings["passages"] = timed(app.select_passages, bm25, found, keywords, question)
+            fragments = [app.passages_text(chunk, chunk_passages) for chunk, chunk_passages in zip(found, selected)]
+        context, timings["context"] = timed(app.build_context, keywords, fragments)
+        messages = app.build_messages(question, context)
+        answer, timings["llm"] = timed(app.ask_llm, messages, llm_url)
+
+        rows.append({
+            "question": question,
+            "rank": first_relevant_rank(found, item["expected"]),
+            "answer_supported": contains_expected(answer, item["expected"]),
+            "prompt_chars": sum(len(m["content"]) for m in messages),
+            "timings": timings,
+        })
+    return rows
+
+
+def negated_qa_matches(qa: "kb_bot.QAIndex") -> List[str]:
+    """Сохраненные вопросы, на отрицание которых ("Не ...") QAIndex отвечает сохраненной парой"""
+    return [entry["question"] for entry in qa.entries if qa.match(f"Не {entry['question']}") is not None]
+
+
+def run_kb_pipeline(questions: List[Dict], knowledge_base: List[Dict], llm_url: str,
+                    fts_path: Optional[str] = None) -> Tuple[List[Dict], List[str]]:
+    """Поиск и ответ через talk2json_bot: BM25SearchEngine (или FTSSearchEngine с базой
+    в fts_path), build_llm_context, LLMClient. Вместе со строками возвращает вопросы
+    qa_pairs, чье отрицание ошибочно получает быстрый ответ"""
+    if fts_path:
+        engine = kb_bot.FTSSearchEngine(kb_bot.TextPreprocessor(), fts_path)
+    else:
+        engine = kb_bot.BM25SearchEngine(kb_bot.TextPreprocessor())
+    with contextlib.redirect_stdout(io.StringIO()):
+        engine.build_index(knowledge_base)
+    llm_client = kb_bot.LLMClient(llm_url, "fake")
+
+    rows = []
+    for item in questions:
+        question = item["question"]
+        timings = {}
+        found, timings["search"] = timed(engine.search, question, max(RECALL_AT))
+        context, timings["context"] = timed(kb_bot.build_llm_context, question, found)
+        messages = [
+            {"role": "system", "content": kb_bot.SYSTEM_PROMPT},
+            {"role": "user", "content": context}
+        ]
+        answer, timings["llm"] = timed(
+            llm_client.query, messages, kb_bot.TEMPERATURE, kb_bot.MAX_ANSWER_LENGTH
+        )
+
+        rows.append({
+            "question": question,
+            "rank": first_relevant_rank([r.get("chunk_text", "") for r in found], item["expected"]),
+            "answer_supported": contains_expected(answer, item["expected"]),
+            "prompt_chars": sum(len(m["content"]) for m in messages),
+            "timings": timings,
+        })
+    return rows, negated_qa_matches(engine.qa)
+
+
+def summarize(pipeline: str, rows: List[Dict]) -> Dict:
+    """Сводные метрики качества и времени по прогону"""
+    total = len(rows) or 1
+    summary = {
+        "pipeline": pipeline,
+        "questions": len(rows),
+        "mrr": round(sum(1 / r["rank"] for r in rows if r["rank"]) / total, 4),
+        "answer_support": round(sum(r["answer_supported"] for r in rows) / total, 4),
+        "prompt_chars_mean": round(sum(r["prompt_chars"] for r in rows) / total, 1),
+    }
+    for k in RECALL_AT:
+        summary[f"recall@{k}"] = round(sum(1 for r in rows if r["rank"] and r["rank"] <= k) / total, 4)
+
+    stage_samples = defaultdict(list)
+    for r in rows:
+        for stage, value in r["timings"].items():
+            stage_samples[stage].append(value)
+    summary["latency_ms"] = {stage: percentiles(values) for stage, values in stage_samples.items()}
+    return summary
+
+
+def find_quality_drops(results: Dict, baseline: Dict, max_drop: float) -> List[str]:
+    """Сравнение с эталоном: метрики качества, упавшие больше чем на max_drop"""
+    previous = {s["pipeline"]: s for s in baseline.get("summary", [])}
+    drops = []
+    for current in results["summary"]:
+        old = previous.get(current["pipeline"])
+        if not old:
+            continue
+        for metric in QUALITY_METRICS:
+            if metric in old and current[metric] < old[metric] - max_drop:
+                drops.append(f"{current['pipeline']} {metric}: {old[metric]} -> {current[metric]}")
+    return drops
+
+
+def print_report(results: Dict) -> None:
+    for s in results["summary"]:
+        recall = " ".join(f"R@{k}={s[f'recall@{k}']}" for k in RECALL_AT)
+        print(
+            f"[{s['pipeline']}] вопросов: {s['questions']}, {recall}, MRR={s['mrr']}, "
+            f"ответ с опорой на фрагмент: {s['answer_support']}, промпт: {s['prompt_chars_mean']} симв.",
+            file=sys.stderr
+        )
+        for stage, stats in s["latency_ms"].items():
+            print(f"    {stage}: p50={stats['p50']} мс p95={stats['p95']} мс", file=sys.stderr)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Оценка качества поиска и ответа")
+    parser.add_argument("--questions", default=DEFAULT_QUESTIONS_PATH, help="JSON с вопросами")
+    parser.add_argument("--from-kb", help="взять вопросы из qa_pairs базы знаний docs2json")
+    parser.add_argument("--knowledge-base", help="база знаний для kb_engine (по умолчанию из --from-kb или documents)")
+    parser.add_argument("--docs-dir", default=app.DOCUMENTS_DIR, help="папка с .txt документами")
+    parser.add_argument("--pipelines", default="main,kb_engine", help="main, main_hybrid, main_fts, main_passages, kb_engine, kb_fts через запятую")
+    parser.add_argument("--llm-url", help="эндпоинт chat/completions (по умолчанию локальный фейковый)")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="задержка фейкового LLM, с")
+    parser.add_argument("--details", action="store_true", help="включить результаты по каждому вопросу")
+    parser.add_argument("--output", help="файл для JSON-результатов (по умолчанию stdout)")
+    parser.add_argument("--baseline", help="JSON предыдущего запуска для проверки качества")
+    parser.add_argument("--max-drop", type=float, default=0.0, help="допустимое падение метрик качества")
+    args = parser.parse_args(argv)
+
+    questions = questions_from_knowledge_base(args.from_kb) if args.from_kb else load_questions(args.questions)
+    if not questions:
+        print("Набор вопросов пуст", file=sys.stderr)
+        return 1
+
+    server = None
+    llm_url = args.llm_url
+    if not llm_url:
+        server, llm_url = start_server(latency=args.llm_latency)
+
+    results = {"meta": {"questions": len(questions), "llm_url": llm_url}, "summary": []}
+    # Базы FTS строятся заново для каждого прогона во временной папке
+    tmp_dir = tempfile.TemporaryDirectory()
+    try:
+        for pipeline in [p.strip() for p in args.pipelines.split(",") if p.strip()]:
+            print(f"⏳ {pipeline}...", file=sys.stderr)
+            fts_path = os.path.join(tmp_dir.name, f"{pipeline}.sqlite") if pipeline.endswith("_fts") else None
+            if pipeline in ("main", "main_hybrid", "main_fts", "main_passages"):
+                rows = run_main_pipeline(
+                    questions, args.docs_dir, llm_url, pipeline == "main_hybrid", fts_path, pipeline == "main_passages"
+                )
+            else:
+                kb_path = args.knowledge_base or args.from_kb
+                if kb_path:
+                    knowledge_base = kb_bot.load_knowledge_base(kb_path)
+                else:
+                    knowledge_base = load_documents_as_kb(args.docs_dir)
+                rows, negated = run_kb_pipeline(questions, knowledge_base, llm_url, fts_path)
+                results["meta"].setdefault("qa_negation_matches", {})[pipeline] = negated
+
+            summary = summarize(pipeline, rows)
+            if args.details:
+                summary["details"] = rows
+            results["summary"].append(summary)
+    finally:
+        tmp_dir.cleanup()
+        if server:
+            server.shutdown()
+
+    print_report(results)
+    negation_errors = [
+        f"{pipeline}: {question}"
+        for pipeline, negated in results["meta"].get("qa_negation_matches", {}).items() for question in negated
+    ]
+    for line in negation_errors:
+        print(f"❌ Быстрый ответ на отрицание вопроса: {line}", file=sys.stderr)
+    payload = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(payload)
+    else:
+        print(payload)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            drops = find_quality_drops(results, json.load(f), args.max_drop)
+        for line in drops:
+            print(f"❌ Качество упало: {line}", file=sys.stderr)
+        if drops:
+            return 1
+    return 1 if negation_errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
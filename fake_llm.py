@@ -0,0 +1,117 @@
+"""Локальный фейковый OpenAI-совместимый сервер /v1/chat/completions.
+
+Нужен для оценки качества, бенчмарков и нагрузочных прогонов без обращения
+к настоящему LLM API. В режиме "echo" ответ содержит текст переданного
+контекста, поэтому по ответу можно проверить, дошли ли нужные фрагменты
+до модели.
+
+Пример:
+    python fake_llm.py --port 8765 --latency 0.5
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+FIXED_ANSWER = "Ответ фейковой модели."
+
+
+def render_answer(messages: List[Dict], mode: str) -> str:
+    """Текст ответа: эхо всех несистемных сообщений или фиксированная фраза"""
+    if mode == "echo":
+        return "\n\n".join(
+            str(m.get("content", "")) for m in messages if m.get("role") != "system"
+        )
+    return FIXED_ANSWER
+
+
+class FakeCompletionsHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self.send_error(400, "Invalid JSON")
+            return
+
+        with server.lock:
+            server.request_count += 1
+
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        if server.error_rate and random.random() < server.error_rate:
+            self.send_error(503, "Fake overload")
+            return
+
+        content = render_answer(payload.get("messages", []), server.mode)
+        body = json.dumps({
+            "id": f"fake-{server.request_count}",
+            "object": "chat.completion",
+            "model": payload.get("model", "fake"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }, ensure_ascii=False).encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(host: str = DEFAULT_HOST, port: int = 0, latency: float = 0.0,
+                 jitter: float = 0.0, mode: str = "echo",
+                 error_rate: float = 0.0) -> Tuple[ThreadingHTTPServer, str]:
+    """Запуск сервера в фоновом потоке. Возвращает сервер и URL эндпоинта"""
+    server = ThreadingHTTPServer((host, port), FakeCompletionsHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.jitter = jitter
+    server.mode = mode
+    server.error_rate = error_rate
+    server.request_count = 0
+    server.lock = threading.Lock()
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://{host}:{server.server_address[1]}/v1/chat/completions"
+    return server, url
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фейковый сервер chat/completions")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, с")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, с")
+    parser.add_argument("--mode", choices=["echo", "fixed"], default="echo")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 503")
+    args = parser.parse_args()
+
+    server, url = start_server(args.host, args.port, args.latency, args.jitter, args.mode, args.error_rate)
+    print(f"Фейковый LLM слушает {url}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
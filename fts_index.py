@@ -0,0 +1,352 @@
+"""Хранилище чанков в SQLite с полнотекстовым индексом FTS5.
+
+Альтернатива InvertedIndex и ChunkStore, для которой корпус не нужно держать
+в памяти: тексты, метаданные и индекс лежат в одном файле базы, поиск
+ранжируется функцией bm25() FTS5. Файл можно открыть из нескольких процессов
+(режим WAL), соединения открываются отдельно для каждого потока.
+
+Схема:
+    chunks     - метаданные чанков: источник, номер в источнике, хэш текста,
+                 поля документа и их нормализованные ключи для фильтров
+    chunks_fts - FTS5-таблица текстовых полей, rowid = chunks.id
+    chunks_vocab - fts5vocab над chunks_fts: число чанков с термом (для IDF)
+    sources    - отпечатки источников (файлов или документов базы знаний)
+
+Источники обновляются инкрементально: replace_source() в одной транзакции
+удаляет старые чанки источника и вставляет новые, поэтому читатели видят
+либо прежнюю, либо новую версию, а остальной корпус не перестраивается.
+
+Для main.py FTSIndex повторяет методы InvertedIndex, которыми пользуется
+поиск (get_scores, top_k, phrase_filter, proximity_boost); номер чанка -
+его rowid, тексты по номерам отдает FTSChunks. Фразы в кавычках main.py
+передает в top_k(phrases=...), и они входят в выражение MATCH, а не в список
+номеров чанков. Близость слов проверяется запросом NEAR, поэтому учитывается
+наличие сближения, а не их число.
+"""
+
+import hashlib
+import math
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+FTS_TOKENIZER = "unicode61 remove_diacritics 0"
+SQLITE_TIMEOUT = 30
+DOC_COLUMNS = ("doc_id", "doc_name", "doc_type", "doc_date")
+# Нормализованные значения для фильтров: точное совпадение, дата - число ГГГГММДД
+KEY_COLUMNS = ("doc_id_key", "doc_name_key", "doc_type_key", "doc_date_key")
+# Термов в одном запросе к chunks_vocab: меньше лимита переменных SQLite (999 в старых версиях)
+VOCAB_BATCH = 500
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def quote_term(term: str) -> str:
+    """Терм или фраза как строка FTS5: без операторов и спецсимволов запроса"""
+    return '"' + term.replace('"', '""') + '"'
+
+
+class FTSIndex:
+    def __init__(self, path: str, fields: Tuple[str, ...] = ("chunk_text",),
+                 weights: Optional[Dict[str, float]] = None):
+        self.path = path
+        self.fields = tuple(fields)
+        self.weights = [float((weights or {}).get(field, 1.0)) for field in self.fields]
+        self.text_field = "chunk_text" if "chunk_text" in self.fields else self.fields[0]
+        self.meta: Dict = {}
+        self.local = threading.local()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._create_schema()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Соединение текущего потока"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def _create_schema(self) -> None:
+        columns = ", ".join(self.fields)
+        with self.conn as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY, source TEXT NOT NULL, "
+                "ordinal INTEGER NOT NULL, text_hash TEXT NOT NULL, "
+                + ", ".join(f"{column} TEXT" for column in DOC_COLUMNS + KEY_COLUMNS[:-1])
+                + ", doc_date_key INTEGER)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS chunks_source ON chunks(source)")
+            conn.execute("CREATE INDEX IF NOT EXISTS chunks_hash ON chunks(text_hash)")
+            for column in KEY_COLUMNS:
+                conn.execute(f"CREATE INDEX IF NOT EXISTS chunks_{column} ON chunks({column})")
+            conn.execute("CREATE TABLE IF NOT EXISTS sources (name TEXT PRIMARY KEY, fingerprint TEXT NOT NULL)")
+            conn.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5({columns}, tokenize='{FTS_TOKENIZER}')"
+            )
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunks_vocab USING fts5vocab(chunks_fts, 'row')")
+
+        existing = tuple(row[1] for row in self.conn.execute("PRAGMA table_info(chunks_fts)"))
+        if existing != self.fields:
+            raise ValueError(f"Поля базы {self.path} ({', '.join(existing)}) не совпадают с {', '.join(self.fields)}")
+
+    # Обновление
+
+    def source_fingerprints(self) -> Dict[str, str]:
+        return dict(self.conn.execute("SELECT name, fingerprint FROM sources"))
+
+    def replace_source(self, name: str, fingerprint: str, rows: List[Dict]) -> None:
+        """Замена всех чанков источника одной транзакцией. rows - словари с текстовыми
+        полями, полями документа (DOC_COLUMNS) и ключами фильтров (KEY_COLUMNS)"""
+        meta_columns = DOC_COLUMNS + KEY_COLUMNS
+        insert_chunk = (
+            f"INSERT INTO chunks (source, ordinal, text_hash, {', '.join(meta_columns)}) "
+            f"VALUES (?, ?, ?, {', '.join('?' * len(meta_columns))})"
+        )
+        insert_text = (
+            f"INSERT INTO chunks_fts (rowid, {', '.join(self.fields)}) "
+            f"VALUES (?, {', '.join('?' * len(self.fields))})"
+        )
+        with self.conn as conn:
+            self._delete_source(conn, name)
+            for ordinal, row in enumerate(rows):
+                cursor = conn.execute(insert_chunk, (
+                    name, ordinal, text_hash(str(row.get(self.text_field, ""))),
+                    *(row.get(column) for column in meta_columns)
+                ))
+                conn.execute(insert_text, (cursor.lastrowid, *(str(row.get(field, "")) for field in self.fields)))
+            conn.execute("INSERT OR REPLACE INTO sources (name, fingerprint) VALUES (?, ?)", (name, fingerprint))
+
+    def remove_source(self, name: str) -> None:
+        with self.conn as conn:
+            self._delete_source(conn, name)
+            conn.execute("DELETE FROM sources WHERE name = ?", (name,))
+
+    def _delete_source(self, conn: sqlite3.Connection, name: str) -> None:
+        conn.execute("DELETE FROM chunks_fts WHERE rowid IN (SELECT id FROM chunks WHERE source = ?)", (name,))
+        conn.execute("DELETE FROM chunks WHERE source = ?", (name,))
+
+    # Размер и чтение
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT count(*) FROM chunks").fetchone()[0]
+
+    @property
+    def corpus_size(self) -> int:
+        """Размер масок чанков: номера - rowid, после удалений в них бывают пропуски"""
+        return (self.conn.execute("SELECT max(id) FROM chunks").fetchone()[0] or 0) + 1
+
+    def fetch(self, ids: Iterable[int], field: Optional[str] = None) -> List[str]:
+        """Текст поля (по умолчанию основного) для чанков ids в том же порядке"""
+        ids = [int(i) for i in ids]
+        if not ids:
+            return []
+        field = field or self.text_field
+        rows = dict(self.conn.execute(
+            f"SELECT rowid, {field} FROM chunks_fts WHERE rowid IN ({', '.join('?' * len(ids))})", ids
+        ))
+        return [rows.get(i, "") for i in ids]
+
+    def rows(self, ids: Iterable[int]) -> List[Dict]:
+        """Поля документа и все текстовые поля чанков ids в том же порядке"""
+        ids = [int(i) for i in ids]
+        if not ids:
+            return []
+        query = (
+            f"SELECT c.id, {', '.join('c.' + column for column in DOC_COLUMNS)}, "
+            f"{', '.join('f.' + field for field in self.fields)} "
+            f"FROM chunks c JOIN chunks_fts f ON f.rowid = c.id WHERE c.id IN ({', '.join('?' * len(ids))})"
+        )
+        names = DOC_COLUMNS + self.fields
+        found = {row[0]: dict(zip(names, row[1:])) for row in self.conn.execute(query, ids)}
+        return [found[i] for i in ids if i in found]
+
+    def sources_for(self, texts: List[str]) -> List[List[List]]:
+        """Источники ([источник, номер чанка] всех копий) для каждого текста"""
+        result = []
+        for text in texts:
+            rows = self.conn.execute(
+                "SELECT source, ordinal FROM chunks WHERE text_hash = ? ORDER BY source, ordinal", (text_hash(text),)
+            )
+            result.append([list(row) for row in rows])
+        return result
+
+    # Поиск
+
+    def _match(self, terms: Iterable[str]) -> Optional[str]:
+        unique = list(dict.fromkeys(term for term in terms if term))
+        return " OR ".join(quote_term(term) for term in unique) or None
+
+    def search(self, terms: List[str], k: int, phrases: Optional[List[List[str]]] = None,
+               filters: Optional[Tuple[str, List]] = None,
+               allowed: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """Top-k чанков по bm25() с весами полей: пары (номер чанка, оценка).
+        phrases ограничивают поиск чанками с точным вхождением всех фраз,
+        filters - условие на таблицу chunks (см. filter_clause), allowed - булева
+        маска номеров чанков: ранжированные строки отбираются по ней в Python,
+        потому что список номеров в запросе упирается в лимит переменных SQLite"""
+        match = self._match(terms)
+        if match is None or k <= 0:
+            return []
+        if phrases:
+            match = f"({match}) AND " + " AND ".join(quote_term(" ".join(phrase)) for phrase in phrases)
+
+        weights = ", ".join(str(w) for w in self.weights)
+        query = f"SELECT rowid, -bm25(chunks_fts, {weights}) AS score FROM chunks_fts WHERE chunks_fts MATCH ?"
+        params: List = [match]
+        if filters is not None:
+            query += f" AND rowid IN (SELECT id FROM chunks WHERE {filters[0]})"
+            params.extend(filters[1])
+        if allowed is None:
+            query += " ORDER BY score DESC, rowid LIMIT ?"
+            params.append(k)
+            return [(rowid, score) for rowid, score in self.conn.execute(query, params)]
+
+        result = []
+        for rowid, score in self.conn.execute(query + " ORDER BY score DESC, rowid", params):
+            if rowid < len(allowed) and allowed[rowid]:
+                result.append((rowid, score))
+                if len(result) == k:
+                    break
+        return result
+
+    def filter_clause(self, filters: Dict[str, object]) -> Optional[Tuple[str, List]]:
+        """Условие на chunks из нормализованных фильтров: {'doc_type_key': [значения], ...,
+        'doc_date_key': (с, по)}; значения одного поля - через OR, поля - через AND"""
+        conditions, params = [], []
+        for column, value in filters.items():
+            if column not in KEY_COLUMNS:
+                raise ValueError(f"Неизвестное поле фильтра: {column}")
+            if column == "doc_date_key":
+                start, end = value
+                if start is not None:
+                    conditions.append("doc_date_key >= ?")
+                    params.append(start)
+                if end is not None:
+                    conditions.append("doc_date_key <= ?")
+                    params.append(end)
+            else:
+                values = list(value)
+                conditions.append(f"{column} IN ({', '.join('?' * len(values))})")
+                params.extend(values)
+        if not conditions:
+            return None
+        return " AND ".join(conditions), params
+
+    # Совместимость с InvertedIndex для main.py
+
+    def _idf(self, terms: List[str]) -> Dict[str, float]:
+        if not terms:
+            return {}
+        total = len(self)
+        result = {}
+        for start in range(0, len(terms), VOCAB_BATCH):
+            batch = terms[start:start + VOCAB_BATCH]
+            rows = self.conn.execute(
+                f"SELECT term, doc FROM chunks_vocab WHERE term IN ({', '.join('?' * len(batch))})", batch
+            )
+            result.update({term: math.log((total - df + 0.5) / (df + 0.5) + 1) for term, df in rows})
+        return result
+
+    def term_idf(self, terms: Iterable[str]) -> Dict[str, float]:
+        """IDF известных индексу термов (для ранжирования отрывков в passages.py и
+        ключевых слов в main.extract_keywords)"""
+        return self._idf(list(dict.fromkeys(terms)))
+
+    def get_scores(self, query: List[str]) -> np.ndarray:
+        """Оценки всех чанков, где встречается хоть один терм запроса (остальные - 0)"""
+        scores = np.zeros(self.corpus_size)
+        match = self._match(query)
+        if match is None:
+            return scores
+        for rowid, score in self.conn.execute(
+            "SELECT rowid, -bm25(chunks_fts) FROM chunks_fts WHERE chunks_fts MATCH ?", (match,)
+        ):
+            scores[rowid] = score
+        return scores
+
+    def top_k(self, query: List[str], k: int, allowed: Optional[np.ndarray] = None,
+              phrases: Optional[List[List[str]]] = None) -> List[Tuple[int, float]]:
+        """Top-k по bm25(); allowed - булева маска номеров чанков (как у InvertedIndex).
+        phrases входят в выражение MATCH; если ни один чанк их не содержит, поиск
+        идет без них, как с пустой маской phrase_filter в InvertedIndex"""
+        if allowed is not None and not allowed.any():
+            return []
+        if phrases:
+            top = self.search(query, k, phrases=phrases, allowed=allowed)
+            if top:
+                return top
+        return self.search(query, k, allowed=allowed)
+
+    def phrase_filter(self, phrases: List[List[str]]) -> Optional[np.ndarray]:
+        """Маска чанков со всеми фразами; None, если фраз нет или ни один чанк их не содержит"""
+        if not phrases:
+            return None
+        match = " AND ".join(quote_term(" ".join(phrase)) for phrase in phrases)
+        ids = [row[0] for row in self.conn.execute("SELECT rowid FROM chunks_fts WHERE chunks_fts MATCH ?", (match,))]
+        if not ids:
+            return None
+        mask = np.zeros(self.corpus_size, dtype=bool)
+        mask[ids] = True
+        return mask
+
+    def proximity_boost(self, top: List[Tuple[int, float]], pairs: List[Tuple[str, str]],
+                        window: int, weight: float) -> List[Tuple[int, float]]:
+        """Переранжирование: за каждую пару термов, стоящих в чанке не дальше window
+        токенов (NEAR), добавляется weight * min(idf) / 2"""
+        pairs = [(a, b) for a, b in pairs if a != b]
+        if not top or not pairs:
+            return top
+        idf = self._idf(list({term for pair in pairs for term in pair}))
+        ids = [doc for doc, _ in top]
+        boost = dict.fromkeys(ids, 0.0)
+        for term_a, term_b in pairs:
+            if term_a not in idf or term_b not in idf:
+                continue
+            rows = self.conn.execute(
+                f"SELECT rowid FROM chunks_fts WHERE chunks_fts MATCH ? AND rowid IN ({', '.join('?' * len(ids))})",
+                [f"NEAR({quote_term(term_a)} {quote_term(term_b)}, {window})", *ids]
+            )
+            for (rowid,) in rows:
+                boost[rowid] += weight * min(idf[term_a], idf[term_b]) / 2
+        rescored = [(doc, score + boost[doc]) for doc, score in top]
+        return sorted(rescored, key=lambda x: (-x[1], x[0]))
+
+    def close(self) -> None:
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+
+class FTSChunks:
+    """Тексты чанков FTSIndex по номерам (rowid), без загрузки корпуса в память"""
+
+    def __init__(self, index: FTSIndex):
+        self.index = index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __getitem__(self, i: int) -> str:
+        row = self.index.conn.execute(
+            f"SELECT {self.index.text_field} FROM chunks_fts WHERE rowid = ?", (int(i),)
+        ).fetchone()
+        if row is None:
+            raise IndexError(i)
+        return row[0]
+
+    def __iter__(self) -> Iterator[str]:
+        """Тексты по возрастанию номеров; номера после удалений идут с пропусками"""
+        cursor = self.index.conn.execute(f"SELECT {self.index.text_field} FROM chunks_fts ORDER BY rowid")
+        return (row[0] for row in cursor)
@@ -0,0 +1,359 @@
+"""Инвертированный BM25-индекс с досрочным завершением top-k поиска.
+
+Для каждого терма хранится список словопозиций (номера чанков по
+возрастанию и частоты терма) и верхняя граница его вклада в BM25. Поиск
+top_k() использует алгоритм MaxScore: термы обрабатываются по убыванию
+верхней границы, и как только сумма границ оставшихся термов становится
+меньше текущего k-го результата, новые кандидаты больше не добавляются,
+а кандидаты без шанса попасть в top-k отбрасываются. Стоимость запроса
+зависит от числа кандидатов, а не от размера корпуса.
+
+Формулы IDF и оценки совпадают с rank_bm25.BM25Okapi, поэтому get_scores()
+можно использовать вместо BM25Okapi.get_scores(). save()/load() сохраняют
+индекс в сжатом формате postings_codec.
+
+Для каждой словопозиции хранятся позиции терма в чанке: phrase_docs()
+находит точные вхождения фраз, proximity_boost() добавляет к оценкам
+кандидатов бонус за близко стоящие термы запроса.
+"""
+
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from postings_codec import TF_TABLE, quantize_tfs, read_index, round_up_float32, write_index
+
+# Множитель ключа чанк * POSITION_SPAN + позиция: больше длины любого чанка в токенах
+POSITION_SPAN = 1 << 32
+
+
+def raw_idf(df: np.ndarray, total_docs: int) -> np.ndarray:
+    """IDF BM25Okapi без замены отрицательных значений"""
+    return np.log(total_docs - np.asarray(df) + 0.5) - np.log(np.asarray(df) + 0.5)
+
+
+def idf_floor_value(df: np.ndarray, total_docs: int, epsilon: float) -> float:
+    """Замена отрицательных IDF: epsilon * средний IDF по словарю (термам с df > 0)"""
+    df = np.asarray(df)
+    df = df[df > 0]
+    return float(epsilon * raw_idf(df, total_docs).mean()) if len(df) else 0.0
+
+
+class InvertedIndex:
+    def __init__(self, corpus: List[List[str]], k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25):
+        vocab: Dict[str, int] = {}
+        token_ids = [
+            np.array([vocab.setdefault(term, len(vocab)) for term in tokens], dtype=np.int64)
+            for tokens in corpus
+        ]
+        self._init(k1, b, epsilon)
+        self._build(token_ids, list(vocab))
+
+    @classmethod
+    def from_token_ids(cls, token_ids: List[np.ndarray], terms: List[str],
+                       k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25) -> "InvertedIndex":
+        """Индекс по массивам номеров термов (analyzer.TokenCache); terms - общий словарь.
+        В словарь индекса попадают только встретившиеся в корпусе термы"""
+        index = cls.__new__(cls)
+        index._init(k1, b, epsilon)
+        index._build(token_ids, terms)
+        return index
+
+    def _init(self, k1: float, b: float, epsilon: float) -> None:
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.vocab: Dict[str, int] = {}
+        self.store = None
+        self.meta: Dict = {}
+
+    def _build(self, token_ids: List[np.ndarray], terms: List[str]) -> None:
+        """Построение списков словопозиций и статистик BM25"""
+        self.corpus_size = len(token_ids)
+        doc_len = np.array([len(ids) for ids in token_ids], dtype=np.int32)
+        all_ids = np.concatenate(token_ids).astype(np.int64) if token_ids else np.zeros(0, dtype=np.int64)
+        doc_of_token = np.repeat(np.arange(self.corpus_size, dtype=np.int64), doc_len)
+
+        # Локальные номера термов в порядке общих номеров
+        used, local_ids = np.unique(all_ids, return_inverse=True)
+        self.vocab = {terms[term_id]: i for i, term_id in enumerate(used.tolist())}
+
+        # Пары (терм, чанк) в порядке сортировки и есть списки словопозиций
+        keys = local_ids * max(self.corpus_size, 1) + doc_of_token
+        pairs, tfs = np.unique(keys, return_counts=True)
+        # Позиции: устойчивая сортировка токенов по (терм, чанк) сохраняет их возрастание
+        doc_starts = np.concatenate([[0], np.cumsum(doc_len)[:-1]]).astype(np.int64)
+        token_pos = np.arange(len(all_ids), dtype=np.int64) - np.repeat(doc_starts, doc_len)
+        self.post_positions = token_pos[np.argsort(keys, kind="stable")].astype(np.int32)
+        self.pos_offsets = np.concatenate([[0], np.cumsum(tfs)]).astype(np.int64)
+        term_of_posting = pairs // max(self.corpus_size, 1)
+        self.post_docs = (pairs % max(self.corpus_size, 1)).astype(np.int32)
+        self.post_tfs = tfs.astype(np.int32)
+        df = np.bincount(term_of_posting, minlength=len(self.vocab))
+        self.offsets = np.concatenate([[0], np.cumsum(df)]).astype(np.int64)
+
+        self.doc_len = doc_len
+        self.set_collection_stats(df, self.corpus_size,
+                                  float(doc_len.sum()) / self.corpus_size if self.corpus_size else 0.0)
+
+    def set_collection_stats(self, df: np.ndarray, total_docs: int, avgdl: float,
+                             idf_floor: Optional[float] = None) -> None:
+        """Статистики коллекции для IDF и нормировки длины. Шард (sharded_index.py) получает
+        статистики всего корпуса, включая замену отрицательных IDF (idf_floor), посчитанную
+        по словарю всего корпуса, и его оценки совпадают с оценками единого индекса"""
+        self.df = np.asarray(df)
+        self.total_docs = total_docs
+        self.avgdl = avgdl
+        self.idf_floor = idf_floor_value(self.df, total_docs, self.epsilon) if idf_floor is None else idf_floor
+        self.doc_norm = self._doc_norm(self.doc_len)
+        self.idf = self._idf(self.df)
+        self.max_score = self._max_scores(self.post_tfs)
+
+    def _doc_norm(self, doc_len: np.ndarray) -> np.ndarray:
+        """Нормировка длины чанка: k1 * (1 - b + b * dl / avgdl)"""
+        if not self.avgdl:
+            return np.full(len(doc_len), self.k1, dtype=np.float64)
+        return self.k1 * (1 - self.b + self.b * doc_len / self.avgdl)
+
+    def _idf(self, df: np.ndarray) -> np.ndarray:
+        """IDF как в BM25Okapi: отрицательные значения заменяются на idf_floor"""
+        idf = raw_idf(df, self.total_docs)
+        idf[idf < 0] = self.idf_floor
+        return idf
+
+    def _max_scores(self, tfs: np.ndarray) -> np.ndarray:
+        """Верхняя граница вклада каждого терма по всем его словопозициям"""
+        if not len(self.post_docs):
+            return np.zeros(0)
+        term_of_posting = np.repeat(np.arange(len(self.vocab)), np.diff(self.offsets))
+        contrib = self.idf[term_of_posting] * self._tf_part(tfs, self.post_docs)
+        return np.maximum.reduceat(contrib, self.offsets[:-1])
+
+    def _tf_part(self, tfs: np.ndarray, docs: np.ndarray) -> np.ndarray:
+        return tfs * (self.k1 + 1) / (tfs + self.doc_norm[docs])
+
+    def postings(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Номера чанков и частоты терма"""
+        if self.store is not None:
+            return self.store.postings(term_id)
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        return self.post_docs[start:end], self.post_tfs[start:end]
+
+    def positions(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Позиции терма во всех его чанках подряд и границы чанков (в порядке postings())"""
+        if self.store is not None:
+            return self.store.positions(term_id)
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        bounds = self.pos_offsets[start:end + 1]
+        return self.post_positions[bounds[0]:bounds[-1]], bounds - bounds[0]
+
+    def _position_keys(self, term_id: int, shift: int = 0,
+                       candidates: Optional[np.ndarray] = None) -> np.ndarray:
+        """Отсортированные ключи чанк * POSITION_SPAN + позиция - shift (только для candidates)"""
+        docs, _ = self.postings(term_id)
+        positions, bounds = self.positions(term_id)
+        if candidates is None:
+            doc_of_position = np.repeat(docs.astype(np.int64), np.diff(bounds))
+            return doc_of_position * POSITION_SPAN + positions - shift
+        if not len(docs):
+            return np.zeros(0, dtype=np.int64)
+
+        # Чанки в postings отсортированы: словопозиции кандидатов находятся бинарным поиском,
+        # и позиции собираются только для них
+        idx = np.minimum(np.searchsorted(docs, candidates), len(docs) - 1)
+        found = idx[docs[idx] == candidates]
+        starts = bounds[found]
+        counts = bounds[found + 1] - starts
+        total = int(counts.sum())
+        # Номера позиций: начало словопозиции + сдвиг внутри нее
+        run_starts = np.cumsum(counts) - counts
+        index = np.repeat(starts - run_starts, counts) + np.arange(total)
+        doc_of_position = np.repeat(docs[found].astype(np.int64), counts)
+        return doc_of_position * POSITION_SPAN + positions[index] - shift
+
+    def phrase_docs(self, phrase: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Чанки с точным вхождением фразы (термы подряд) и число вхождений"""
+        term_ids = [self.vocab.get(term) for term in phrase]
+        if not term_ids or None in term_ids:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64)
+
+        # Кандидаты - пересечение чанков всех термов, начиная с самого редкого
+        order = sorted(range(len(term_ids)), key=lambda i: self.offsets[term_ids[i] + 1] - self.offsets[term_ids[i]])
+        candidates = self.postings(term_ids[order[0]])[0]
+        for i in order[1:]:
+            candidates = np.intersect1d(candidates, self.postings(term_ids[i])[0], assume_unique=True)
+            if not len(candidates):
+                return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64)
+
+        # Позиция начала фразы: позиция i-го терма минус i, общая для всех термов
+        starts = self._position_keys(term_ids[0], 0, candidates)
+        for i, term_id in enumerate(term_ids[1:], start=1):
+            starts = np.intersect1d(starts, self._position_keys(term_id, i, candidates))
+            if not len(starts):
+                return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64)
+
+        docs, counts = np.unique(starts // POSITION_SPAN, return_counts=True)
+        return docs.astype(np.int32), counts
+
+    def phrase_filter(self, phrases: List[List[str]]) -> Optional[np.ndarray]:
+        """Булева маска чанков, содержащих все фразы; None, если фраз нет или таких чанков нет"""
+        if not phrases:
+            return None
+        allowed = np.ones(self.corpus_size, dtype=bool)
+        for phrase in phrases:
+            mask = np.zeros(self.corpus_size, dtype=bool)
+            mask[self.phrase_docs(phrase)[0]] = True
+            allowed &= mask
+        return allowed if allowed.any() else None
+
+    def proximity_boost(self, top: List[Tuple[int, float]], pairs: List[Tuple[str, str]],
+                        window: int, weight: float) -> List[Tuple[int, float]]:
+        """Переранжирование кандидатов: за каждую пару термов запроса, стоящих в чанке
+        не дальше window токенов, добавляется weight * min(idf) * n / (n + 1),
+        где n - число таких сближений"""
+        slots: Dict[int, int] = {}
+        pair_slots = []
+        for term_a, term_b in pairs:
+            id_a, id_b = self.vocab.get(term_a), self.vocab.get(term_b)
+            if id_a is None or id_b is None or id_a == id_b:
+                continue
+            pair_slots.append((slots.setdefault(id_a, len(slots)), slots.setdefault(id_b, len(slots))))
+        if not top or not pair_slots:
+            return top
+
+        # Вес пары в симметричной матрице термов запроса
+        n_slots = len(slots)
+        slot_idf = self.idf[list(slots)]
+        pair_weight = np.zeros((n_slots, n_slots))
+        for slot_a, slot_b in pair_slots:
+            pair_weight[slot_a, slot_b] = pair_weight[slot_b, slot_a] = (
+                weight * min(slot_idf[slot_a], slot_idf[slot_b])
+            )
+
+        # Позиции всех термов запроса в кандидатах одним отсортированным массивом:
+        # вхождения на расстоянии <= window отстоят в нем не больше чем на window элементов
+        candidates = np.array(sorted(doc for doc, _ in top), dtype=np.int64)
+        keys = [self._position_keys(term_id, 0, candidates) for term_id in slots]
+        all_keys = np.concatenate(keys)
+        term_slot = np.repeat(np.arange(n_slots), [len(k) for k in keys])
+        order = np.argsort(all_keys, kind="stable")
+        all_keys, term_slot = all_keys[order], term_slot[order]
+
+        codes = []
+        for lag in range(1, window + 1):
+            near = np.flatnonzero(all_keys[lag:] - all_keys[:-lag] <= window)
+            if not len(near):
+                break
+            doc_index = np.searchsorted(candidates, all_keys[near] // POSITION_SPAN)
+            codes.append((doc_index * n_slots + term_slot[near]) * n_slots + term_slot[near + lag])
+        if not codes:
+            return top
+
+        # n по каждой паре (порядок термов в тексте не важен) и чанку
+        n = np.bincount(np.concatenate(codes), minlength=len(candidates) * n_slots * n_slots)
+        n = n.reshape(len(candidates), n_slots, n_slots)
+        n = n + n.transpose(0, 2, 1)
+        boost = (pair_weight * n / (n + 1)).sum(axis=(1, 2)) / 2
+
+        boost_by_doc = dict(zip(candidates.tolist(), boost.tolist()))
+        rescored = [(doc, score + boost_by_doc[doc]) for doc, score in top]
+        return sorted(rescored, key=lambda x: (-x[1], x[0]))
+
+    def _query_terms(self, query: Iterable[str]) -> List[Tuple[int, int]]:
+        """Известные индексу термы запроса с весом (числом повторов)"""
+        return [(self.vocab[t], w) for t, w in Counter(query).items() if t in self.vocab]
+
+    def term_idf(self, terms: Iterable[str]) -> Dict[str, float]:
+        """IDF известных индексу термов (для ранжирования отрывков в passages.py)"""
+        return {term: float(self.idf[self.vocab[term]]) for term in terms if term in self.vocab}
+
+    def get_scores(self, query: List[str]) -> np.ndarray:
+        """Полный расчет оценок всех чанков (совместим с BM25Okapi.get_scores)"""
+        scores = np.zeros(self.corpus_size)
+        for term_id, weight in self._query_terms(query):
+            docs, tfs = self.postings(term_id)
+            scores[docs] += weight * self.idf[term_id] * self._tf_part(tfs, docs)
+        return scores
+
+    def top_k(self, query: List[str], k: int, allowed: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """Top-k чанков по BM25 алгоритмом MaxScore. Возвращает пары (номер чанка, оценка).
+        allowed - булева маска чанков, среди которых идет поиск (None - все)"""
+        terms = self._query_terms(query)
+        if not terms or k <= 0:
+            return []
+
+        bounds = np.array([w * self.max_score[t] for t, w in terms])
+        order = np.argsort(-bounds, kind="stable")
+        terms = [terms[i] for i in order]
+        # remaining[i] - сумма верхних границ термов, начиная с i-го
+        remaining = np.concatenate([np.cumsum(bounds[order][::-1])[::-1], [0.0]])
+
+        cand_docs = np.zeros(0, dtype=np.int32)
+        cand_scores = np.zeros(0)
+        threshold = 0.0
+
+        for i, (term_id, weight) in enumerate(terms):
+            docs, tfs = self.postings(term_id)
+            if allowed is not None:
+                in_allowed = allowed[docs]
+                docs, tfs = docs[in_allowed], tfs[in_allowed]
+            coeff = weight * self.idf[term_id]
+
+            if len(cand_docs) < k or remaining[i] > threshold:
+                # Существенный терм: новый чанк еще может попасть в top-k
+                merged = np.concatenate([cand_docs, docs])
+                contrib = np.concatenate([cand_scores, coeff * self._tf_part(tfs, docs)])
+                cand_docs, inverse = np.unique(merged, return_inverse=True)
+                cand_scores = np.bincount(inverse, weights=contrib)
+            else:
+                # Несущественный терм: только дооценка уже найденных кандидатов
+                pos = np.searchsorted(docs, cand_docs)
+                pos[pos == len(docs)] = 0
+                hit = docs[pos] == cand_docs
+                cand_scores[hit] += coeff * self._tf_part(tfs[pos[hit]], cand_docs[hit])
+
+            if len(cand_docs) > k:
+                threshold = np.partition(cand_scores, -k)[-k]
+                keep = cand_scores + remaining[i + 1] >= threshold
+                cand_docs, cand_scores = cand_docs[keep], cand_scores[keep]
+
+        top = np.lexsort((cand_docs, -cand_scores))[:k]
+        return [(int(cand_docs[i]), float(cand_scores[i])) for i in top]
+
+    def save(self, path: str, meta: Optional[Dict] = None) -> None:
+        """Сохранение индекса в папку в сжатом формате (частоты квантуются)"""
+        quantized_tfs = TF_TABLE[quantize_tfs(self.post_tfs)]
+        write_index(
+            path,
+            {**(meta or {}), "k1": self.k1, "b": self.b, "epsilon": self.epsilon,
+             "corpus_size": self.corpus_size, "total_docs": self.total_docs, "avgdl": self.avgdl,
+             "idf_floor": self.idf_floor},
+            list(self.vocab),
+            {"doc_len": self.doc_len, "df": self.df.astype(np.int32),
+             "max_score": round_up_float32(self._max_scores(quantized_tfs))},
+            self.post_docs, self.post_tfs, self.offsets,
+            self.post_positions, self.pos_offsets
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "InvertedIndex":
+        """Загрузка сохраненного индекса; списки распаковываются по мере запросов"""
+        meta, vocab, arrays, store = read_index(path, ["doc_len", "df", "max_score"])
+        index = cls.__new__(cls)
+        index.k1, index.b, index.epsilon = meta["k1"], meta["b"], meta["epsilon"]
+        index.corpus_size, index.total_docs, index.avgdl = meta["corpus_size"], meta["total_docs"], meta["avgdl"]
+        index.meta = meta
+        index.vocab = {term: term_id for term_id, term in enumerate(vocab)}
+        index.store = store
+        index.offsets = store.offsets
+        index.doc_len = arrays["doc_len"]
+        index.df = arrays["df"]
+        # Индексы прежних версий без idf_floor: замена по собственному словарю, как раньше
+        index.idf_floor = meta.get("idf_floor")
+        if index.idf_floor is None:
+            index.idf_floor = idf_floor_value(index.df, index.total_docs, index.epsilon)
+        index.doc_norm = index._doc_norm(index.doc_len)
+        index.idf = index._idf(index.df)
+        index.max_score = arrays["max_score"]
+        return index
@@ -0,0 +1,152 @@
+"""Общий шлюз исходящих запросов к LLM.
+
+Все сессии Streamlit работают в одном процессе, и без шлюза каждая
+отправляла свой блокирующий запрос: одинаковые вопросы, заданные почти
+одновременно, уходили к провайдеру по нескольку раз, а число одновременных
+запросов ограничивалось только числом потоков.
+
+LLMGateway.call(key, request):
+- single-flight: пока выполняется запрос с тем же ключом, остальные вызовы
+  ждут его результата, а не отправляют запрос повторно. Ожидание ограничено
+  queue_timeout + request_timeout: зависший запрос не держит все одинаковые
+  вопросы. Ошибку ведущего запроса ведомые получают новым исключением
+  (LLMOverloaded или LLMRequestFailed) с исходным в __cause__;
+- допуск: одновременно выполняется не больше max_concurrent запросов,
+  остальные ждут в очереди не дольше queue_timeout. Если очередь
+  переполнена (max_queue) или ожидание истекло, запрос отклоняется
+  исключением LLMOverloaded, а не занимает поток до таймаута провайдера.
+
+Метрики (metrics.REGISTRY): этап llm_queue_wait (время ожидания в очереди),
+gauges llm_queue_depth и llm_in_flight, счетчики llm_coalesced и
+llm_shed{reason="queue_full|timeout|coalesced_timeout"}.
+
+Переменные окружения:
+    LLM_MAX_CONCURRENT - одновременных запросов к провайдеру (4)
+    LLM_MAX_QUEUE      - запросов, ожидающих в очереди (32)
+    LLM_QUEUE_TIMEOUT  - максимальное ожидание в очереди, с (10)
+    LLM_REQUEST_TIMEOUT - время запроса к провайдеру, которое ждут ведомые вызовы, с (60)
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from metrics import REGISTRY, record_stage
+
+LLM_MAX_CONCURRENT = int(os.environ.get("LLM_MAX_CONCURRENT", "4"))
+LLM_MAX_QUEUE = int(os.environ.get("LLM_MAX_QUEUE", "32"))
+LLM_QUEUE_TIMEOUT = float(os.environ.get("LLM_QUEUE_TIMEOUT", "10"))
+LLM_REQUEST_TIMEOUT = float(os.environ.get("LLM_REQUEST_TIMEOUT", "60"))
+
+
+class LLMOverloaded(RuntimeError):
+    """Запрос отклонен шлюзом: очередь переполнена или ожидание истекло"""
+
+
+class LLMRequestFailed(RuntimeError):
+    """Ведущий запрос, результата которого ждал вызов, завершился ошибкой"""
+
+
+def request_key(*parts: object) -> str:
+    """Ключ для объединения одинаковых запросов: хэш URL, модели, сообщений и параметров"""
+    data = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    """Выполняющийся запрос; ведомые вызовы ждут done"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[str] = None
+        self.error: Optional[BaseException] = None
+
+
+class LLMGateway:
+    def __init__(self, max_concurrent: int = LLM_MAX_CONCURRENT, max_queue: int = LLM_MAX_QUEUE,
+                 queue_timeout: float = LLM_QUEUE_TIMEOUT, request_timeout: float = LLM_REQUEST_TIMEOUT):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.request_timeout = request_timeout
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.lock = threading.Lock()
+        self.flights: Dict[str, _Flight] = {}
+        self.queued = 0
+        self.in_flight = 0
+
+    def call(self, key: str, request: Callable[[], str]) -> str:
+        """Результат request(); одинаковые по key одновременные вызовы выполняют его один раз"""
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+
+        if not leader:
+            REGISTRY.increment("llm_coalesced")
+            timeout = self.queue_timeout + self.request_timeout
+            if not flight.done.wait(timeout):
+                REGISTRY.increment("llm_shed", {"reason": "coalesced_timeout"})
+                raise LLMOverloaded(f"Ответ на такой же запрос к LLM не получен за {timeout:g} с")
+            # Исходное исключение принадлежит ведущему потоку: ведомые получают новое
+            if isinstance(flight.error, LLMOverloaded):
+                raise LLMOverloaded(str(flight.error)) from flight.error
+            if flight.error is not None:
+                raise LLMRequestFailed(f"{type(flight.error).__name__}: {flight.error}") from flight.error
+            return flight.result
+
+        try:
+            flight.result = self._admit(request)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result
+
+    def _admit(self, request: Callable[[], str]) -> str:
+        """Выполнение request() в одном из max_concurrent слотов"""
+        wait = 0.0
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                if self.queued >= self.max_queue:
+                    REGISTRY.increment("llm_shed", {"reason": "queue_full"})
+                    raise LLMOverloaded("Очередь запросов к LLM переполнена")
+                self.queued += 1
+                self._update_gauges()
+
+            start = time.perf_counter()
+            acquired = self.slots.acquire(timeout=self.queue_timeout)
+            wait = time.perf_counter() - start
+            with self.lock:
+                self.queued -= 1
+                self._update_gauges()
+            if not acquired:
+                record_stage("llm_queue_wait", wait)
+                REGISTRY.increment("llm_shed", {"reason": "timeout"})
+                raise LLMOverloaded(f"Ожидание в очереди к LLM превысило {self.queue_timeout:g} с")
+        record_stage("llm_queue_wait", wait)
+
+        with self.lock:
+            self.in_flight += 1
+            self._update_gauges()
+        try:
+            return request()
+        finally:
+            self.slots.release()
+            with self.lock:
+                self.in_flight -= 1
+                self._update_gauges()
+
+    def _update_gauges(self) -> None:
+        REGISTRY.set_gauge("llm_queue_depth", self.queued)
+        REGISTRY.set_gauge("llm_in_flight", self.in_flight)
+
+
+LLM_GATEWAY = LLMGateway()
@@ -0,0 +1,332 @@
+"""Нагрузочный прогон main.py: одновременные пользователи против фейкового LLM.
+
+Каждый пользователь - поток со своим состоянием сессии (словарь с ключами
+st.session_state). Он загружает документ из папки documents и задает
+вопросы через те же функции, что и main(): file_to_text, process_document,
+answer_question (поиск, отрывки, кэш вопросов, запрос к LLM через
+LLM_GATEWAY). Streamlit AppTest для этого не подходит: он не умеет
+загружать файлы через st.file_uploader, а параллельные AppTest в одном
+процессе блокируют друг друга. Отрисовка интерфейса поэтому не измеряется.
+
+Нагрузка растет ступенями (--users 1,2,4,8,16). На каждой ступени кэш вопросов
+очищается, шлюз к LLM создается заново, и каждый пользователь делает загрузку
+и --questions вопросов с паузой --think-time. По ступени выводятся:
+пропускная способность (отвеченных вопросов/с), перцентили задержки отвеченного
+вопроса и загрузки,
+медианы этапов (llm, llm_queue_wait, scoring, ...), доли ответов из кэша,
+отклонений шлюзом и ошибок, число запросов к LLM и пиковый RSS процесса.
+
+Память на сессию меряется отдельно до ступеней (tracemalloc замедляет
+аллокации и исказил бы задержки): MEMORY_SESSIONS сессий делают загрузку
+и один вопрос, рост Python-аллокаций, удерживаемых после этого, делится
+на число сессий. Общие индексы загружаются заранее и в оценку не входят.
+
+Насыщение - первая ступень, на которой пропускная способность выросла меньше
+чем на SATURATION_GAIN при росте числа пользователей, или появились
+отклонения и ошибки. Сервер с такими настройками выдерживает предыдущую ступень.
+
+Пример:
+    python loadtest.py --users 1,2,4,8,16 --questions 5 --llm-latency 0.5
+    python loadtest.py --users 4,16,64 --llm-concurrency 8 --output data/load.json
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import main as app
+from benchmark import BENCHMARK_QUERIES, percentiles
+from conversation_memory import ConversationMemory
+from fake_llm import start_server
+from llm_gateway import LLM_MAX_CONCURRENT, LLM_MAX_QUEUE, LLM_QUEUE_TIMEOUT, LLMGateway, LLMOverloaded
+from metrics import finish_trace, start_trace
+from query_cache import QUERY_CACHE
+
+DEFAULT_USERS = "1,2,4,8,16"
+DEFAULT_QUESTIONS = 5
+DEFAULT_LLM_LATENCY = 0.5
+# Размер загружаемого документа: пользователи загружают договоры и письма, а не кодексы
+DEFAULT_UPLOAD_KB = 100
+MEMORY_SESSIONS = 4
+SATURATION_GAIN = 0.1
+REPORT_STAGES = ("llm", "llm_queue_wait", "keywords", "scoring", "proximity", "passages")
+SEED = 42
+
+
+class UploadedDocument(io.BytesIO):
+    """Документ в виде объекта st.file_uploader: name и getvalue()"""
+
+    def __init__(self, name: str, data: bytes):
+        super().__init__(data)
+        self.name = name
+
+
+def load_uploads(docs_dir: str, max_kb: int) -> List[UploadedDocument]:
+    """Документы папки в UTF-8 (как их загрузил бы пользователь), не длиннее max_kb"""
+    uploads = []
+    for filename in sorted(os.listdir(docs_dir)):
+        if not filename.endswith(".txt"):
+            continue
+        text = app.read_text_file(os.path.join(docs_dir, filename))
+        data = text.encode("utf-8")[:max_kb * 1024].decode("utf-8", errors="ignore").encode("utf-8")
+        uploads.append(UploadedDocument(filename, data))
+    return uploads
+
+
+def new_session() -> Dict:
+    """Состояние сессии, как st.session_state после initialize_session()"""
+    return {
+        "document_text": "",
+        "document_keywords": [],
+        "document_relevant_chunks": [],
+        "document_passages": [],
+        "query_relevant_chunks": [],
+        "chat_memory": ConversationMemory(token_budget=app.CHAT_LOG_TOKEN_BUDGET),
+        "last_timings": {},
+    }
+
+
+def upload(session: Dict, document: UploadedDocument) -> None:
+    """Загрузка документа, как ветка st.file_uploader в main()"""
+    start_trace()
+    try:
+        file_text = app.file_to_text(UploadedDocument(document.name, document.getvalue()))
+        if not file_text:
+            raise ValueError(f"Не удалось прочитать {document.name}")
+        result = app.process_document(session, file_text)
+        if result["error"] is not None:
+            raise ValueError(result["error"] or "Не удалось создать поисковый индекс")
+    finally:
+        session["last_timings"] = finish_trace()
+
+
+def ask(session: Dict, question: str, llm_url: str) -> str:
+    """Вопрос, как кнопка "Отправить" в main(); возвращает исход: answered, cached, shed, error"""
+    start_trace()
+    try:
+        result = app.answer_question(session, question, llm_url)
+        if result["error"]:
+            return "error"
+        return "cached" if result["cached_question"] else "answered"
+    except LLMOverloaded:
+        return "shed"
+    except Exception:
+        return "error"
+    finally:
+        session["last_timings"] = finish_trace()
+
+
+def run_user(user: int, documents: List[UploadedDocument], questions: List[str], count: int,
+             think_time: float, llm_url: str, start: threading.Event, records: List[Dict],
+             lock: threading.Lock) -> None:
+    """Один пользователь: загрузка документа и count вопросов"""
+    rng = random.Random(SEED + user)
+    session = new_session()
+    start.wait()
+
+    began = time.perf_counter()
+    try:
+        upload(session, documents[user % len(documents)])
+        outcome = "uploaded"
+    except Exception:
+        outcome = "error"
+    with lock:
+        records.append({"kind": "upload", "outcome": outcome, "seconds": time.perf_counter() - began,
+                        "timings": session["last_timings"]})
+
+    for _ in range(count):
+        if think_time:
+            time.sleep(rng.uniform(0, 2 * think_time))
+        began = time.perf_counter()
+        outcome = ask(session, rng.choice(questions), llm_url)
+        with lock:
+            records.append({"kind": "question", "outcome": outcome, "seconds": time.perf_counter() - began,
+                            "timings": session["last_timings"]})
+
+
+def run_step(users: int, documents: List[UploadedDocument], questions: List[str], count: int,
+             think_time: float, llm_url: str, server, gateway_args: Dict) -> Dict:
+    """Одна ступень нагрузки: users пользователей одновременно"""
+    QUERY_CACHE.clear()
+    app.LLM_GATEWAY = LLMGateway(**gateway_args)
+    llm_requests = server.request_count if server else 0
+
+    records: List[Dict] = []
+    lock = threading.Lock()
+    start = threading.Event()
+    threads = [
+        threading.Thread(target=run_user, args=(
+            user, documents, questions, count, think_time, llm_url, start, records, lock
+        ))
+        for user in range(users)
+    ]
+    for thread in threads:
+        thread.start()
+    began = time.perf_counter()
+    start.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+
+    asked = [r for r in records if r["kind"] == "question"]
+    uploads = [r for r in records if r["kind"] == "upload"]
+    outcomes = {outcome: sum(r["outcome"] == outcome for r in asked)
+                for outcome in ("answered", "cached", "shed", "error")}
+    # Задержка - только отвеченных вопросов: быстрые отказы шлюза занизили бы перцентили
+    served = [r for r in asked if r["outcome"] in ("answered", "cached")]
+    stages = {}
+    for stage in REPORT_STAGES:
+        values = [r["timings"][stage] for r in served if stage in r["timings"]]
+        if values:
+            stages[stage] = round(float(np.median(values)), 3)
+
+    return {
+        "users": users,
+        "seconds": round(elapsed, 3),
+        "questions": len(asked),
+        "throughput_qps": round(len(served) / elapsed, 3) if elapsed else 0.0,
+        "question_latency_ms": percentiles([r["seconds"] for r in served]) if served else {},
+        "upload_latency_ms": percentiles([r["seconds"] for r in uploads]) if uploads else {},
+        "stage_median_ms": stages,
+        "outcomes": outcomes,
+        "upload_errors": sum(r["outcome"] == "error" for r in uploads),
+        "llm_requests": server.request_count - llm_requests if server else None,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def session_memory_mb(documents: List[UploadedDocument], questions: List[str], llm_url: str,
+                      sessions: int = MEMORY_SESSIONS) -> float:
+    """Память, удерживаемая одной сессией после загрузки документа и одного вопроса"""
+    QUERY_CACHE.clear()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        kept = []
+        for user in range(sessions):
+            session = new_session()
+            upload(session, documents[user % len(documents)])
+            ask(session, questions[user % len(questions)], llm_url)
+            kept.append(session)
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return round((after - before) / sessions / 1024 / 1024, 3)
+
+
+def find_saturation(steps: List[Dict], gain: float = SATURATION_GAIN) -> Optional[int]:
+    """Число пользователей первой ступени, где рост пропускной способности < gain
+    или появились отклонения шлюзом и ошибки"""
+    previous = None
+    for step in steps:
+        failures = step["outcomes"]["shed"] + step["outcomes"]["error"] + step["upload_errors"]
+        if failures:
+            return step["users"]
+        if previous and step["throughput_qps"] < previous["throughput_qps"] * (1 + gain):
+            return step["users"]
+        previous = step
+    return None
+
+
+def print_report(results: Dict) -> None:
+    print(f"Память на сессию: {results['session_memory_mb']} МБ", file=sys.stderr)
+    for step in results["steps"]:
+        latency = step["question_latency_ms"]
+        outcomes = step["outcomes"]
+        print(
+            f"[{step['users']} польз.] {step['throughput_qps']} вопр/с, "
+            f"p50={latency.get('p50')} p95={latency.get('p95')} p99={latency.get('p99')} мс, "
+            f"кэш: {outcomes['cached']}, отклонено: {outcomes['shed']}, ошибок: {outcomes['error']}, "
+            f"запросов к LLM: {step['llm_requests']}, RSS: {step['peak_rss_mb']} МБ",
+            file=sys.stderr
+        )
+        stages = ", ".join(f"{stage}={ms}" for stage, ms in step["stage_median_ms"].items())
+        print(f"    этапы (медиана, мс): {stages}", file=sys.stderr)
+    saturation = results["saturation_users"]
+    if saturation is None:
+        print("Насыщение не достигнуто", file=sys.stderr)
+    else:
+        print(f"Насыщение при {saturation} пользователях", file=sys.stderr)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон main.py с фейковым LLM")
+    parser.add_argument("--users", default=DEFAULT_USERS, help="ступени числа пользователей через запятую")
+    parser.add_argument("--questions", type=int, default=DEFAULT_QUESTIONS, help="вопросов на пользователя")
+    parser.add_argument("--think-time", type=float, default=0.0, help="средняя пауза перед вопросом, с")
+    parser.add_argument("--docs-dir", default=app.DOCUMENTS_DIR, help="папка с загружаемыми .txt документами")
+    parser.add_argument("--upload-kb", type=int, default=DEFAULT_UPLOAD_KB, help="размер загружаемого документа, КБ")
+    parser.add_argument("--llm-url", help="эндпоинт chat/completions (по умолчанию локальный фейковый)")
+    parser.add_argument("--llm-latency", type=float, default=DEFAULT_LLM_LATENCY, help="задержка фейкового LLM, с")
+    parser.add_argument("--llm-jitter", type=float, default=0.0, help="случайная добавка к задержке, с")
+    parser.add_argument("--llm-concurrency", type=int, default=LLM_MAX_CONCURRENT, help="LLM_MAX_CONCURRENT шлюза")
+    parser.add_argument("--llm-queue", type=int, default=LLM_MAX_QUEUE, help="LLM_MAX_QUEUE шлюза")
+    parser.add_argument("--queue-timeout", type=float, default=LLM_QUEUE_TIMEOUT, help="LLM_QUEUE_TIMEOUT шлюза, с")
+    parser.add_argument("--output", help="файл для JSON-результатов (по умолчанию stdout)")
+    args = parser.parse_args(argv)
+
+    documents = load_uploads(args.docs_dir, args.upload_kb)
+    if not documents:
+        print(f"В папке {args.docs_dir} нет .txt документов", file=sys.stderr)
+        return 1
+    index, _ = app.create_search_index()
+    if index is None:
+        print("Не удалось построить поисковый индекс", file=sys.stderr)
+        return 1
+
+    server, llm_url = None, args.llm_url
+    if not llm_url:
+        server, llm_url = start_server(latency=args.llm_latency, jitter=args.llm_jitter)
+    gateway_args = {"max_concurrent": args.llm_concurrency, "max_queue": args.llm_queue,
+                    "queue_timeout": args.queue_timeout}
+    questions = list(BENCHMARK_QUERIES)
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "llm_url": llm_url,
+            "llm_latency": args.llm_latency,
+            "questions_per_user": args.questions,
+            "think_time": args.think_time,
+            "upload_kb": args.upload_kb,
+            "gateway": gateway_args,
+            "backend": app.SEARCH_BACKEND,
+        },
+        "steps": [],
+    }
+    try:
+        app.LLM_GATEWAY = LLMGateway(**gateway_args)
+        print("⏳ память сессии...", file=sys.stderr)
+        results["session_memory_mb"] = session_memory_mb(documents, questions, llm_url)
+        for users in [int(u) for u in args.users.split(",") if u.strip()]:
+            print(f"⏳ {users} польз...", file=sys.stderr)
+            results["steps"].append(run_step(
+                users, documents, questions, args.questions, args.think_time, llm_url, server, gateway_args
+            ))
+    finally:
+        if server:
+            server.shutdown()
+    results["saturation_users"] = find_saturation(results["steps"])
+
+    print_report(results)
+    payload = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(payload)
+    else:
+        print(payload)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,37 +1,72 @@
 import os
 import re
+import json
 import time
-import chardet
 import requests
-import numpy as np
 import streamlit as st
-from docx import Document
-from PyPDF2 import PdfReader
-from typing import List, Optional
-from rank_bm25 import BM25Okapi
+from typing import Dict, List, Optional
 from config import API_KEY, API_URL
+from analyzer import TOKEN_CACHE, TokenCache, russian_words, tokenize
+from conversation_memory import ConversationMemory
+from dedup import DEDUP_THRESHOLD, deduplicate_chunks
+from dense_index import HAS_SKLEARN, DenseIndex, reciprocal_rank_fusion
+from fts_index import FTSChunks, FTSIndex
+from inverted_index import InvertedIndex
+from llm_gateway import LLM_GATEWAY, LLMOverloaded, request_key
+from metrics import REGISTRY, finish_trace, start_metrics_server, start_trace, timed_stage
+from passages import Passage, PassageRanker, highlight_markdown, passages_text
+from profiling import PROFILE_ENABLED, profile_request
+from query_cache import NEGATION_WORDS, QUERY_CACHE, STOP_WORDS, context_key
+from sharded_index import ShardedIndex, build_shards, read_shards_meta
+from warmup import WARM_CACHE
 
 # Конфигурация приложения
 SYSTEM_PROMPT = "Ты юрист-консультант. Отвечай доброжелательно и структурированно. Запрещено выдумывать законы и судебные решения. Оперируй только известной информацией из контекста USER_CONTEXT."
 API_TIMEOUT = 60
+LLM_MODEL = "google/gemini-2.0-flash-lite-001"
 CHUNK_SIZE = 10000
 CHUNK_OVERLAP = 1000
+DOCUMENTS_DIR = "documents"
+INDEX_DIR = os.path.join("data", "bm25_index")
+TOP_K = 5
+# "memory" - InvertedIndex в памяти процесса, "fts" - SQLite FTS5 (fts_index.py) в FTS_PATH;
+# с FTS корпус не загружается в память, поэтому векторный этап и шарды не используются
+SEARCH_BACKEND = os.environ.get("TALK2JSON_BACKEND", "memory")
+FTS_PATH = os.path.join("data", "chunks.sqlite")
+HYBRID_SEARCH = os.environ.get("TALK2JSON_HYBRID") == "1" and HAS_SKLEARN and SEARCH_BACKEND != "fts"
+HYBRID_DEPTH = 4
+SHARD_COUNT = int(os.environ.get("TALK2JSON_SHARDS", "1")) if SEARCH_BACKEND != "fts" else 1
+SHARDS_DIR = os.path.join(INDEX_DIR, "shards")
+RERANK_DEPTH = 2
+PROXIMITY_WINDOW = 4
+PROXIMITY_WEIGHT = 1.0
+PROXIMITY_MIN_LENGTH = 3
+# Отрицания нужны ключу кэша ответов, но не поиску по чанкам
+SEARCH_STOP_WORDS = STOP_WORDS | NEGATION_WORDS
+PHRASE_PATTERN = re.compile(r'"([^"]+)"|«([^»]+)»')
+# Вместо целых чанков в промпт и интерфейс идут лучшие отрывки из них (passages.py)
+PASSAGE_MODE = os.environ.get("TALK2JSON_PASSAGES", "1") == "1"
+# Лог диалога только показывается (в промпт не входит), поэтому бюджет больше, чем у бота
+CHAT_LOG_TOKEN_BUDGET = 2000
 
 def initialize_session():
     required_keys = {
-        "chat_log": "",
         "user_input": "",
         "document_text": "",
         "document_keywords": [],
         "document_relevant_chunks": [],
+        "document_passages": [],
         "query_keywords": [],
-        "query_relevant_chunks": []
+        "query_relevant_chunks": [],
+        "last_timings": {},
+        "last_profile": {}
     }
     for key in required_keys:
         if key not in st.session_state:
             st.session_state[key] = required_keys[key]
-
-initialize_session()
+    # Лог диалога ограничен: последние реплики дословно, более ранние - в резюме
+    if "chat_memory" not in st.session_state:
+        st.session_state.chat_memory = ConversationMemory(token_budget=CHAT_LOG_TOKEN_BUDGET)
 
 def process_text(text: str) -> List[str]:
     """Разделение текста на чанки с перекрытием"""
@@ -45,32 +80,98 @@ def process_text(text: str) -> List[str]:
 
 def detect_file_encoding(file_path: str) -> str:
     """Определение кодировки файла"""
+    import chardet  # импорт по требованию: нужен только при построении индекса
+
     with open(file_path, 'rb') as f:
         raw_data = f.read(10000)
     return chardet.detect(raw_data)['encoding']
 
-def create_bm25_index():
-    """Создание BM25 индекса на основе документов в папке"""
+def corpus_fingerprint(docs_dir: str, txt_files: List[str], dedup_threshold: Optional[float] = DEDUP_THRESHOLD) -> Dict:
+    """Отпечаток корпуса и параметров разбиения для проверки актуальности сохраненного индекса"""
+    files = []
+    for filename in sorted(txt_files):
+        stat = os.stat(os.path.join(docs_dir, filename))
+        files.append([filename, stat.st_size, stat.st_mtime_ns])
+    return {"files": files, "chunk_size": CHUNK_SIZE, "chunk_overlap": CHUNK_OVERLAP,
+            "dedup_threshold": dedup_threshold, "tokenizer": "analyzer"}
+
+def read_text_file(file_path: str) -> str:
+    """Текст документа из папки корпуса с определением кодировки"""
+    with timed_stage("decode"):
+        encoding = detect_file_encoding(file_path)
+        with open(file_path, 'r', encoding=encoding, errors='replace') as f:
+            return f.read()
+
+def load_saved_index(index_dir: str, fingerprint: Dict):
+    """Загрузка сохраненного индекса, если он построен по тем же документам"""
+    try:
+        with timed_stage("index_load"):
+            bm25 = InvertedIndex.load(index_dir)
+            if bm25.meta.get("fingerprint") != fingerprint:
+                return None, None
+            with open(os.path.join(index_dir, "chunks.json"), 'r', encoding='utf-8') as f:
+                return bm25, json.load(f)
+    except (OSError, ValueError, KeyError):
+        return None, None
+
+def save_index(index_dir: str, bm25: InvertedIndex, chunks: List[str], fingerprint: Dict) -> None:
+    """Сохранение индекса и текстов чанков для быстрого холодного старта"""
+    try:
+        with timed_stage("index_save"):
+            os.makedirs(index_dir, exist_ok=True)
+            # Без meta.json индекс не загружается, пока чанки и индекс не записаны целиком
+            meta_path = os.path.join(index_dir, "meta.json")
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+            chunks_path = os.path.join(index_dir, "chunks.json")
+            with open(chunks_path + ".tmp", 'w', encoding='utf-8') as f:
+                json.dump(chunks, f, ensure_ascii=False)
+            os.replace(chunks_path + ".tmp", chunks_path)
+            bm25.save(index_dir, {**bm25.meta, "fingerprint": fingerprint})
+    except OSError as e:
+        st.warning(f"Не удалось сохранить индекс: {str(e)}")
+
+def create_bm25_index(docs_dir: str = DOCUMENTS_DIR, index_dir: Optional[str] = INDEX_DIR,
+                      dedup_threshold: Optional[float] = DEDUP_THRESHOLD,
+                      token_cache: Optional[TokenCache] = None):
+    """Создание BM25 индекса на основе документов в папке (или загрузка сохраненного).
+    Почти-дубликаты чанков схлопываются, источники копий сохраняются в bm25.meta["sources"]
+    (dedup_threshold=None отключает схлопывание). Сохраняемый индекс (index_dir задан)
+    держится в WARM_CACHE процесса и не загружается заново при перезапусках скрипта.
+    token_cache - кэш токенов (по умолчанию общий TOKEN_CACHE); на диск он пишется
+    только вместе с индексом"""
+    if token_cache is None:
+        token_cache = TOKEN_CACHE
     all_chunks = []
-    original_texts = []
+    sources = []
     
     try:
-        if not os.path.exists("documents"):
-            os.makedirs("documents")
+        if not os.path.exists(docs_dir):
+            os.makedirs(docs_dir)
 
-        txt_files = [f for f in os.listdir("documents") if f.endswith(".txt")]
+        txt_files = [f for f in os.listdir(docs_dir) if f.endswith(".txt")]
         if not txt_files:
             return None, None
 
+        fingerprint = corpus_fingerprint(docs_dir, txt_files, dedup_threshold)
+        cache_key = json.dumps([index_dir, fingerprint], sort_keys=True)
+        if index_dir:
+            cached = WARM_CACHE.get("bm25", cache_key)
+            if cached is not None:
+                return cached
+            bm25, chunks = load_saved_index(index_dir, fingerprint)
+            if bm25 is not None:
+                WARM_CACHE.put("bm25", cache_key, (bm25, chunks))
+                return bm25, chunks
+
         for filename in txt_files:
-            file_path = os.path.join("documents", filename)
+            file_path = os.path.join(docs_dir, filename)
             try:
-                encoding = detect_file_encoding(file_path)
-                with open(file_path, 'r', encoding=encoding, errors='replace') as f:
-                    text = f.read()
-                chunks = process_text(text)
+                text = read_text_file(file_path)
+                with timed_stage("chunking"):
+                    chunks = process_text(text)
                 all_chunks.extend(chunks)
-                original_texts.extend(chunks)
+                sources.extend([filename, i] for i in range(len(chunks)))
             except Exception as e:
                 st.error(f"Ошибка чтения {filename}: {str(e)}")
                 continue
@@ -78,26 +179,172 @@ def create_bm25_index():
         if not all_chunks:
             return None, None
 
-        tokenized_chunks = [doc.split() for doc in all_chunks]
-        return BM25Okapi(tokenized_chunks, k1=1.8, b=0.75), original_texts
+        if dedup_threshold is not None:
+            with timed_stage("dedup"):
+                original_texts, sources = deduplicate_chunks(all_chunks, sources, dedup_threshold)
+        else:
+            original_texts, sources = all_chunks, [[source] for source in sources]
+
+        # Токенизация через общий кэш анализатора: повторная сборка не токенизирует чанки заново
+        with timed_stage("tokenize"):
+            token_ids = token_cache.encode_many(original_texts)
+            if index_dir:
+                token_cache.save()
+        with timed_stage("index_build"):
+            bm25 = InvertedIndex.from_token_ids(token_ids, token_cache.terms, k1=1.8, b=0.75)
+        bm25.meta.update({"fingerprint": fingerprint, "sources": sources})
+        if index_dir:
+            save_index(index_dir, bm25, original_texts, fingerprint)
+            WARM_CACHE.put("bm25", cache_key, (bm25, original_texts))
+        return bm25, original_texts
+
+    except Exception as e:
+        st.error(f"Ошибка создания индекса: {str(e)}")
+        return None, None
+
+def create_fts_index(docs_dir: str = DOCUMENTS_DIR, path: str = FTS_PATH):
+    """Индекс SQLite FTS5 по документам папки. Изменившиеся, новые и удаленные файлы
+    синхронизируются инкрементально (по одной транзакции на файл), остальные не
+    перечитываются. Возвращает индекс и тексты чанков по номерам (FTSChunks)"""
+    try:
+        if not os.path.exists(docs_dir):
+            os.makedirs(docs_dir)
+        txt_files = [f for f in os.listdir(docs_dir) if f.endswith(".txt")]
+
+        index = WARM_CACHE.get("fts", path)
+        if index is None:
+            with timed_stage("index_load"):
+                index = FTSIndex(path)
+            WARM_CACHE.put("fts", path, index)
+
+        current = {
+            filename: json.dumps([size, mtime, CHUNK_SIZE, CHUNK_OVERLAP])
+            for filename, size, mtime in corpus_fingerprint(docs_dir, txt_files, None)["files"]
+        }
+        stored = index.source_fingerprints()
+        for filename in stored.keys() - current.keys():
+            with timed_stage("index_update"):
+                index.remove_source(filename)
+        for filename, fingerprint in current.items():
+            if stored.get(filename) == fingerprint:
+                continue
+            try:
+                text = read_text_file(os.path.join(docs_dir, filename))
+                with timed_stage("chunking"):
+                    chunks = process_text(text)
+                with timed_stage("index_update"):
+                    index.replace_source(filename, fingerprint, [{"chunk_text": chunk} for chunk in chunks])
+            except Exception as e:
+                st.error(f"Ошибка чтения {filename}: {str(e)}")
+
+        index.meta["fingerprint"] = {"backend": "fts", "files": sorted(current.items())}
+        if not len(index):
+            return None, None
+        return index, FTSChunks(index)
 
     except Exception as e:
         st.error(f"Ошибка создания индекса: {str(e)}")
         return None, None
 
+def create_search_index():
+    """Индекс выбранного бэкенда (SEARCH_BACKEND) и тексты чанков по номерам"""
+    if SEARCH_BACKEND == "fts":
+        return create_fts_index()
+    return create_bm25_index()
+
+def create_dense_index(chunks: List[str], index_dir: Optional[str] = INDEX_DIR) -> Optional[DenseIndex]:
+    """Векторный (LSA) индекс чанков для гибридного поиска (или загрузка сохраненного)"""
+    try:
+        if index_dir:
+            # Список чанков из WARM_CACHE один на процесс: ключ по его идентичности
+            cached = WARM_CACHE.get("dense", index_dir)
+            if cached is not None and cached[0] is chunks:
+                return cached[1]
+            with timed_stage("index_load"):
+                dense = DenseIndex.load(index_dir, chunks)
+            if dense is not None:
+                WARM_CACHE.put("dense", index_dir, (chunks, dense))
+                return dense
+
+        with timed_stage("embedding"):
+            dense = DenseIndex(chunks)
+        if index_dir:
+            with timed_stage("index_save"):
+                dense.save(index_dir)
+            WARM_CACHE.put("dense", index_dir, (chunks, dense))
+        return dense
+
+    except Exception as e:
+        st.warning(f"Векторный поиск недоступен: {str(e)}")
+        return None
+
+def create_sharded_index(chunks: List[str], fingerprint: Dict, shards_dir: str = SHARDS_DIR,
+                         n_shards: int = SHARD_COUNT) -> Optional[ShardedIndex]:
+    """Шардированный индекс тех же чанков: top-k считается параллельно в рабочих процессах"""
+    try:
+        saved = read_shards_meta(shards_dir)
+        # Шарды без idf_floor построены прежней версией с IDF по словарю шарда
+        if (saved is None or saved.get("fingerprint") != fingerprint or saved.get("shards") != n_shards
+                or "idf_floor" not in saved):
+            with timed_stage("tokenize"):
+                token_ids = TOKEN_CACHE.encode_many(chunks)
+            with timed_stage("index_build"):
+                build_shards(token_ids, TOKEN_CACHE.terms, n_shards, shards_dir, k1=1.8, b=0.75,
+                             meta={"fingerprint": fingerprint, "shards": n_shards})
+        # Рабочие процессы шардов живут в WARM_CACHE и переживают перезапуски скрипта
+        cache_key = json.dumps([shards_dir, fingerprint, n_shards], sort_keys=True)
+        sharded = WARM_CACHE.get("shards", cache_key)
+        if sharded is not None and not sharded.alive:
+            # Процесс шарда завершился: индекс останавливается и запускается заново
+            sharded.close()
+            WARM_CACHE.discard("shards", sharded)
+            sharded = None
+        if sharded is None:
+            with timed_stage("index_load"):
+                sharded = ShardedIndex(shards_dir)
+            previous = WARM_CACHE.put("shards", cache_key, sharded)
+            if previous is not None:
+                previous.close()
+        return sharded
+
+    except (OSError, ValueError, RuntimeError) as e:
+        st.warning(f"Шардированный поиск недоступен: {str(e)}")
+        return None
+
+def chunk_sources(index, original_chunks, chunks: List[str]) -> List[Optional[List[List]]]:
+    """Источники найденных чанков: [файл, номер чанка] каждой копии"""
+    if isinstance(index, FTSIndex):
+        return index.sources_for(chunks)
+    sources = dict(zip(original_chunks, index.meta.get("sources", [])))
+    return [sources.get(chunk) for chunk in chunks]
+
+def format_sources(sources: List[List]) -> str:
+    """Подпись фрагмента: файл-источник и число одинаковых фрагментов в других местах"""
+    if not sources:
+        return ""
+    filename, _ = sources[0]
+    label = os.path.splitext(filename)[0]
+    if len(sources) > 1:
+        label += f", еще копий: {len(sources) - 1}"
+    return f" ({label})"
+
 def file_to_text(uploaded_file) -> Optional[str]:
     """Конвертация файла в текст"""
     try:
-        if uploaded_file.name.endswith('.txt'):
-            return uploaded_file.getvalue().decode("utf-8")
-        
-        elif uploaded_file.name.endswith('.docx'):
-            doc = Document(uploaded_file)
-            return "\n".join([para.text for para in doc.paragraphs])
-        
-        elif uploaded_file.name.endswith('.pdf'):
-            reader = PdfReader(uploaded_file)
-            return "\n".join([page.extract_text() for page in reader.pages])
+        with timed_stage("decode"):
+            if uploaded_file.name.endswith('.txt'):
+                return uploaded_file.getvalue().decode("utf-8")
+
+            # Библиотеки форматов импортируются при первом файле своего типа
+            elif uploaded_file.name.endswith('.docx'):
+                from docx import Document
+                doc = Document(uploaded_file)
+                return "\n".join([para.text for para in doc.paragraphs])
+
+            elif uploaded_file.name.endswith('.pdf'):
+                from PyPDF2 import PdfReader
+                reader = PdfReader(uploaded_file)
+                return "\n".join([page.extract_text() for page in reader.pages])
         
     except Exception as e:
         st.error(f"Ошибка обработки файла: {str(e)}")
@@ -109,166 +356,407 @@ def clean_keyword(word: str) -> str:
         word = word[:-1]
     return word
 
-def extract_keywords(text: str, bm25: BM25Okapi) -> List[str]:
+def extract_keywords(text: str, bm25: InvertedIndex) -> List[str]:
     """Извлечение ключевых слов с учетом BM25"""
     try:
-        words = re.findall(r'\b[а-яё]+\b', text.lower())
-        stop_words = {"на", "под", "в", "среди", "перед", "затем", "после", "до", "сразу"}
+        with timed_stage("keywords"):
+            # Один проход по тексту: слова только из русских букв, поэтому цифр в них нет
+            words = russian_words(text)
+            stop_words = {"на", "под", "в", "среди", "перед", "затем", "после", "до", "сразу"}
         
-        filtered = [
-            word for word in words
-            if len(word) >= 5 
-            and word not in stop_words
-            and not re.search(r'\d', word)
-        ]
+            filtered = [
+                word for word in words
+                if len(word) >= 5 
+                and word not in stop_words
+            ]
 
-        scores = bm25.get_scores(filtered)
-        scored_words = sorted(zip(filtered, scores), key=lambda x: x[1], reverse=True)
+            if isinstance(bm25, FTSIndex):
+                # IDF слов из fts5vocab: MATCH по всем словам загруженного документа
+                # оценивал бы все чанки базы
+                idf = bm25.term_idf(filtered)
+                scores = [idf.get(word, 0.0) for word in filtered]
+            else:
+                scores = bm25.get_scores(filtered)
+            scored_words = sorted(zip(filtered, scores), key=lambda x: x[1], reverse=True)
         
-        unique_words = []
-        seen = set()
-        for word, _ in scored_words:
-            if word not in seen:
-                seen.add(word)
-                unique_words.append(word)
-                if len(unique_words) == 20:
-                    break
+            unique_words = []
+            seen = set()
+            for word, _ in scored_words:
+                if word not in seen:
+                    seen.add(word)
+                    unique_words.append(word)
+                    if len(unique_words) == 20:
+                        break
 
-        return [clean_keyword(word) for word in unique_words]
+            return [clean_keyword(word) for word in unique_words]
 
     except Exception as e:
         st.error(f"Ошибка извлечения ключевых слов: {str(e)}")
         return []
 
-def search_relevant_chunks(bm25: BM25Okapi, original_chunks: List[str], keywords: List[str]) -> List[str]:
-    """Поиск релевантных фрагментов"""
+def parse_phrases(query_text: str) -> List[List[str]]:
+    """Фразы в кавычках ("..." или «...») из текста вопроса, токенизированные как индекс"""
+    phrases = [tokenize(quoted or angled) for quoted, angled in PHRASE_PATTERN.findall(query_text)]
+    return [phrase for phrase in phrases if phrase]
+
+def proximity_pairs(query_text: str) -> List[tuple]:
+    """Соседние значимые слова вопроса: их близость в чанке повышает оценку"""
+    terms = [term for term in tokenize(query_text) if len(term) >= PROXIMITY_MIN_LENGTH and term not in SEARCH_STOP_WORDS]
+    return list(zip(terms, terms[1:]))
+
+def search_relevant_chunks(bm25: InvertedIndex, original_chunks: List[str], keywords: List[str],
+                           dense: Optional[DenseIndex] = None, query_text: str = "",
+                           sharded: Optional[ShardedIndex] = None) -> List[str]:
+    """Поиск релевантных фрагментов. Фразы в кавычках ограничивают поиск чанками с их
+    точным вхождением, близко стоящие слова вопроса повышают оценку. С векторным
+    индексом выдачи BM25 и векторного поиска объединяются через reciprocal rank fusion.
+    С шардированным индексом top-k BM25 считается в его рабочих процессах"""
     try:
+        phrases = parse_phrases(query_text)
         query_weights = {term: 2 for term in keywords}
+        for phrase in phrases:
+            query_weights.update({term: 2 for term in phrase})
         weighted_query = []
         for term, weight in query_weights.items():
             weighted_query.extend([term] * weight)
         
-        doc_scores = np.array(bm25.get_scores(weighted_query))
-        sorted_indices = sorted(range(len(doc_scores)), key=lambda i: doc_scores[i], reverse=True)
-        return [original_chunks[i] for i in sorted_indices if doc_scores[i] > 0.0][:5]
+        depth = TOP_K * (HYBRID_DEPTH if dense is not None else RERANK_DEPTH)
+        with timed_stage("scoring"):
+            if isinstance(bm25, FTSIndex):
+                # Фразы - часть выражения MATCH, без маски и списка номеров чанков в запросе
+                top = bm25.top_k(weighted_query, depth, phrases=phrases)
+            else:
+                allowed = bm25.phrase_filter(phrases)
+                top = None
+                if sharded is not None:
+                    try:
+                        top = sharded.top_k(weighted_query, depth, allowed)
+                    except RuntimeError as e:
+                        # Шарды уже остановлены: следующий запрос запустит их заново
+                        WARM_CACHE.discard("shards", sharded)
+                        st.warning(f"Шардированный поиск недоступен, поиск в основном процессе: {str(e)}")
+                if top is None:
+                    top = bm25.top_k(weighted_query, depth, allowed)
+        with timed_stage("proximity"):
+            top = bm25.proximity_boost(top, proximity_pairs(query_text), PROXIMITY_WINDOW, PROXIMITY_WEIGHT)
+        if dense is None:
+            return [original_chunks[i] for i, score in top[:TOP_K] if score > 0.0]
+
+        with timed_stage("vector_search"):
+            nearest = dense.search(query_text or " ".join(keywords), depth)
+        fused = reciprocal_rank_fusion([
+            [i for i, score in top if score > 0.0],
+            [i for i, score in nearest if score > 0.0],
+        ])
+        return [original_chunks[i] for i, _ in fused[:TOP_K]]
     
     except Exception as e:
         st.error(f"Ошибка поиска: {str(e)}")
         return []
 
-# Интерфейс
-st.title("Юридический консультант AI")
-uploaded_file = st.file_uploader("Загрузите документ (PDF, DOCX, TXT)", type=["pdf", "docx", "txt"])
+def select_passages(index, chunks: List[str], keywords: List[str], query_text: str = "") -> List[List[Passage]]:
+    """Лучшие отрывки каждого найденного чанка по ключевым словам и значимым словам вопроса"""
+    with timed_stage("passages"):
+        terms = list(keywords) + [
+            term for term in tokenize(query_text) if len(term) >= PROXIMITY_MIN_LENGTH and term not in SEARCH_STOP_WORDS
+        ]
+        ranker = PassageRanker(index, terms)
+        return [ranker.passages(chunk) for chunk in chunks]
 
-if uploaded_file:
-    with st.spinner("Анализ документа..."):
-        file_text = file_to_text(uploaded_file)
-        if not file_text:
-            st.stop()
-        
-        st.session_state.document_text = file_text
-        bm25_index, original_chunks = create_bm25_index()
-        
-        if not bm25_index or not original_chunks:
-            st.stop()
-        
-        keywords = extract_keywords(file_text, bm25_index)
-        if not keywords:
-            st.error("Не удалось извлечь ключевые слова")
-            st.stop()
-        
-        st.session_state.document_keywords = keywords
-        st.session_state.document_relevant_chunks = search_relevant_chunks(bm25_index, original_chunks, keywords)
-        
-        if st.session_state.document_relevant_chunks:
-            st.subheader("Релевантные фрагменты из документа:")
-            for i, chunk in enumerate(st.session_state.document_relevant_chunks):
-                st.text_area(f"Фрагмент {i+1}", value=chunk[:5000], height=150, key=f"doc_chunk_{i}")
-
-# Блок чата
-user_input = st.text_area(
-    "Введите ваш вопрос:", 
-    height=150,
-    max_chars=600,
-    key="user_input"
-)
-
-if st.button("Отправить"):
-    if not user_input.strip():
-        st.error("Введите текст вопроса")
-        st.stop()
-    
-    with st.spinner("Обработка запроса..."):
-        # Создание индекса и обработка запроса
-        bm25_index, original_chunks = create_bm25_index()
-        if not bm25_index or not original_chunks:
-            st.error("Не удалось создать поисковый индекс")
-            st.stop()
-        
-        # Извлечение ключевых слов из запроса
-        query_keywords = extract_keywords(user_input, bm25_index)
-        if not query_keywords:
-            st.error("Не удалось извлечь ключевые слова из запроса")
-            st.stop()
-        
-        # Поиск релевантных фрагментов
-        query_chunks = search_relevant_chunks(bm25_index, original_chunks, query_keywords)
-        st.session_state.query_relevant_chunks = query_chunks
-        
-        # Формирование контекста
+def context_fragments(chunks: List[str], passages: List[List[Passage]]) -> List[str]:
+    """Фрагменты для промпта: отрывки чанков или, с выключенным PASSAGE_MODE, чанки целиком"""
+    if not PASSAGE_MODE:
+        return chunks
+    return [passages_text(chunk, chunk_passages) for chunk, chunk_passages in zip(chunks, passages)]
+
+def render_fragments(title: str, index, original_chunks, chunks: List[str],
+                     passages: List[List[Passage]], key_prefix: str) -> None:
+    """Найденные фрагменты: отрывки с подсветкой совпавших слов и их границами в чанке"""
+    sources = chunk_sources(index, original_chunks, chunks)
+    st.subheader(title)
+    for i, chunk in enumerate(chunks):
+        label = f"Фрагмент {i+1}{format_sources(sources[i])}"
+        if not PASSAGE_MODE or not passages[i]:
+            st.text_area(label, value=chunk[:5000], height=150, key=f"{key_prefix}_{i}")
+            continue
+        st.markdown(f"**{label}**")
+        for passage in sorted(passages[i], key=lambda p: p.start):
+            position = f"символы {passage.start}–{passage.end} из {len(chunk)}"
+            if passage.heading:
+                position = f"{chunk[passage.heading[0]:passage.heading[1]].strip()} · {position}"
+            st.caption(position[0].upper() + position[1:])
+            st.markdown(highlight_markdown(chunk, passage))
+
+def build_context(query_keywords: List[str], query_chunks: List[str],
+                  document_keywords: Optional[List[str]] = None,
+                  document_chunks: Optional[List[str]] = None) -> str:
+    """Формирование контекста для LLM из документа и запроса"""
+    with timed_stage("context"):
         context_parts = []
-        if st.session_state.document_keywords:
+        if document_keywords:
             context_parts.append(
                 "Контекст из документа:\n"
-                f"Ключевые термины: {', '.join(st.session_state.document_keywords)}\n"
+                f"Ключевые термины: {', '.join(document_keywords)}\n"
                 f"Релевантные фрагменты:\n" + 
-                "\n\n".join(st.session_state.document_relevant_chunks)
+                "\n\n".join(document_chunks or [])
             )
-        
+
         context_parts.append(
             "Контекст из запроса:\n"
             f"Ключевые термины: {', '.join(query_keywords)}\n"
             f"Релевантные фрагменты:\n" + 
             "\n\n".join(query_chunks)
         )
-        
-        assistant_content = "\n\n".join(context_parts)
-        
-        # Формирование запроса к LLM
-        messages = [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": user_input},
-            {"role": "assistant", "content": assistant_content}
-        ]
-        
-        try:
-            response = requests.post(
-                API_URL,
-                headers={"Authorization": f"Bearer {API_KEY}"},
-                json={
-                    "model": "google/gemini-2.0-flash-lite-001",
-                    "messages": messages,
-                    "temperature": 0.3
-                },
-                timeout=API_TIMEOUT
-            )
-            response.raise_for_status()
-            
-            answer = response.json()['choices'][0]['message']['content']
-            st.session_state.chat_log += f"\nПользователь: {user_input}\nАссистент: {answer}"
-            
-            st.subheader("Ответ:")
-            st.write(answer)
-            
-            if query_chunks:
-                st.subheader("Релевантные фрагменты из запроса:")
-                for i, chunk in enumerate(query_chunks):
-                    st.text_area(f"Фрагмент {i+1}", value=chunk[:5000], height=150, key=f"query_chunk_{i}")
-            
-        except Exception as e:
-            st.error(f"Ошибка API: {str(e)}")
-
-# История чата
-if st.session_state.chat_log:
-    st.subheader("История диалога")
-    st.text_area("Лог", value=st.session_state.chat_log, height=300, key="history")
+
+        return "\n\n".join(context_parts)
+
+def build_messages(user_input: str, assistant_content: str) -> List[Dict]:
+    """Формирование запроса к LLM"""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": user_input},
+        {"role": "assistant", "content": assistant_content}
+    ]
+
+def ask_llm(messages: List[Dict], api_url: str = API_URL, api_key: str = API_KEY) -> str:
+    """Запрос к LLM API через общий шлюз, возвращает текст ответа"""
+    payload = {
+        "model": LLM_MODEL,
+        "messages": messages,
+        "temperature": 0.3
+    }
+
+    def post() -> str:
+        response = requests.post(
+            api_url,
+            headers={"Authorization": f"Bearer {api_key}"},
+            json=payload,
+            timeout=API_TIMEOUT
+        )
+        response.raise_for_status()
+        return response.json()['choices'][0]['message']['content']
+
+    # Одинаковые одновременные запросы сессий уходят к провайдеру один раз
+    with timed_stage("llm"):
+        return LLM_GATEWAY.call(request_key(api_url, payload), post)
+
+def process_document(state, file_text: str) -> Dict:
+    """Анализ загруженного документа для сессии state (st.session_state или словарь с теми же
+    ключами): ключевые слова, релевантные чанки корпуса и их отрывки сохраняются в state.
+    error - None при успехе, "" если ошибка уже показана функцией поиска, иначе текст ошибки"""
+    result = {"error": None, "index": None, "original_chunks": None}
+    state["document_text"] = file_text
+    bm25_index, original_chunks = create_search_index()
+    if not bm25_index or not original_chunks:
+        result["error"] = ""
+        return result
+    result.update(index=bm25_index, original_chunks=original_chunks)
+
+    keywords = extract_keywords(file_text, bm25_index)
+    if not keywords:
+        result["error"] = "Не удалось извлечь ключевые слова"
+        return result
+
+    state["document_keywords"] = keywords
+    document_chunks = search_relevant_chunks(bm25_index, original_chunks, keywords)
+    state["document_relevant_chunks"] = document_chunks
+    state["document_passages"] = select_passages(bm25_index, document_chunks, keywords)
+    return result
+
+def answer_question(state, user_input: str, api_url: Optional[str] = None) -> Dict:
+    """Ответ на вопрос в контексте сессии state: поиск, отрывки и запрос к LLM или ответ
+    из кэша; реплика добавляется в state["chat_memory"]. Ошибки ask_llm (LLMOverloaded,
+    ошибки API) не перехватываются. Используется в main() и в loadtest.py"""
+    result = {"error": None, "answer": "", "cached_question": None, "chunks": [], "passages": [],
+              "index": None, "original_chunks": None}
+    # Создание индекса и обработка запроса
+    bm25_index, original_chunks = create_search_index()
+    if not bm25_index or not original_chunks:
+        result["error"] = "Не удалось создать поисковый индекс"
+        return result
+    result.update(index=bm25_index, original_chunks=original_chunks)
+
+    # Ответ на такой же или похожий вопрос в том же контексте берется из кэша
+    # Фразы в кавычках меняют выдачу: вопрос с ними и без них кэшируется раздельно
+    cache_context = context_key(
+        bm25_index.meta.get("fingerprint"), state["document_keywords"], HYBRID_SEARCH,
+        parse_phrases(user_input)
+    )
+    cached = QUERY_CACHE.lookup(user_input, cache_context)
+
+    if cached:
+        query_chunks = cached["chunks"]
+        query_passages = cached["passages"]
+    else:
+        # Извлечение ключевых слов из запроса
+        query_keywords = extract_keywords(user_input, bm25_index)
+        if not query_keywords:
+            result["error"] = "Не удалось извлечь ключевые слова из запроса"
+            return result
+
+        # Поиск релевантных фрагментов
+        dense_index = create_dense_index(original_chunks) if HYBRID_SEARCH else None
+        sharded_index = (
+            create_sharded_index(original_chunks, bm25_index.meta.get("fingerprint"))
+            if SHARD_COUNT > 1 else None
+        )
+        query_chunks = search_relevant_chunks(
+            bm25_index, original_chunks, query_keywords, dense_index, user_input, sharded_index
+        )
+        query_passages = select_passages(bm25_index, query_chunks, query_keywords, user_input)
+
+        # Формирование контекста и запрос к LLM
+        assistant_content = build_context(
+            query_keywords,
+            context_fragments(query_chunks, query_passages),
+            state["document_keywords"],
+            context_fragments(state["document_relevant_chunks"], state["document_passages"])
+        )
+        messages = build_messages(user_input, assistant_content)
+    state["query_relevant_chunks"] = query_chunks
+    result.update(chunks=query_chunks, passages=query_passages)
+
+    if cached:
+        answer = cached["answer"]
+        result["cached_question"] = cached["question"]
+    else:
+        answer = ask_llm(messages, api_url or API_URL)
+        QUERY_CACHE.store(
+            user_input,
+            {"question": user_input, "chunks": query_chunks, "passages": query_passages, "answer": answer},
+            cache_context
+        )
+    state["chat_memory"].add(user_input, answer)
+    result["answer"] = answer
+    return result
+
+def render_timings_panel():
+    """Отладочная панель в сайдбаре: время этапов последнего запроса"""
+    with st.sidebar:
+        if not st.checkbox("Показать время этапов", key="show_timings"):
+            return
+
+        st.subheader("Последний запрос")
+        if st.session_state.last_timings:
+            total = sum(st.session_state.last_timings.values())
+            st.table([
+                {"Этап": stage, "мс": ms, "%": round(ms / total * 100, 1) if total else 0.0}
+                for stage, ms in st.session_state.last_timings.items()
+            ])
+        else:
+            st.caption("Нет данных")
+
+        st.caption(
+            f"LLM: выполняется {LLM_GATEWAY.in_flight} из {LLM_GATEWAY.max_concurrent}, "
+            f"в очереди {LLM_GATEWAY.queued}"
+        )
+        if WARM_CACHE.timings:
+            st.caption("Старт процесса: " + ", ".join(
+                f"{stage} {seconds:.2f} с" for stage, seconds in WARM_CACHE.timings.items()
+            ))
+
+        st.subheader("Все запросы процесса")
+        st.table([
+            {"Этап": stage, "Вызовов": stats["count"], "Среднее, мс": stats["mean_ms"]}
+            for stage, stats in REGISTRY.stage_summary().items()
+        ])
+        hits = REGISTRY.counter_value("query_cache_hits")
+        lookups = hits + REGISTRY.counter_value("query_cache_misses")
+        if lookups:
+            st.caption(f"Кэш вопросов: {int(hits)} попаданий из {int(lookups)} ({hits / lookups:.0%})")
+        with st.expander("Prometheus"):
+            st.code(REGISTRY.render_prometheus(), language="text")
+
+def render_profile_panel():
+    """Сводка профиля последнего запроса в сайдбаре"""
+    profile = st.session_state.last_profile
+    if not profile:
+        return
+    with st.sidebar:
+        st.subheader("Профиль запроса")
+        st.caption(f"{profile['elapsed_ms']} мс, пик памяти {profile['peak_mb']} MB")
+        st.table([{"Модули": group, "мс": ms} for group, ms in profile["by_group_ms"].items()])
+        st.caption(f"Отчет: {profile['report_path']}")
+
+def main():
+    initialize_session()
+    start_metrics_server()
+    profiling_enabled = st.sidebar.checkbox(
+        "Профилирование запроса", value=PROFILE_ENABLED, key="profile_queries"
+    )
+
+    # Интерфейс
+    st.title("Юридический консультант AI")
+    uploaded_file = st.file_uploader("Загрузите документ (PDF, DOCX, TXT)", type=["pdf", "docx", "txt"])
+
+    if uploaded_file:
+        start_trace()
+        with st.spinner("Анализ документа..."):
+            file_text = file_to_text(uploaded_file)
+            if not file_text:
+                st.stop()
+
+            result = process_document(st.session_state, file_text)
+            if result["error"] is not None:
+                if result["error"]:
+                    st.error(result["error"])
+                st.stop()
+
+            if st.session_state.document_relevant_chunks:
+                render_fragments(
+                    "Релевантные фрагменты из документа:", result["index"], result["original_chunks"],
+                    st.session_state.document_relevant_chunks, st.session_state.document_passages, "doc_chunk"
+                )
+        st.session_state.last_timings = finish_trace()
+
+    # Блок чата
+    user_input = st.text_area(
+        "Введите ваш вопрос:", 
+        height=150,
+        max_chars=600,
+        key="user_input"
+    )
+
+    if st.button("Отправить"):
+        if not user_input.strip():
+            st.error("Введите текст вопроса")
+            st.stop()
+
+        start_trace()
+        with profile_request("query", profiling_enabled) as profile, st.spinner("Обработка запроса..."):
+            try:
+                result = answer_question(st.session_state, user_input)
+                if result["error"]:
+                    st.error(result["error"])
+                else:
+                    st.subheader("Ответ:")
+                    if result["cached_question"]:
+                        st.caption(f"Ответ из кэша на вопрос: «{result['cached_question']}»")
+                    st.write(result["answer"])
+
+                    if result["chunks"]:
+                        render_fragments(
+                            "Релевантные фрагменты из запроса:", result["index"], result["original_chunks"],
+                            result["chunks"], result["passages"], "query_chunk"
+                        )
+
+            except LLMOverloaded as e:
+                st.warning(f"Сервис перегружен, повторите вопрос позже ({str(e)})")
+            except Exception as e:
+                st.error(f"Ошибка API: {str(e)}")
+        st.session_state.last_timings = finish_trace()
+        st.session_state.last_profile = profile
+
+    # История чата
+    memory = st.session_state.chat_memory
+    if memory.total_turns:
+        st.subheader("История диалога")
+        st.text_area("Лог", value=memory.render(), height=300, key="history")
+        if memory.total_turns > len(memory.turns):
+            st.caption(f"Реплик: {memory.total_turns}, ранние сжаты в краткое содержание")
+
+    render_timings_panel()
+    render_profile_panel()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""Метрики времени этапов обработки запросов.
+
+Этапы оборачиваются в timed_stage(), длительности агрегируются в гистограммы
+на уровне процесса (общие для всех сессий Streamlit) и отдаются в текстовом
+формате Prometheus: через render_prometheus(), HTTP-эндпоинт
+start_metrics_server() или строки лога. Разбивка по этапам для одного
+запроса собирается между start_trace() и finish_trace().
+
+Счетчики событий (например, попадания в кэш) увеличиваются через
+REGISTRY.increment(), текущие значения (например, длина очереди к LLM)
+задаются через REGISTRY.set_gauge(); все экспортируются вместе с гистограммами.
+
+Переменные окружения:
+    METRICS_PORT - порт эндпоинта /metrics (если не задан, сервер не стартует)
+    METRICS_LOG  - "1", чтобы писать время каждого этапа в лог
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+METRIC_PREFIX = "talk2json"
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRICS_PORT = os.environ.get("METRICS_PORT")
+METRICS_LOG = os.environ.get("METRICS_LOG") == "1"
+
+logger = logging.getLogger("talk2json.metrics")
+
+_current_trace: ContextVar[Optional[Dict[str, float]]] = ContextVar("current_trace", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = STAGE_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.total += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self) -> List[int]:
+        """Накопленные значения по корзинам, как требует формат Prometheus"""
+        result, running = [], 0
+        for count in self.counts:
+            running += count
+            result.append(running)
+        return result
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages: Dict[str, Histogram] = {}
+        self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self.gauges: Dict[str, float] = {}
+
+    def increment(self, name: str, labels: Optional[Dict[str, str]] = None, value: float = 1) -> None:
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def counter_value(self, name: str, labels: Optional[Dict[str, str]] = None) -> float:
+        """Значение счетчика; без labels - сумма по всем меткам"""
+        with self.lock:
+            if labels is not None:
+                return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+            return sum(value for (n, _), value in self.counters.items() if n == name)
+
+    def set_gauge(self, name: str, value: float) -> None:
+        with self.lock:
+            self.gauges[name] = value
+
+    def gauge_value(self, name: str) -> float:
+        with self.lock:
+            return self.gauges.get(name, 0)
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = Histogram()
+            self.stages[stage].observe(seconds)
+
+    def stage_summary(self) -> Dict[str, Dict[str, float]]:
+        """Число вызовов, суммарное и среднее время по этапам"""
+        with self.lock:
+            return {
+                stage: {
+                    "count": h.count,
+                    "total_s": round(h.total, 6),
+                    "mean_ms": round(h.total / h.count * 1000, 3) if h.count else 0.0,
+                }
+                for stage, h in self.stages.items()
+            }
+
+    def render_prometheus(self) -> str:
+        """Текстовый формат экспозиции Prometheus"""
+        name = f"{METRIC_PREFIX}_stage_seconds"
+        lines = [
+            f"# HELP {name} Время этапов обработки запроса в секундах",
+            f"# TYPE {name} histogram",
+        ]
+        with self.lock:
+            for stage, h in sorted(self.stages.items()):
+                for bound, value in zip(h.buckets, h.cumulative()):
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {value}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {h.count}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {h.total:.6f}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {h.count}')
+
+            declared = set()
+            for (counter, labels), value in sorted(self.counters.items()):
+                full_name = f"{METRIC_PREFIX}_{counter}_total"
+                if full_name not in declared:
+                    declared.add(full_name)
+                    lines.append(f"# TYPE {full_name} counter")
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"{full_name}{{{label_text}}} {value:g}" if label_text else f"{full_name} {value:g}")
+
+            for gauge, value in sorted(self.gauges.items()):
+                full_name = f"{METRIC_PREFIX}_{gauge}"
+                lines.append(f"# TYPE {full_name} gauge")
+                lines.append(f"{full_name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        with self.lock:
+            self.stages = {}
+            self.counters = {}
+            self.gauges = {}
+
+
+REGISTRY = MetricsRegistry()
+
+
+def record_stage(stage: str, elapsed: float) -> None:
+    """Время этапа, измеренное вызывающим: в гистограмму процесса и в трассу текущего запроса"""
+    REGISTRY.observe(stage, elapsed)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace[stage] = trace.get(stage, 0.0) + elapsed
+    if METRICS_LOG:
+        logger.info("stage=%s seconds=%.6f", stage, elapsed)
+
+
+@contextmanager
+def timed_stage(stage: str):
+    """Замер времени этапа: в гистограмму процесса и в трассу текущего запроса"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def start_trace() -> Dict[str, float]:
+    """Начало сбора разбивки по этапам для одного запроса"""
+    trace: Dict[str, float] = {}
+    _current_trace.set(trace)
+    return trace
+
+
+def finish_trace() -> Dict[str, float]:
+    """Окончание сбора: возвращает время этапов запроса в миллисекундах"""
+    trace = _current_trace.get() or {}
+    _current_trace.set(None)
+    return {stage: round(seconds * 1000, 3) for stage, seconds in trace.items()}
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server: Optional[ThreadingHTTPServer] = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port: Optional[int] = None, host: str = "0.0.0.0") -> Optional[ThreadingHTTPServer]:
+    """Запуск эндпоинта /metrics в фоновом потоке (один раз на процесс)"""
+    global _server
+    if port is None:
+        if not METRICS_PORT:
+            return None
+        port = int(METRICS_PORT)
+
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer((host, port), MetricsHandler)
+            except OSError as e:
+                logger.warning("Не удалось запустить сервер метрик на порту %s: %s", port, e)
+                return None
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+            logger.info("Метрики доступны на http://%s:%s/metrics", host, port)
+    return _server
+
+
+def log_summary() -> None:
+    """Сводка по этапам в лог"""
+    for stage, stats in REGISTRY.stage_summary().items():
+        logger.info("stage=%s count=%d mean_ms=%.3f total_s=%.3f",
+                    stage, stats["count"], stats["mean_ms"], stats["total_s"])
@@ -0,0 +1,80 @@
+"""MinHash-сигнатуры множеств и LSH-индекс для поиска почти-дубликатов.
+
+Сигнатура - минимумы NUM_PERM случайных хэш-функций по элементам
+множества; доля совпавших позиций двух сигнатур оценивает коэффициент
+Жаккара. LSHIndex делит сигнатуру на полосы (bands) и кладет множество в
+корзину по каждой полосе: кандидатами считаются множества, совпавшие хотя
+бы в одной полосе, поэтому похожие пары находятся без попарного сравнения.
+"""
+
+import zlib
+from collections import defaultdict
+from typing import Dict, Hashable, Iterable, List, Set
+
+import numpy as np
+
+NUM_PERM = 64
+LSH_BANDS = 16
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+
+_rng = np.random.RandomState(1)
+_PERM_A = _rng.randint(1, 2 ** 32 - 1, size=NUM_PERM, dtype=np.uint64)
+_PERM_B = _rng.randint(0, 2 ** 32 - 1, size=NUM_PERM, dtype=np.uint64)
+
+
+def minhash_signature(items: Iterable[str]) -> np.ndarray:
+    """MinHash-сигнатура множества строк (uint64, длина NUM_PERM)"""
+    return signature_from_hashes(np.array([zlib.crc32(item.encode("utf-8")) for item in set(items)], dtype=np.uint64))
+
+
+def signature_from_hashes(hashes: np.ndarray) -> np.ndarray:
+    """MinHash-сигнатура множества, заданного 32-битными хэшами элементов"""
+    if not len(hashes):
+        return np.full(NUM_PERM, MERSENNE_PRIME, dtype=np.uint64)
+    # Переполнение uint64 допустимо: нужна только независимость перестановок
+    with np.errstate(over="ignore"):
+        permuted = (np.outer(_PERM_A, hashes) + _PERM_B[:, None]) % MERSENNE_PRIME
+    return permuted.min(axis=1)
+
+
+def estimate_jaccard(sig_a: np.ndarray, sig_b: np.ndarray) -> float:
+    """Оценка коэффициента Жаккара по двум сигнатурам"""
+    return float(np.mean(sig_a == sig_b))
+
+
+def jaccard(a: Set, b: Set) -> float:
+    """Точный коэффициент Жаккара двух множеств"""
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class LSHIndex:
+    def __init__(self, bands: int = LSH_BANDS, num_perm: int = NUM_PERM):
+        if num_perm % bands:
+            raise ValueError("Длина сигнатуры должна делиться на число полос")
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.buckets: List[Dict[bytes, Set[Hashable]]] = [defaultdict(set) for _ in range(bands)]
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def insert(self, key: Hashable, signature: np.ndarray) -> None:
+        for band, band_key in zip(self.buckets, self._band_keys(signature)):
+            band[band_key].add(key)
+
+    def remove(self, key: Hashable, signature: np.ndarray) -> None:
+        for band, band_key in zip(self.buckets, self._band_keys(signature)):
+            keys = band.get(band_key)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del band[band_key]
+
+    def query(self, signature: np.ndarray) -> Set[Hashable]:
+        """Ключи множеств, совпавших с сигнатурой хотя бы в одной полосе"""
+        candidates: Set[Hashable] = set()
+        for band, band_key in zip(self.buckets, self._band_keys(signature)):
+            candidates |= band.get(band_key, set())
+        return candidates
@@ -0,0 +1,207 @@
+"""Второй этап ранжирования: лучшие отрывки внутри найденных чанков.
+
+Чанк (до CHUNK_SIZE символов) делится на предложения, из соседних
+предложений (до PASSAGE_SENTENCES подряд, не длиннее PASSAGE_MAX_CHARS)
+собираются окна, и каждое окно оценивается по BM25 относительно термов
+вопроса (длина окна для нормировки - в символах). IDF берется из
+поискового индекса (InvertedIndex или FTSIndex, метод term_idf) и
+запоминается в PassageRanker на время запроса, поэтому статистика каждого
+терма запрашивается один раз на все чанки выдачи.
+
+Ключевые слова из main.extract_keywords усечены (clean_keyword), поэтому
+терм длиной не меньше PREFIX_MIN_LENGTH совпадает с любым токеном, который
+с него начинается; IDF в этом случае берется у самого токена. Совпадения
+ищутся одним регулярным выражением по всем термам, без разбора чанка на токены.
+
+Отрывок из середины статьи закона без ее номера и названия мало полезен
+модели, поэтому к отрывку добавляется ближайший предшествующий заголовок
+(строка "Статья N. ...", "Глава N. ..." и т.п.) того же чанка.
+
+Из каждого чанка остается до PASSAGES_PER_CHUNK непересекающихся окон
+с границами в символах исходного чанка и позициями совпавших токенов
+для подсветки. В промпт и в интерфейс идут только эти отрывки.
+"""
+
+import re
+from bisect import bisect_right
+from collections import Counter, defaultdict
+from functools import lru_cache
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+PASSAGE_SENTENCES = 3
+PASSAGE_MAX_CHARS = 1200
+PASSAGES_PER_CHUNK = 2
+PREFIX_MIN_LENGTH = 4
+SENTENCE_CACHE_SIZE = 512
+PASSAGE_SEPARATOR = "\n…\n"
+HEADING_MAX_CHARS = 200
+K1 = 1.2
+B = 0.75
+
+# Граница предложения: знак конца не после цифры и пробел перед заглавной буквой или кавычкой,
+# либо перевод строки. "ст. 15", "п. 3", "т. е." и "Статья 200. Название" не разрывают предложение.
+# Знак конца входит в совпадение (выражение с литералом в начале быстрее) и возвращается предложению
+SENTENCE_BOUNDARY = re.compile(r"[.!?…](?<![0-9].)\s+(?=[А-ЯЁA-Z«\"(])|[ \t]*\n\s*")
+SENTENCE_END = ".!?…"
+HEADING_PATTERN = re.compile(r"^[ \t]*(?:Статья|Глава|Раздел|Подраздел|Часть|§)[ \t]+\d[^\n]*", re.MULTILINE)
+MARKDOWN_SPECIAL = re.compile(r"([\\`*_{}\[\]<>()#+\-!|~$])")
+
+
+class Passage(NamedTuple):
+    start: int
+    end: int
+    score: float
+    # Совпавшие с вопросом токены: (начало, конец) в символах чанка
+    highlights: Tuple[Tuple[int, int], ...]
+    # Ближайший заголовок перед отрывком (начало, конец), если он не входит в отрывок
+    heading: Optional[Tuple[int, int]] = None
+
+
+@lru_cache(maxsize=SENTENCE_CACHE_SIZE)
+def sentence_spans(text: str, max_chars: int = PASSAGE_MAX_CHARS) -> Tuple[Tuple[int, int], ...]:
+    """Границы предложений (начало, конец) без окружающих пробелов; слишком длинные
+    предложения режутся по пробелам на части не длиннее max_chars. Не зависят от
+    вопроса и кэшируются: одни и те же чанки попадают в выдачу разных вопросов"""
+    spans = []
+    start = 0
+    for match in SENTENCE_BOUNDARY.finditer(text):
+        end = match.start() + (text[match.start()] in SENTENCE_END)
+        spans.append((start, end))
+        start = match.end()
+    spans.append((start, len(text)))
+
+    result = []
+    for start, end in spans:
+        while end - start > max_chars:
+            cut = text.rfind(" ", start + max_chars // 2, start + max_chars)
+            cut = cut if cut > start else start + max_chars
+            result.append((start, cut))
+            start = cut
+            while start < end and text[start].isspace():
+                start += 1
+        if end > start:
+            result.append((start, end))
+    return tuple(result)
+
+
+class PassageRanker:
+    def __init__(self, index, query_terms: List[str], window: int = PASSAGE_SENTENCES,
+                 max_chars: int = PASSAGE_MAX_CHARS):
+        self.index = index
+        self.terms = sorted({term for term in query_terms if term})
+        self.window = window
+        self.max_chars = max_chars
+        self.idf: Dict[str, float] = {}
+        # Одно выражение на все термы: длинные совпадают по префиксу, короткие - целым словом.
+        # Терм, который начинается с другого префикса, лишний: его совпадения уже покрыты
+        prefixes = []
+        for term in self.terms:
+            if len(term) >= PREFIX_MIN_LENGTH and not any(term.startswith(prefix) for prefix in prefixes):
+                prefixes.append(term)
+        exact = [term for term in self.terms if len(term) < PREFIX_MIN_LENGTH]
+        alternatives = []
+        if prefixes:
+            alternatives.append(f"(?:{'|'.join(map(re.escape, prefixes))})\\w*")
+        if exact:
+            alternatives.append(f"(?:{'|'.join(map(re.escape, exact))})\\b")
+        pattern = f"\\b(?:{'|'.join(alternatives)})" if alternatives else None
+        # Выражение без IGNORECASE по тексту в нижнем регистре заметно быстрее
+        self.pattern = re.compile(pattern) if pattern else None
+        self.pattern_ignorecase = re.compile(pattern, re.IGNORECASE) if pattern else None
+
+    def _load_idf(self, tokens: List[str]) -> None:
+        missing = [token for token in set(tokens) if token not in self.idf]
+        if missing:
+            known = self.index.term_idf(missing)
+            self.idf.update({token: known.get(token, 0.0) for token in missing})
+
+    def passages(self, chunk: str, count: int = PASSAGES_PER_CHUNK) -> List[Passage]:
+        """До count лучших непересекающихся окон чанка в порядке убывания оценки"""
+        if self.pattern is None:
+            return []
+        sentences = sentence_spans(chunk, self.max_chars)
+        starts = [start for start, _ in sentences]
+        # Только предложения с совпадениями
+        hits: Dict[int, Counter] = defaultdict(Counter)
+        highlights: Dict[int, List[Tuple[int, int]]] = defaultdict(list)
+        lowered = chunk.lower()
+        if len(lowered) == len(chunk):
+            matches = self.pattern.finditer(lowered)
+        else:
+            # Редкие символы меняют длину при lower(): позиции берутся по исходному тексту
+            matches = self.pattern_ignorecase.finditer(chunk)
+        for match in matches:
+            sentence = bisect_right(starts, match.start()) - 1
+            hits[sentence][match.group().lower()] += 1
+            highlights[sentence].append(match.span())
+        self._load_idf([token for counter in hits.values() for token in counter])
+
+        windows = []
+        for first in sorted(hits):
+            for last in range(first, min(first + self.window, len(sentences))):
+                if last > first and sentences[last][1] - sentences[first][0] > self.max_chars:
+                    break
+                windows.append((first, last))
+        if not windows:
+            return []
+
+        avg_length = max(1.0, sum(
+            sentences[last][1] - sentences[first][0] for first, last in windows
+        ) / len(windows))
+        scored = []
+        for first, last in windows:
+            tf = Counter()
+            for sentence in range(first, last + 1):
+                if sentence in hits:
+                    tf.update(hits[sentence])
+            norm = K1 * (1 - B + B * (sentences[last][1] - sentences[first][0]) / avg_length)
+            score = sum(self.idf[token] * n * (K1 + 1) / (n + norm) for token, n in tf.items())
+            scored.append((score, first, last))
+        # При равной оценке - более раннее и более короткое окно
+        scored.sort(key=lambda x: (-x[0], x[1], x[2]))
+
+        headings = [match.span() for match in HEADING_PATTERN.finditer(chunk)]
+        heading_starts = [start for start, _ in headings]
+        result, used = [], set()
+        for score, first, last in scored:
+            if score <= 0.0 or used.intersection(range(first, last + 1)):
+                continue
+            used.update(range(first, last + 1))
+            start = sentences[first][0]
+            heading = None
+            i = bisect_right(heading_starts, start) - 1
+            if i >= 0 and headings[i][0] < start:
+                heading = (headings[i][0], min(headings[i][1], headings[i][0] + HEADING_MAX_CHARS))
+            result.append(Passage(
+                start, sentences[last][1], score,
+                tuple(span for sentence in range(first, last + 1) for span in highlights.get(sentence, ())),
+                heading
+            ))
+            if len(result) == count:
+                break
+        return result
+
+
+def passages_text(chunk: str, passages: List[Passage]) -> str:
+    """Отрывки чанка с их заголовками в порядке следования в тексте; без отрывков - начало чанка"""
+    if not passages:
+        return chunk[:PASSAGE_MAX_CHARS]
+    parts = []
+    for passage in sorted(passages, key=lambda p: p.start):
+        text = chunk[passage.start:passage.end]
+        if passage.heading:
+            text = f"{chunk[passage.heading[0]:passage.heading[1]].strip()}\n{text}"
+        parts.append(text)
+    return PASSAGE_SEPARATOR.join(parts)
+
+
+def highlight_markdown(chunk: str, passage: Passage) -> str:
+    """Отрывок в Markdown с выделением совпавших токенов жирным"""
+    parts, pos = [], passage.start
+    for start, end in passage.highlights:
+        parts.append(MARKDOWN_SPECIAL.sub(r"\\\1", chunk[pos:start]))
+        parts.append(f"**{chunk[start:end]}**")
+        pos = end
+    parts.append(MARKDOWN_SPECIAL.sub(r"\\\1", chunk[pos:passage.end]))
+    # Одиночные переводы строк Markdown склеивает: сохраняются явным разрывом
+    return "".join(parts).replace("\n", "  \n")
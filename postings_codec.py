@@ -0,0 +1,282 @@
+"""Сжатый формат списков словопозиций для сохраненного индекса.
+
+Номера чанков внутри терма хранятся разностями (delta) в кодировке
+variable-byte (7 бит данных на байт, старший бит - признак продолжения),
+частоты термов квантуются в один байт: до TF_EXACT_MAX точно, дальше по
+логарифмической шкале. Кодирование и декодирование векторизованы в NumPy,
+а при загрузке файлы отображаются в память (mmap), поэтому распаковываются
+только списки термов, встретившихся в запросах.
+
+Позиции термов в чанке хранятся так же разностями в variable-byte, перед
+позициями каждого чанка пишется 0: внутри чанка разности не меньше 1, а
+первая позиция хранится как p + 1, поэтому 0 однозначно отмечает начало
+нового чанка и позиции терма распаковываются без точных частот.
+"""
+
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+FORMAT_VERSION = 3
+TF_EXACT_MAX = 128
+TF_MAX = 65536
+DECODE_CACHE_SIZE = 4096
+
+# Таблица декодирования частот: коды 1..128 точные, 129..255 - логарифмическая шкала до TF_MAX
+_TF_LOG_BASE = (TF_MAX / TF_EXACT_MAX) ** (1 / (255 - TF_EXACT_MAX))
+TF_TABLE = np.concatenate([
+    np.arange(TF_EXACT_MAX + 1, dtype=np.float64),
+    TF_EXACT_MAX * _TF_LOG_BASE ** np.arange(1, 255 - TF_EXACT_MAX + 1),
+])
+
+
+def quantize_tfs(tfs: np.ndarray) -> np.ndarray:
+    """Квантование частот термов в uint8 (ближайший код по таблице)"""
+    tfs = np.asarray(tfs, dtype=np.float64)
+    codes = np.minimum(tfs, TF_EXACT_MAX)
+    large = tfs > TF_EXACT_MAX
+    if large.any():
+        log_codes = TF_EXACT_MAX + np.round(np.log(tfs[large] / TF_EXACT_MAX) / np.log(_TF_LOG_BASE))
+        codes[large] = np.minimum(log_codes, 255)
+    return codes.astype(np.uint8)
+
+
+def compact_offsets(offsets: np.ndarray) -> np.ndarray:
+    """Смещения в uint32, если помещаются (обычный случай), иначе uint64"""
+    return offsets.astype(np.uint32 if offsets[-1] < 2 ** 32 else np.uint64)
+
+
+def round_up_float32(values: np.ndarray) -> np.ndarray:
+    """float32 с округлением вверх: верхние границы не должны уменьшаться"""
+    rounded = values.astype(np.float32)
+    low = rounded < values
+    rounded[low] = np.nextafter(rounded[low], np.float32(np.inf))
+    return rounded
+
+
+def encode_varint(values: np.ndarray) -> np.ndarray:
+    """Кодирование неотрицательных целых (< 2^35) в variable-byte поток uint8"""
+    values = np.asarray(values, dtype=np.uint64)
+    if not len(values):
+        return np.zeros(0, dtype=np.uint8)
+
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    for shift in (7, 14, 21, 28):
+        n_bytes += values >= (1 << shift)
+    starts = np.concatenate([[0], np.cumsum(n_bytes)[:-1]])
+
+    out = np.zeros(int(n_bytes.sum()), dtype=np.uint8)
+    for j in range(int(n_bytes.max())):
+        has_byte = n_bytes > j
+        payload = (values[has_byte] >> np.uint64(7 * j)) & np.uint64(0x7F)
+        more = (n_bytes[has_byte] > j + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[has_byte] + j] = (payload | more).astype(np.uint8)
+    return out
+
+
+def decode_varint(stream: np.ndarray) -> np.ndarray:
+    """Векторизованное декодирование variable-byte потока в массив uint64"""
+    stream = np.asarray(stream, dtype=np.uint8)
+    if not len(stream):
+        return np.zeros(0, dtype=np.uint64)
+
+    ends = np.flatnonzero(stream < 0x80)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    # Номер байта внутри своего числа определяет сдвиг его 7 бит
+    byte_pos = np.arange(len(stream)) - np.repeat(starts, ends - starts + 1)
+    parts = (stream & 0x7F).astype(np.uint64) << (7 * byte_pos).astype(np.uint64)
+    return np.add.reduceat(parts, starts)
+
+
+def encode_postings(docs: np.ndarray, offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Delta + varint для всех термов. Возвращает поток и байтовые смещения термов"""
+    deltas = np.diff(docs.astype(np.int64), prepend=0)
+    # Первый номер в каждом терме хранится как есть, а не разностью с предыдущим термом
+    first = offsets[:-1][np.diff(offsets) > 0]
+    deltas[first] = docs[first]
+
+    stream = encode_varint(deltas)
+    n_bytes = np.ones(len(deltas), dtype=np.int64)
+    for shift in (7, 14, 21, 28):
+        n_bytes += deltas >= (1 << shift)
+    byte_offsets = np.concatenate([[0], np.cumsum(n_bytes)])[offsets]
+    return stream, byte_offsets
+
+
+def encode_positions(positions: np.ndarray, pos_offsets: np.ndarray,
+                     offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Позиции всех словопозиций в поток с маркерами. Возвращает поток и байтовые смещения термов"""
+    n_postings = len(pos_offsets) - 1
+    values = np.diff(positions.astype(np.int64), prepend=0)
+    starts = pos_offsets[:-1]
+    values[starts] = positions[starts].astype(np.int64) + 1
+    values = np.insert(values, starts, 0)
+
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    for shift in (7, 14, 21, 28):
+        n_bytes += values >= (1 << shift)
+    byte_starts = np.concatenate([[0], np.cumsum(n_bytes)])
+    # Маркер словопозиции j стоит в потоке на месте pos_offsets[j] + j
+    marker_index = np.concatenate([pos_offsets[:-1] + np.arange(n_postings), [len(values)]])
+    return encode_varint(values), byte_starts[marker_index[offsets]]
+
+
+def decode_positions(stream: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Позиции терма подряд (int32) и границы чанков в этом массиве"""
+    values = decode_varint(stream).astype(np.int64)
+    markers = np.flatnonzero(values == 0)
+    keep = np.ones(len(values), dtype=bool)
+    keep[markers] = False
+    values = values[keep]
+    # После удаления маркеров первая позиция чанка j стоит на месте markers[j] - j
+    bounds = np.concatenate([markers - np.arange(len(markers)), [len(values)]])
+    if not len(values):
+        return np.zeros(0, dtype=np.int32), bounds
+    running = np.cumsum(values)
+    counts = np.diff(bounds)
+    base = np.repeat(running[bounds[:-1]] - values[bounds[:-1]], counts)
+    return (running - base - 1).astype(np.int32), bounds
+
+
+class CompressedPostings:
+    """Доступ к сжатым спискам словопозиций с LRU-кэшем распакованных термов.
+    Индекс читают несколько потоков Streamlit, поэтому кэши меняются под
+    блокировкой; распаковка идет вне ее"""
+
+    def __init__(self, doc_stream: np.ndarray, byte_offsets: np.ndarray,
+                 tf_codes: np.ndarray, offsets: np.ndarray, cache_size: int = DECODE_CACHE_SIZE,
+                 pos_stream: Optional[np.ndarray] = None, pos_byte_offsets: Optional[np.ndarray] = None):
+        self.doc_stream = doc_stream
+        self.byte_offsets = byte_offsets
+        self.tf_codes = tf_codes
+        self.offsets = offsets
+        self.pos_stream = pos_stream
+        self.pos_byte_offsets = pos_byte_offsets
+        self.cache_size = cache_size
+        self.cache: "OrderedDict[int, Tuple[np.ndarray, np.ndarray]]" = OrderedDict()
+        self.pos_cache: "OrderedDict[int, Tuple[np.ndarray, np.ndarray]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def postings(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        with self.lock:
+            cached = self.cache.get(term_id)
+            if cached is not None:
+                self.cache.move_to_end(term_id)
+                return cached
+
+        stream = self.doc_stream[self.byte_offsets[term_id]:self.byte_offsets[term_id + 1]]
+        docs = np.cumsum(decode_varint(stream)).astype(np.int32)
+        tfs = TF_TABLE[self.tf_codes[self.offsets[term_id]:self.offsets[term_id + 1]]]
+
+        with self.lock:
+            self.cache[term_id] = (docs, tfs)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return docs, tfs
+
+    def positions(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        with self.lock:
+            cached = self.pos_cache.get(term_id)
+            if cached is not None:
+                self.pos_cache.move_to_end(term_id)
+                return cached
+
+        stream = self.pos_stream[self.pos_byte_offsets[term_id]:self.pos_byte_offsets[term_id + 1]]
+        result = decode_positions(stream)
+        with self.lock:
+            self.pos_cache[term_id] = result
+            if len(self.pos_cache) > self.cache_size:
+                self.pos_cache.popitem(last=False)
+        return result
+
+
+def write_index(path: str, meta: Dict, vocab: List[str], arrays: Dict[str, np.ndarray],
+                docs: np.ndarray, tfs: np.ndarray, offsets: np.ndarray,
+                positions: np.ndarray, pos_offsets: np.ndarray) -> None:
+    """Запись индекса в папку: метаданные, словарь, сжатые списки, позиции и служебные массивы.
+
+    Каждый файл пишется под временным именем и переименовывается (os.replace):
+    прежний индекс из этой папки может быть отображен в память (WARM_CACHE,
+    другие сессии, процессы шардов), и перезапись файла на месте обрывает его
+    чтение с SIGBUS. Отображения держат старые файлы до закрытия"""
+    os.makedirs(path, exist_ok=True)
+    # meta.json удаляется первым и пишется последним: без него индекс считается недописанным
+    meta_path = os.path.join(path, "meta.json")
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    doc_stream, byte_offsets = encode_postings(docs, offsets)
+    pos_stream, pos_byte_offsets = encode_positions(positions, pos_offsets, offsets)
+
+    _write_bytes(path, "docs.bin", doc_stream)
+    _write_bytes(path, "tfs.bin", quantize_tfs(tfs))
+    _write_array(path, "byte_offsets", compact_offsets(byte_offsets))
+    _write_array(path, "offsets", compact_offsets(offsets))
+    _write_bytes(path, "positions.bin", pos_stream)
+    _write_array(path, "pos_byte_offsets", compact_offsets(pos_byte_offsets))
+    for name, array in arrays.items():
+        _write_array(path, name, array)
+
+    # Термы не содержат пробельных символов, поэтому словарь хранится построчно
+    _write_text(path, "vocab.txt", "\n".join(vocab))
+    _write_text(path, "meta.json", json.dumps({**meta, "format_version": FORMAT_VERSION}, ensure_ascii=False))
+
+
+def _write_bytes(path: str, name: str, data: np.ndarray) -> None:
+    tmp_path = os.path.join(path, f"{name}.tmp")
+    data.tofile(tmp_path)
+    os.replace(tmp_path, os.path.join(path, name))
+
+
+def _write_array(path: str, name: str, array: np.ndarray) -> None:
+    tmp_path = os.path.join(path, f"{name}.npy.tmp")
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, os.path.join(path, f"{name}.npy"))
+
+
+def _write_text(path: str, name: str, text: str) -> None:
+    tmp_path = os.path.join(path, f"{name}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, os.path.join(path, name))
+
+
+def read_index(path: str, array_names: List[str]) -> Tuple[Dict, List[str], Dict[str, np.ndarray], CompressedPostings]:
+    """Чтение индекса из папки с отображением крупных файлов в память"""
+    with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("format_version") != FORMAT_VERSION:
+        raise ValueError(f"Неподдерживаемая версия формата индекса: {meta.get('format_version')}")
+
+    with open(os.path.join(path, "vocab.txt"), "r", encoding="utf-8") as f:
+        content = f.read()
+        vocab = content.split("\n") if content else []
+
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy")) for name in array_names}
+    offsets = np.load(os.path.join(path, "offsets.npy")).astype(np.int64)
+    store = CompressedPostings(
+        _map_bytes(os.path.join(path, "docs.bin")),
+        np.load(os.path.join(path, "byte_offsets.npy")).astype(np.int64),
+        _map_bytes(os.path.join(path, "tfs.bin")),
+        offsets,
+        pos_stream=_map_bytes(os.path.join(path, "positions.bin")),
+        pos_byte_offsets=np.load(os.path.join(path, "pos_byte_offsets.npy")).astype(np.int64),
+    )
+    return meta, vocab, arrays, store
+
+
+def _map_bytes(file_path: str) -> np.ndarray:
+    """Отображение файла в память (пустой файл mmap не поддерживает)"""
+    if os.path.getsize(file_path):
+        return np.memmap(file_path, dtype=np.uint8, mode="r")
+    return np.zeros(0, dtype=np.uint8)
+
+
+def index_size(path: str) -> int:
+    """Размер индекса на диске в байтах"""
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
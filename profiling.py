@@ -0,0 +1,163 @@
+"""Режим профилирования одного запроса.
+
+profile_request() выполняет блок под cProfile и tracemalloc и пишет в
+data/profiles/ два файла на запрос:
+    <время>_<pid>-<номер>_<имя>.prof - статистика cProfile (snakeviz, gprof2dot, pstats)
+    <время>_<pid>-<номер>_<имя>.txt  - время по модулям, топ функций, граф вызовов
+                                       и топ аллокаций памяти по строкам кода
+Номер процесса и счетчик запросов в имени не дают запросам одной секунды
+перезаписать отчеты друг друга.
+
+Включается переменной окружения TALK2JSON_PROFILE=1 или переключателем
+в сайдбаре. tracemalloc глобален для процесса, поэтому одновременно
+профилируется только один запрос, остальные выполняются как обычно.
+Если трассировку уже включил кто-то другой (benchmark, loadtest), она не
+останавливается, а пик памяти в отчете считается с ее начала.
+"""
+
+import cProfile
+import io
+import itertools
+import os
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+PROFILE_DIR = os.path.join("data", "profiles")
+PROFILE_ENABLED = os.environ.get("TALK2JSON_PROFILE") == "1"
+STATS_LIMIT = 40
+CALLEES_LIMIT = 15
+ALLOCATIONS_LIMIT = 25
+TRACEMALLOC_FRAMES = 10
+
+# Группы модулей для сводки "куда ушло время"
+MODULE_GROUPS = [
+    ("rank_bm25", "rank_bm25"),
+    ("regex", "re/"),
+    ("regex", "sre_"),
+    ("numpy", "numpy"),
+    ("http", "requests"),
+    ("http", "urllib3"),
+    ("http", "socket"),
+    ("http", "ssl"),
+    ("streamlit", "streamlit"),
+    ("app", "main.py"),
+]
+
+_profile_lock = threading.Lock()
+_profile_counter = itertools.count(1)
+
+
+def module_group(filename: str) -> str:
+    """Группа модуля по имени файла из статистики cProfile"""
+    normalized = filename.replace("\\", "/")
+    for group, marker in MODULE_GROUPS:
+        if marker in normalized:
+            return group
+    if normalized == "~":
+        return "builtins"
+    return "other"
+
+
+def time_by_group(stats: pstats.Stats) -> Dict[str, float]:
+    """Собственное время функций (tottime), сгруппированное по модулям"""
+    groups = defaultdict(float)
+    for (filename, _, name), (_, _, tottime, _, _) in stats.stats.items():
+        group = module_group(filename)
+        # Встроенные функции регулярных выражений cProfile записывает как '~'
+        if group == "builtins" and re.search(r"re\.Pattern|_sre", name):
+            group = "regex"
+        groups[group] += tottime
+    return dict(sorted(groups.items(), key=lambda x: x[1], reverse=True))
+
+
+def top_functions(stats: pstats.Stats, limit: int = 10) -> List[Dict]:
+    """Функции с наибольшим накопленным временем"""
+    rows = []
+    for (filename, line, name), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+        rows.append({
+            "function": f"{os.path.basename(filename)}:{line}({name})",
+            "calls": ncalls,
+            "tottime_ms": round(tottime * 1000, 3),
+            "cumtime_ms": round(cumtime * 1000, 3),
+        })
+    return sorted(rows, key=lambda r: r["cumtime_ms"], reverse=True)[:limit]
+
+
+def render_report(name: str, elapsed: float, stats: pstats.Stats,
+                  snapshot: tracemalloc.Snapshot, peak: int) -> str:
+    """Текстовый отчет: время по модулям, cProfile, граф вызовов, аллокации"""
+    out = io.StringIO()
+    out.write(f"Запрос: {name}\nВремя: {elapsed * 1000:.1f} мс\n")
+    out.write(f"Пик памяти (tracemalloc): {peak / 1024 / 1024:.2f} MB\n\n")
+
+    out.write("== Собственное время по модулям ==\n")
+    for group, seconds in time_by_group(stats).items():
+        out.write(f"{group:>12}: {seconds * 1000:10.1f} мс\n")
+
+    stats.stream = out
+    out.write("\n== Топ функций по накопленному времени ==\n")
+    stats.sort_stats("cumulative").print_stats(STATS_LIMIT)
+    out.write("\n== Граф вызовов (кого вызывают самые дорогие функции) ==\n")
+    stats.print_callees(CALLEES_LIMIT)
+
+    out.write("\n== Топ аллокаций памяти по строкам ==\n")
+    for stat in snapshot.statistics("lineno")[:ALLOCATIONS_LIMIT]:
+        out.write(f"{stat}\n")
+    return out.getvalue()
+
+
+@contextmanager
+def profile_request(name: str, enabled: Optional[bool] = None, output_dir: str = PROFILE_DIR):
+    """Профилирование блока кода. Отдает словарь, который после выхода из блока
+    содержит пути к отчетам и краткую сводку (пустой, если профилирование
+    выключено или уже идет в другом потоке)"""
+    result: Dict = {}
+    if enabled is None:
+        enabled = PROFILE_ENABLED
+    if not enabled or not _profile_lock.acquire(blocking=False):
+        yield result
+        return
+
+    profiler = cProfile.Profile()
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        yield result
+    finally:
+        profiler.disable()
+        elapsed = time.perf_counter() - start
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        if not was_tracing:
+            tracemalloc.stop()
+        request_number = next(_profile_counter)
+        _profile_lock.release()
+
+        os.makedirs(output_dir, exist_ok=True)
+        safe_name = re.sub(r"[^\w-]+", "_", name)[:40]
+        base = os.path.join(
+            output_dir, f"{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}-{request_number}_{safe_name}"
+        )
+        profiler.dump_stats(base + ".prof")
+
+        stats = pstats.Stats(profiler)
+        with open(base + ".txt", "w", encoding="utf-8") as f:
+            f.write(render_report(name, elapsed, stats, snapshot, peak))
+
+        result.update({
+            "stats_path": base + ".prof",
+            "report_path": base + ".txt",
+            "elapsed_ms": round(elapsed * 1000, 1),
+            "peak_mb": round(peak / 1024 / 1024, 2),
+            "by_group_ms": {g: round(s * 1000, 1) for g, s in time_by_group(stats).items()},
+            "top_functions": top_functions(stats),
+        })
@@ -0,0 +1,149 @@
+"""Кэш ответов на похожие вопросы.
+
+Вопрос нормализуется в множество термов (нижний регистр, лемматизация
+pymorphy, если установлен, иначе усечение до основы, без служебных
+слов). Точное совпадение множества находится по хэшу, почти-дубликаты -
+через MinHash/LSH с проверкой точного коэффициента Жаккара против
+порога. Записи хранятся отдельно для каждого контекста (корпус и
+загруженный документ), вытесняются по LRU и сроку жизни. Попадания и
+промахи считаются в счетчиках metrics.REGISTRY.
+
+Отрицания ("не", "ни", "без") остаются термами: "можно ли расторгнуть"
+и "нельзя ли не расторгать" - разные вопросы. Короткие вопросы (не больше
+CACHE_EXACT_TERMS термов) совпадают только точно: у них Жаккар 0.8 дает
+уже подмножество ("срок договора аренды" и "срок договора аренды земли").
+"""
+
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Optional
+
+from metrics import REGISTRY
+from minhash import LSHIndex, jaccard, minhash_signature
+
+try:
+    import pymorphy3 as pymorphy
+    HAS_MORPH = True
+except ImportError:
+    try:
+        import pymorphy2 as pymorphy
+        HAS_MORPH = True
+    except ImportError:
+        HAS_MORPH = False
+
+CACHE_THRESHOLD = 0.8
+CACHE_EXACT_TERMS = 5
+CACHE_MAX_ENTRIES = 512
+CACHE_TTL = 24 * 3600
+STEM_LENGTH = 6
+
+WORD_PATTERN = re.compile(r"[а-яёa-z0-9]+")
+STOP_WORDS = {
+    "и", "в", "во", "на", "по", "с", "со", "к", "ко", "о", "об", "от", "до", "за", "из", "у",
+    "для", "при", "под", "над", "или", "а", "но", "ли", "же", "это",
+    "как", "каков", "какова", "каково", "каковы", "какой", "какая", "какое", "какие",
+    "что", "кто", "где", "когда", "зачем", "почему", "сколько", "чем",
+    "мне", "я", "мы", "нам", "можно", "нужно", "скажите", "подскажите", "пожалуйста",
+}
+# Меняют смысл вопроса, поэтому не входят в STOP_WORDS, но для поиска бесполезны
+NEGATION_WORDS = {"не", "ни", "без"}
+
+_morph = pymorphy.MorphAnalyzer() if HAS_MORPH else None
+
+
+def normalize_question(question: str) -> FrozenSet[str]:
+    """Множество нормализованных термов вопроса"""
+    terms = set()
+    for word in WORD_PATTERN.findall(question.lower().replace("ё", "е")):
+        if word in STOP_WORDS:
+            continue
+        if _morph is not None:
+            terms.add(_morph.parse(word)[0].normal_form)
+        else:
+            terms.add(word[:STEM_LENGTH])
+    return frozenset(terms)
+
+
+def context_key(*parts: object) -> str:
+    """Ключ контекста: ответы не переиспользуются между разными корпусами и документами"""
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+
+class QueryCache:
+    def __init__(self, threshold: float = CACHE_THRESHOLD, max_entries: int = CACHE_MAX_ENTRIES,
+                 ttl: float = CACHE_TTL):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[tuple, Dict]" = OrderedDict()
+        self.lsh = LSHIndex()
+
+    def lookup(self, question: str, context: str = "") -> Optional[Dict]:
+        """Сохраненный результат для такого же или похожего вопроса"""
+        terms = normalize_question(question)
+        if not terms:
+            return None
+
+        with self.lock:
+            entry = self._get((context, terms))
+            if entry is not None:
+                REGISTRY.increment("query_cache_hits", {"kind": "exact"})
+                return entry["result"]
+
+            best, best_similarity = None, self.threshold
+            # Короткие вопросы - только точное совпадение
+            candidates = self.lsh.query(minhash_signature(terms)) if len(terms) > CACHE_EXACT_TERMS else ()
+            for key in candidates:
+                if key[0] != context or len(key[1]) <= CACHE_EXACT_TERMS:
+                    continue
+                similarity = jaccard(terms, key[1])
+                if similarity >= best_similarity:
+                    best, best_similarity = key, similarity
+
+            entry = self._get(best) if best is not None else None
+            if entry is not None:
+                REGISTRY.increment("query_cache_hits", {"kind": "similar"})
+                return {**entry["result"], "similarity": round(best_similarity, 3)}
+
+        REGISTRY.increment("query_cache_misses")
+        return None
+
+    def store(self, question: str, result: Dict, context: str = "") -> None:
+        terms = normalize_question(question)
+        if not terms:
+            return
+        key = (context, terms)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            signature = minhash_signature(terms)
+            self.entries[key] = {"result": result, "signature": signature, "time": time.time()}
+            self.lsh.insert(key, signature)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+
+    def _get(self, key: tuple) -> Optional[Dict]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry["time"] > self.ttl:
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def _remove(self, key: tuple) -> None:
+        entry = self.entries.pop(key)
+        self.lsh.remove(key, entry["signature"])
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries = OrderedDict()
+            self.lsh = LSHIndex()
+
+
+QUERY_CACHE = QueryCache()
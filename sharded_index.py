@@ -0,0 +1,205 @@
+"""Шардированный BM25-индекс с поиском scatter-gather по рабочим процессам.
+
+Корпус делится на непрерывные диапазоны чанков, каждый шард - обычный
+InvertedIndex в своей папке (shard_000, shard_001, ...). Шарды сохраняются
+со статистиками всего корпуса (df термов, число чанков, avgdl и замена
+отрицательных IDF, посчитанная по словарю всего корпуса), поэтому их
+оценки совпадают с оценками единого индекса, а слияние локальных top-k
+дает тот же глобальный top-k.
+
+Каждый шард обслуживает отдельный процесс: он открывает шард через
+InvertedIndex.load, списки словопозиций отображаются в память только для
+чтения и делятся страничным кэшем ОС. Координатор рассылает запрос всем
+процессам, собирает их top-k и сливает по оценке. Ответ ждется не дольше
+SHARD_QUERY_TIMEOUT; после ошибки или таймаута шарда индекс останавливает
+процессы (очередность ответов уже сбита) и дальше не используется.
+
+Формат папки:
+    shard_NNN/    - индексы шардов (postings_codec)
+    shards.json   - границы шардов и метаданные (пишется последним)
+"""
+
+import heapq
+import json
+import multiprocessing
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from inverted_index import InvertedIndex, idf_floor_value
+
+SHARDS_FILE = "shards.json"
+WORKER_START_TIMEOUT = 60
+SHARD_QUERY_TIMEOUT = 10
+
+
+def shard_bounds(corpus_size: int, n_shards: int) -> List[int]:
+    """Границы шардов: n_shards почти равных диапазонов номеров чанков"""
+    n_shards = max(1, min(n_shards, corpus_size or 1))
+    return [corpus_size * i // n_shards for i in range(n_shards + 1)]
+
+
+def build_shards(token_ids: List[np.ndarray], terms: List[str], n_shards: int, path: str,
+                 k1: float = 1.5, b: float = 0.75, meta: Optional[Dict] = None) -> None:
+    """Построение и сохранение шардов по массивам номеров термов (analyzer.TokenCache)"""
+    bounds = shard_bounds(len(token_ids), n_shards)
+    shards, used_ids = [], []
+    global_df = np.zeros(len(terms), dtype=np.int64)
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        shard = InvertedIndex.from_token_ids(token_ids[start:end], terms, k1=k1, b=b)
+        # Словарь шарда упорядочен по общим номерам встретившихся в нем термов
+        used = np.unique(np.concatenate(token_ids[start:end])) if end > start else np.zeros(0, dtype=np.int64)
+        global_df[used] += shard.df
+        shards.append(shard)
+        used_ids.append(used)
+
+    total_tokens = sum(len(ids) for ids in token_ids)
+    avgdl = total_tokens / len(token_ids) if token_ids else 0.0
+    # Средний IDF для замены отрицательных значений - по словарю всего корпуса, а не шарда
+    idf_floor = idf_floor_value(global_df, len(token_ids), shards[0].epsilon if shards else 0.25)
+    os.makedirs(path, exist_ok=True)
+    # Описание удаляется первым и пишется последним: без него шарды считаются недостроенными
+    shards_file = os.path.join(path, SHARDS_FILE)
+    if os.path.exists(shards_file):
+        os.remove(shards_file)
+    for i, (shard, used) in enumerate(zip(shards, used_ids)):
+        shard.set_collection_stats(global_df[used], len(token_ids), avgdl, idf_floor)
+        shard.save(os.path.join(path, f"shard_{i:03d}"), meta)
+    with open(shards_file, "w", encoding="utf-8") as f:
+        json.dump({**(meta or {}), "bounds": bounds, "idf_floor": idf_floor}, f, ensure_ascii=False)
+
+
+def read_shards_meta(path: str) -> Optional[Dict]:
+    """Описание сохраненных шардов или None, если их нет"""
+    try:
+        with open(os.path.join(path, SHARDS_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _serve_shard(path: str, conn) -> None:
+    """Цикл рабочего процесса: запросы (query, k, allowed) -> локальный top-k шарда"""
+    try:
+        index = InvertedIndex.load(path)
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+        return
+    conn.send(("ready", index.corpus_size))
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        try:
+            conn.send(("ok", index.top_k(*request)))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class ShardedIndex:
+    def __init__(self, path: str):
+        self.meta = read_shards_meta(path)
+        if self.meta is None:
+            raise ValueError(f"Шарды не найдены: {path}")
+        self.bounds = self.meta["bounds"]
+        self.corpus_size = self.bounds[-1]
+        self.lock = threading.Lock()
+        self.workers = []
+        self.connections = []
+
+        # spawn: рабочие процессы не наследуют потоки и состояние родителя (Streamlit)
+        context = multiprocessing.get_context("spawn")
+        try:
+            for i in range(len(self.bounds) - 1):
+                parent_conn, child_conn = context.Pipe()
+                worker = context.Process(
+                    target=_serve_shard, args=(os.path.join(path, f"shard_{i:03d}"), child_conn), daemon=True
+                )
+                worker.start()
+                child_conn.close()
+                self.workers.append(worker)
+                self.connections.append(parent_conn)
+            self._gather(WORKER_START_TIMEOUT)
+        except Exception:
+            self.close()
+            raise
+
+    @property
+    def alive(self) -> bool:
+        """Все рабочие процессы запущены и отвечают"""
+        return bool(self.workers) and all(worker.is_alive() for worker in self.workers)
+
+    def _receive(self, shard: int, conn, timeout: Optional[float] = None) -> Tuple[str, object]:
+        if timeout is not None and not conn.poll(max(0.0, timeout)):
+            return "error", "нет ответа"
+        try:
+            return conn.recv()
+        except EOFError:
+            return "error", "процесс завершился"
+
+    def _gather(self, timeout: Optional[float] = None) -> List:
+        """Ответы всех шардов за общее время timeout; ответы читаются все, даже после
+        ошибки, чтобы не сбить очередность"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        replies = [
+            self._receive(i, conn, deadline - time.monotonic() if deadline is not None else None)
+            for i, conn in enumerate(self.connections)
+        ]
+        for i, (status, payload) in enumerate(replies):
+            if status == "error":
+                raise RuntimeError(f"Ошибка шарда {i}: {payload}")
+        return [payload for _, payload in replies]
+
+    def top_k(self, query: List[str], k: int, allowed: Optional[np.ndarray] = None,
+              timeout: float = SHARD_QUERY_TIMEOUT) -> List[Tuple[int, float]]:
+        """Top-k по всем шардам: запрос рассылается всем процессам, ответы сливаются по оценке.
+        RuntimeError, если шарды остановлены, не ответили за timeout или завершились"""
+        if k <= 0:
+            return []
+        with self.lock:
+            if not self.connections:
+                raise RuntimeError("Процессы шардов остановлены")
+            try:
+                for conn, start, end in zip(self.connections, self.bounds[:-1], self.bounds[1:]):
+                    conn.send((query, k, allowed[start:end] if allowed is not None else None))
+                replies = self._gather(timeout)
+            except (OSError, RuntimeError) as e:
+                # Поздний ответ сбил бы очередность следующих запросов: процессы останавливаются
+                self.close(timeout=0)
+                raise RuntimeError(str(e)) from e
+        results = [
+            (start + doc, score) for start, top in zip(self.bounds[:-1], replies) for doc, score in top
+        ]
+        return heapq.nsmallest(k, results, key=lambda x: (-x[1], x[0]))
+
+    def close(self, timeout: float = 5) -> None:
+        """Остановка рабочих процессов: timeout секунд на штатное завершение, затем SIGTERM"""
+        for conn in self.connections:
+            try:
+                conn.send(None)
+            except (OSError, ValueError):
+                pass
+            conn.close()
+        for worker in self.workers:
+            worker.join(timeout=timeout)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join(timeout=1)
+            if worker.is_alive():
+                # Остановленный или зависший в системном вызове процесс не реагирует на SIGTERM
+                worker.kill()
+                worker.join(timeout=1)
+        self.workers, self.connections = [], []
+
+    def __enter__(self) -> "ShardedIndex":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,111 @@
+"""Прогрев приложения до первого запроса.
+
+Streamlit выполняет main.py заново при каждом действии пользователя, а
+первый запрос после старта процесса платит за импорт модулей и загрузку
+(или построение) индексов. WARM_CACHE хранит загруженные индексы и
+рабочие процессы шардов на уровне процесса: этот модуль импортируется один
+раз, поэтому перезапуски скрипта берут их из кэша.
+
+python warmup.py [аргументы streamlit run] импортирует приложение, загружает
+или строит индексы (BM25, кэш токенов, векторный индекс и шарды, если они
+включены), выполняет пробный поиск, печатает время импорта и прогрева и
+запускает сервер Streamlit в том же процессе: первый пользователь после
+рестарта пода получает уже прогретый процесс.
+python warmup.py --check только прогревает и завершается (например, чтобы
+построить индексы на диске при сборке образа).
+"""
+
+import os
+import sys
+import threading
+import time
+from typing import Dict, Hashable, Optional
+
+from metrics import REGISTRY
+
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+WARMUP_QUESTION = "Срок исковой давности"
+
+
+class WarmCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries: Dict[str, tuple] = {}
+        self.timings: Dict[str, float] = {}
+
+    def get(self, name: str, key: Hashable) -> Optional[object]:
+        """Значение, сохраненное под именем name с тем же ключом"""
+        with self.lock:
+            entry = self.entries.get(name)
+        return entry[1] if entry is not None and entry[0] == key else None
+
+    def put(self, name: str, key: Hashable, value: object) -> Optional[object]:
+        """Одно значение на имя: возвращает вытесненное значение с другим ключом"""
+        with self.lock:
+            previous = self.entries.get(name)
+            self.entries[name] = (key, value)
+        if previous is not None and previous[1] is not value:
+            return previous[1]
+        return None
+
+    def discard(self, name: str, value: object) -> None:
+        """Удаление значения (например, сломанного индекса), если оно еще хранится под именем name"""
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None and entry[1] is value:
+                del self.entries[name]
+
+    def record(self, stage: str, seconds: float) -> None:
+        """Время этапа старта: для панели main.py и гистограмм metrics"""
+        with self.lock:
+            self.timings[stage] = round(seconds, 3)
+        REGISTRY.observe(stage, seconds)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries = {}
+            self.timings = {}
+
+
+WARM_CACHE = WarmCache()
+
+
+def warm_up() -> Dict[str, float]:
+    """Импорт приложения, загрузка индексов и пробный поиск. Возвращает время этапов в секундах"""
+    start = time.perf_counter()
+    import main as app
+    WARM_CACHE.record("startup_import", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    bm25, chunks = app.create_search_index()
+    if bm25 is not None:
+        dense = app.create_dense_index(chunks) if app.HYBRID_SEARCH else None
+        sharded = (
+            app.create_sharded_index(chunks, bm25.meta.get("fingerprint")) if app.SHARD_COUNT > 1 else None
+        )
+        # Пробный поиск подгружает списки словопозиций и инициализирует кэши разбора
+        keywords = app.extract_keywords(WARMUP_QUESTION, bm25)
+        app.search_relevant_chunks(bm25, chunks, keywords, dense, WARMUP_QUESTION, sharded)
+    WARM_CACHE.record("startup_warmup", time.perf_counter() - start)
+    return dict(WARM_CACHE.timings)
+
+
+def main(argv: Optional[list] = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    timings = warm_up()
+    print(
+        f"Прогрев: импорт {timings['startup_import']:.2f} с, индексы {timings['startup_warmup']:.2f} с",
+        file=sys.stderr
+    )
+    if "--check" in argv:
+        return 0
+
+    from streamlit.web import cli as stcli
+    sys.argv = ["streamlit", "run", MAIN_SCRIPT, *argv]
+    return stcli.main()
+
+
+if __name__ == "__main__":
+    # Запуск через модуль warmup, а не __main__: main.py импортирует тот же WARM_CACHE
+    import warmup
+    sys.exit(warmup.main())